@@ -1,6 +1,9 @@
-from flask import Blueprint, jsonify
+import json
+from flask import Blueprint, jsonify, request, current_app
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from models import db, User, Upload, Transaction
+from models import db, User, Upload, Transaction, ColumnProfile, CategoryRule, Budget, DailyBalance
+from services import balances, cache, profiles, rules, rollups
+from services.storage import release_blob
 
 admin_bp = Blueprint('admin', __name__)
 
@@ -65,18 +68,202 @@ def delete_user(user_id):
     try:
         # Cascade delete: Transactions -> Uploads -> User
         # Find all uploads for this user
-        uploads = Upload.query.filter_by(user_id=user_id).all()
+        # Refreshes first: they reference the upload they refreshed
+        uploads = Upload.query.filter_by(user_id=user_id).order_by(Upload.append_to_id.is_(None), Upload.id).all()
+        if any(u.status in ('pending', 'processing') for u in uploads):
+            # A worker would keep inserting rows under the deleted uploads
+            return jsonify({"error": "Some uploads of this user are still being processed. Try again once they are done."}), 409
         for upload in uploads:
             # Delete transactions for each upload
             Transaction.query.filter_by(source_file_id=upload.id).delete()
+            rollups.delete(upload.id)
+            balances.delete(upload.id)
             # Delete the upload record
             db.session.delete(upload)
+            db.session.flush()
+
+        # Their categorization rules, budgets and what is left of their balance series
+        CategoryRule.query.filter_by(user_id=user_id).delete()
+        Budget.query.filter_by(user_id=user_id).delete()
+        DailyBalance.query.filter_by(user_id=user_id).delete()
+
+        # Column profiles learned from this user's files
+        user_profiles = ColumnProfile.query.filter_by(user_id=user_id).all()
+        for profile in user_profiles:
+            profiles.forget(profile)
+            db.session.delete(profile)
             
         # Delete the user
         db.session.delete(user_to_delete)
         db.session.commit()
+        cache.forget(user_id) # Its entries can no longer be read (see cache.data_version)
+
+        # Stored files no longer referenced by any upload
+        for upload in uploads:
+            try:
+                release_blob(current_app, upload)
+            except Exception as e:
+                print(f"Error deleting file from disk: {e}")
         
         return jsonify({"message": f"User {user_to_delete.username} deleted successfully"}), 200
     except Exception as e:
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
+
+@admin_bp.route('/column-profiles', methods=['GET'])
+@jwt_required()
+def get_column_profiles():
+    current_user = User.query.get(get_jwt_identity())
+
+    if not current_user or not current_user.is_admin:
+        return jsonify({"error": "Admin access required"}), 403
+
+    rows = ColumnProfile.query.order_by(ColumnProfile.hits.desc(), ColumnProfile.id).all()
+    return jsonify({
+        "profiles": [{
+            "id": p.id,
+            "fingerprint": p.fingerprint,
+            "user_id": p.user_id,
+            "name": p.name,
+            "columns": json.loads(p.columns) if p.columns else [],
+            "mapping": json.loads(p.mapping),
+            "date_format": p.date_format,
+            "hits": p.hits or 0,
+            "last_used_at": p.last_used_at.strftime('%Y-%m-%d %H:%M') if p.last_used_at else None
+        } for p in rows],
+        "cache": profiles.get_stats()
+    }), 200
+
+@admin_bp.route('/column-profiles/<int:profile_id>/promote', methods=['POST'])
+@jwt_required()
+def promote_column_profile(profile_id):
+    current_user = User.query.get(get_jwt_identity())
+
+    if not current_user or not current_user.is_admin:
+        return jsonify({"error": "Admin access required"}), 403
+
+    profile = ColumnProfile.query.get(profile_id)
+    if not profile:
+        return jsonify({"error": "Profile not found"}), 404
+
+    name = (request.get_json(silent=True) or {}).get('name')
+    if name:
+        profile.name = name
+
+    if profile.user_id is not None and not profiles.promote(profile):
+        db.session.rollback()
+        return jsonify({"error": "A global profile already exists for this header"}), 409
+
+    db.session.commit()
+    return jsonify({"message": "Profile is now shared by all users", "id": profile.id}), 200
+
+@admin_bp.route('/column-profiles/<int:profile_id>', methods=['DELETE'])
+@jwt_required()
+def delete_column_profile(profile_id):
+    current_user = User.query.get(get_jwt_identity())
+
+    if not current_user or not current_user.is_admin:
+        return jsonify({"error": "Admin access required"}), 403
+
+    profile = ColumnProfile.query.get(profile_id)
+    if not profile:
+        return jsonify({"error": "Profile not found"}), 404
+
+    profiles.forget(profile)
+    db.session.delete(profile)
+    db.session.commit()
+    return jsonify({"message": "Profile deleted"}), 200
+
+@admin_bp.route('/rules', methods=['GET'])
+@jwt_required()
+def get_global_rules():
+    current_user = User.query.get(get_jwt_identity())
+
+    if not current_user or not current_user.is_admin:
+        return jsonify({"error": "Admin access required"}), 403
+
+    global_rules = CategoryRule.query.filter(CategoryRule.user_id.is_(None)).order_by(CategoryRule.priority, CategoryRule.id).all()
+    return jsonify({
+        "rules": [rules.serialize_rule(r) for r in global_rules],
+        "reclassification": rules.reclassify_status(all_users=True)
+    }), 200
+
+@admin_bp.route('/rules', methods=['POST'])
+@jwt_required()
+def create_global_rule():
+    current_user = User.query.get(get_jwt_identity())
+
+    if not current_user or not current_user.is_admin:
+        return jsonify({"error": "Admin access required"}), 403
+
+    data = request.get_json(silent=True) or {}
+    error = rules.validate(data)
+    if error:
+        return jsonify({"error": error}), 400
+
+    rule = CategoryRule(user_id=None)
+    rules.update_rule(rule, data)
+    db.session.add(rule)
+    db.session.commit()
+    return jsonify(rules.serialize_rule(rule)), 201
+
+@admin_bp.route('/rules/<int:rule_id>', methods=['PUT', 'DELETE'])
+@jwt_required()
+def edit_global_rule(rule_id):
+    current_user = User.query.get(get_jwt_identity())
+
+    if not current_user or not current_user.is_admin:
+        return jsonify({"error": "Admin access required"}), 403
+
+    rule = CategoryRule.query.get(rule_id)
+    if not rule or rule.user_id is not None:
+        return jsonify({"error": "Rule not found"}), 404
+
+    if request.method == 'DELETE':
+        db.session.delete(rule)
+        db.session.commit()
+        return jsonify({"message": "Rule deleted"}), 200
+
+    data = request.get_json(silent=True) or {}
+    error = rules.validate(data)
+    if error:
+        return jsonify({"error": error}), 400
+    rules.update_rule(rule, data)
+    db.session.commit()
+    return jsonify(rules.serialize_rule(rule)), 200
+
+@admin_bp.route('/rules/apply', methods=['POST'])
+@jwt_required()
+def apply_global_rules():
+    """
+    Re-classifies every user's transactions in the background, after the
+    global rules changed.
+    """
+    current_user = User.query.get(get_jwt_identity())
+
+    if not current_user or not current_user.is_admin:
+        return jsonify({"error": "Admin access required"}), 403
+
+    if not rules.start_reclassify(current_app._get_current_object(), all_users=True):
+        return jsonify({"error": "A re-classification is already running."}), 409
+    return jsonify({"message": "Re-classification started."}), 202
+
+@admin_bp.route('/cache', methods=['GET', 'DELETE'])
+@jwt_required()
+def result_cache():
+    """
+    Hit ratio and size of the dashboard result cache (counters are those of
+    the process serving the request). DELETE empties it.
+    """
+    current_user = User.query.get(get_jwt_identity())
+
+    if not current_user or not current_user.is_admin:
+        return jsonify({"error": "Admin access required"}), 403
+
+    result_cache = cache.current()
+    if result_cache is None:
+        return jsonify({"backend": "none"}), 200
+    if request.method == 'DELETE':
+        result_cache.backend.clear()
+        return jsonify({"message": "Result cache cleared"}), 200
+    return jsonify(result_cache.stats()), 200
@@ -13,7 +13,7 @@ load_dotenv()
 
 def create_app():
     app = Flask(__name__)
-    CORS(app, resources={r"/api/*": {"origins": "*"}}, allow_headers=["Content-Type", "Authorization"], methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"])
+    CORS(app, resources={r"/api/*": {"origins": "*"}}, allow_headers=["Content-Type", "Authorization", "If-None-Match"], expose_headers=["ETag"], methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"])
 
     # Configuration
     app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///financial_dashboard.db')
@@ -34,6 +34,24 @@ def create_app():
     app.config['STRIPE_WEBHOOK_SECRET'] = os.environ.get('STRIPE_WEBHOOK_SECRET', 'whsec_placeholder')
     app.config['STRIPE_PRICE_ID'] = os.environ.get('STRIPE_PRICE_ID', 'price_placeholder') # 39€/month price ID
 
+    # Background ingestion (services/jobs.py)
+    app.config['INGESTION_WORKERS'] = int(os.environ.get('INGESTION_WORKERS', 0)) # Threads per app instance, 0 = enqueue only (scripts, worker.py)
+    app.config['INGESTION_POLL_INTERVAL'] = float(os.environ.get('INGESTION_POLL_INTERVAL', 5)) # Seconds between idle polls
+    app.config['INGESTION_STALE_SECONDS'] = int(os.environ.get('INGESTION_STALE_SECONDS', 600)) # 'processing' without progress => re-queued
+    app.config['INGESTION_MAX_ATTEMPTS'] = int(os.environ.get('INGESTION_MAX_ATTEMPTS', 3))
+    app.config['PROGRESS_POLL_INTERVAL'] = float(os.environ.get('PROGRESS_POLL_INTERVAL', 1)) # Progress stream re-reads when the worker is in another process
+    app.config['PROGRESS_STREAM_SECONDS'] = int(os.environ.get('PROGRESS_STREAM_SECONDS', 120)) # A stream then closes and the client reconnects
+
+    # Result cache of the dashboard services (services/cache.py): 'memory' (per process), 'redis' (shared) or 'none'
+    app.config['RESULT_CACHE_BACKEND'] = os.environ.get('RESULT_CACHE_BACKEND', 'memory')
+    app.config['RESULT_CACHE_MAX_ENTRIES'] = int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', 2048))
+    app.config['RESULT_CACHE_MAX_BYTES'] = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+    app.config['RESULT_CACHE_REDIS_URL'] = os.environ.get('RESULT_CACHE_REDIS_URL', 'redis://localhost:6379/0')
+    app.config['RESULT_CACHE_TTL'] = int(os.environ.get('RESULT_CACHE_TTL', 86400)) # Redis only, stale versions are never read anyway
+
+    # Schema migrations (migrations/) applied at startup, off by default: deployments run migrate.py first
+    app.config['AUTO_MIGRATE'] = os.environ.get('AUTO_MIGRATE', 'false').lower() in ['true', 'on', '1']
+
     db.init_app(app)
     jwt = JWTManager(app)
     
@@ -62,10 +80,20 @@ def create_app():
         return "OK", 200
 
     with app.app_context():
-        db.create_all()
+        import migrations
+        with migrations.lock(db.engine): # Processes starting together create the tables once
+            db.create_all()
+        if app.config['AUTO_MIGRATE']:
+            migrations.upgrade(db.engine)
+
+    from services import jobs, cache
+    cache.init_app(app)
+    jobs.init_app(app)
 
     return app
 
 if __name__ == '__main__':
+    os.environ.setdefault('INGESTION_WORKERS', '2') # The server processes uploads itself unless told otherwise
+    os.environ.setdefault('AUTO_MIGRATE', '1') # The development server keeps its own database up to date
     app = create_app()
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,134 @@
+"""
+Ingestion benchmark: row-by-row (legacy iterrows loop) vs column-wise normalization.
+
+Usage: python benchmark_ingestion.py [rows ...]
+       python benchmark_ingestion.py --rss [rows ...]   # peak RSS of a full process_file run
+"""
+import os
+import sys
+import random
+import resource
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from services.ingestion import (
+    read_file, normalize_columns, normalize_frame,
+    parse_date, parse_amount, determine_type, auto_categorize
+)
+
+DESCRIPTIONS = [
+    'Facture Vente de services', 'Paiement Loyer', 'CB Carrefour Market', 'Virement Salaire',
+    'Prélèvement EDF', 'Vente Baguette', 'Uber Trip', 'Netflix', 'Consulting', 'Pharmacie du centre'
+]
+
+def write_sample_csv(path, rows, seed=42):
+    """
+    Writes a semicolon separated statement with French formatted amounts.
+    """
+    rng = random.Random(seed)
+    start = datetime(2020, 1, 1)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('Date;Libellé;Montant;Tiers;Devise\n')
+        for _ in range(rows):
+            day = start + timedelta(days=rng.randint(0, 4 * 365))
+            amount = round(rng.uniform(-3000, 5000), 2)
+            amount_str = f"{amount:,.2f}".replace(',', ' ').replace('.', ',') + ' €'
+            f.write(f"{day.strftime('%d/%m/%Y')};{rng.choice(DESCRIPTIONS)};{amount_str};Client {rng.randint(1, 50)};EUR\n")
+
+def legacy_normalize(df, cols):
+    """
+    The original per-row loop of process_file, kept as the reference implementation.
+    """
+    rows = []
+    for _, row in df.iterrows():
+        date_obj = parse_date(row[cols['date']])
+        if date_obj is None:
+            continue
+        amount = parse_amount(row, cols)
+        if amount == 0:
+            continue
+        description = str(row.get(cols.get('description'), '')).strip()
+        type_val, corrected_amount = determine_type(amount, description)
+        third_party = row.get(cols.get('third_party'), '')
+        if 'category' in cols:
+            category = str(row.get(cols['category'], '')).strip()
+            if not category or category.lower() == 'nan':
+                category = auto_categorize(description)
+        else:
+            category = auto_categorize(description)
+        rows.append((date_obj, description, float(corrected_amount), type_val, category, str(third_party).strip()))
+    return rows
+
+def vectorized_normalize(df, cols):
+    normalized = normalize_frame(df, cols)
+    return list(zip(
+        normalized['date'], normalized['description'], normalized['amount'].tolist(),
+        normalized['type'], normalized['category'], normalized['third_party']
+    ))
+
+def run(rows):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'statement.csv')
+        write_sample_csv(path, rows)
+        df = read_file(path)
+        cols = normalize_columns(df)
+
+        start = time.perf_counter()
+        before = legacy_normalize(df, cols)
+        legacy_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        after = vectorized_normalize(df, cols)
+        vectorized_time = time.perf_counter() - start
+
+    identical = before == after
+    print(f"{rows:>9} rows | legacy {rows / legacy_time:>12,.0f} rows/s | "
+          f"vectorized {rows / vectorized_time:>12,.0f} rows/s | "
+          f"x{legacy_time / vectorized_time:.1f} | identical={identical}")
+    return identical
+
+def ingest(rows):
+    """
+    Runs process_file end to end against a throwaway SQLite database.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'statement.csv')
+        write_sample_csv(path, rows)
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tmp, 'bench.db')
+
+        from app import create_app
+        from models import db, Upload
+        from services.ingestion import process_file
+
+        app = create_app()
+        with app.app_context():
+            upload = Upload(filename='statement.csv', status='processing')
+            db.session.add(upload)
+            db.session.commit()
+
+            start = time.perf_counter()
+            count = process_file(path, upload.id)
+            elapsed = time.perf_counter() - start
+
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{rows:>9} rows | {count} inserted | {rows / elapsed:>10,.0f} rows/s | peak RSS {peak_mb:,.0f} MB")
+
+def measure_rss(rows):
+    # One interpreter per size: ru_maxrss never goes down
+    subprocess.run([sys.executable, __file__, '--ingest', str(rows)], check=True)
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args and args[0] == '--ingest':
+        ingest(int(args[1]))
+    elif args and args[0] == '--rss':
+        for n in [int(a) for a in args[1:]] or [10000, 100000, 500000]:
+            measure_rss(n)
+    else:
+        sizes = [int(a) for a in args] or [1000, 10000, 100000]
+        ok = all([run(n) for n in sizes])
+        sys.exit(0 if ok else 1)
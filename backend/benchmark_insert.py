@@ -0,0 +1,72 @@
+"""
+Insert throughput: ORM bulk_save_objects (previous path) vs insert_transactions
+(COPY on PostgreSQL, executemany on SQLite), chunked like process_file.
+
+Usage: DATABASE_URL=... python benchmark_insert.py [rows ...]
+       (defaults to a throwaway SQLite file and 10k, 100k, 1M rows)
+"""
+import os
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+
+if 'DATABASE_URL' not in os.environ:
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+from app import create_app
+from models import db, Upload, Transaction
+from services.ingestion import insert_transactions, CHUNK_SIZE
+
+def make_frame(rows, seed=42):
+    rng = np.random.default_rng(seed)
+    start = date(2020, 1, 1)
+    days = rng.integers(0, 4 * 365, rows)
+    amounts = np.round(rng.uniform(-3000, 5000, rows), 2)
+    return pd.DataFrame({
+        'date': [start + timedelta(days=int(d)) for d in days],
+        'description': rng.choice(['Facture client', 'Paiement Loyer', 'CB Carrefour', 'Virement'], rows).astype(object),
+        'amount': amounts,
+        'type': np.where(amounts < 0, 'PURCHASE', 'SALE').astype(object),
+        'category': rng.choice(['Logement', 'Alimentation', 'Autre'], rows).astype(object),
+        'third_party': rng.choice(['Client A', 'Client B', ''], rows).astype(object)
+    })
+
+def orm_insert(normalized, upload_id):
+    db.session.bulk_save_objects([
+        Transaction(date=r.date, description=r.description, amount=r.amount, type=r.type,
+                    category=r.category, third_party=r.third_party, source_file_id=upload_id)
+        for r in normalized.itertuples()
+    ])
+    return len(normalized)
+
+def timed(insert, frame, upload_id):
+    start = time.perf_counter()
+    for offset in range(0, len(frame), CHUNK_SIZE):
+        insert(frame.iloc[offset:offset + CHUNK_SIZE], upload_id)
+        db.session.commit()
+    return time.perf_counter() - start
+
+def run(app, rows):
+    frame = make_frame(rows)
+    with app.app_context():
+        results = {}
+        for name, insert in [('orm', orm_insert), ('native', insert_transactions)]:
+            upload = Upload(filename=f'bench-{name}-{rows}', status='completed')
+            db.session.add(upload)
+            db.session.commit()
+            results[name] = timed(insert, frame, upload.id)
+            Transaction.query.filter_by(source_file_id=upload.id).delete()
+            db.session.delete(upload)
+            db.session.commit()
+
+        print(f"{db.engine.name:>10} | {rows:>9} rows | ORM {rows / results['orm']:>10,.0f} rows/s | "
+              f"native {rows / results['native']:>10,.0f} rows/s | x{results['orm'] / results['native']:.1f}")
+
+if __name__ == "__main__":
+    app = create_app()
+    for n in [int(a) for a in sys.argv[1:]] or [10000, 100000, 1000000]:
+        run(app, n)
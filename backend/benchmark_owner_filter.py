@@ -0,0 +1,162 @@
+"""
+Before/after benchmark of the user filter on transactions: the former
+`source_file_id IN (SELECT id FROM uploads WHERE user_id = ?)` semi-join
+without owner indexes, against `transactions.user_id = ?` with the
+(user_id, date) and (user_id, type, date) indexes.
+
+Seeds an EMPTY database with set-based INSERT ... SELECT (generate_series on
+PostgreSQL, a recursive CTE on SQLite), then prints the query plan and the
+median latency of the user-scoped queries the services run.
+
+Usage: DATABASE_URL=... python benchmark_owner_filter.py [--rows N] [--users U]
+                                                         [--uploads-per-user K] [--repeat R]
+       (default: 10M rows in a throwaway SQLite file)
+"""
+import os
+import time
+import argparse
+import statistics
+import tempfile
+from datetime import date
+
+OWNER_INDEXES = ['ix_transactions_user_date', 'ix_transactions_user_type_date']
+BATCH = 1000000
+
+def seed(db, rows, users, uploads_per_user):
+    from models import User, Upload
+
+    for i in range(users):
+        db.session.add(User(username=f'owner{i}', email=f'owner{i}@example.com', password_hash='-'))
+    db.session.flush()
+    user_ids = [u.id for u in User.query.order_by(User.id)]
+    for user_id in user_ids:
+        for k in range(uploads_per_user):
+            db.session.add(Upload(filename=f'owner{user_id}-{k}.csv', user_id=user_id, status='completed'))
+    db.session.commit()
+    upload_ids = [u.id for u in Upload.query.order_by(Upload.id)]
+    assert upload_ids == list(range(upload_ids[0], upload_ids[0] + len(upload_ids))), "ids must be contiguous"
+    assert user_ids == list(range(user_ids[0], user_ids[0] + len(user_ids))), "ids must be contiguous"
+
+    # Row x: upload x % uploads, ten years of dates, pseudo-random amounts, 2/3 expenses
+    uploads = len(upload_ids)
+    columns = """
+        {day} AS date, 'Transaction ' || x AS description, amount,
+        CASE WHEN amount < 0 THEN 'PURCHASE' ELSE 'SALE' END AS type,
+        CASE x % 6 WHEN 0 THEN 'Loyer' WHEN 1 THEN 'Salaires' WHEN 2 THEN 'Achats'
+                   WHEN 3 THEN 'Energie' WHEN 4 THEN 'Ventes' ELSE 'Autre' END AS category,
+        '' AS third_party,
+        {first_upload} + x % {uploads} AS source_file_id,
+        {first_user} + (x % {uploads}) / {per_user} AS user_id,
+        CURRENT_TIMESTAMP AS created_at
+    """
+    insert = "INSERT INTO transactions (date, description, amount, type, category, third_party, source_file_id, user_id, created_at) "
+    dialect = db.engine.name
+    start = time.perf_counter()
+    for offset in range(0, rows, BATCH):
+        count = min(BATCH, rows - offset)
+        amount = "((x % 100003) * 7919 % 300001 - 200000) / 100.0 AS amount"
+        if dialect == 'postgresql':
+            day = "DATE '2016-01-01' + (x % 3650)::int"
+            prefix, source = '', f"SELECT x, {amount} FROM generate_series({offset}, {offset + count - 1}) AS x"
+        else:
+            day = "date('2016-01-01', '+' || (x % 3650) || ' days')"
+            prefix = f"WITH RECURSIVE g(x) AS (SELECT {offset} UNION ALL SELECT x + 1 FROM g WHERE x < {offset + count - 1}) "
+            source = f"SELECT x, {amount} FROM g"
+        select = "SELECT " + columns.format(day=day, first_upload=upload_ids[0], uploads=uploads,
+                                            first_user=user_ids[0], per_user=uploads_per_user)
+        db.session.execute(db.text(f"{prefix}{insert}{select} FROM ({source}) AS s"))
+        db.session.commit()
+        print(f"  seeded {offset + count:,} rows ({time.perf_counter() - start:.0f}s)")
+    return user_ids
+
+def queries(owner):
+    from models import db, Transaction
+
+    year_start, year_end = date(2024, 1, 1), date(2025, 1, 1)
+    return {
+        'range_totals': db.select(Transaction.type, db.func.sum(Transaction.amount)).where(
+            owner, Transaction.date >= date(2024, 10, 1), Transaction.date <= date(2024, 10, 18)
+        ).group_by(Transaction.type),
+        'daily_cash_flow': db.select(Transaction.date, db.func.sum(Transaction.amount)).where(
+            owner, Transaction.date >= year_start, Transaction.date < year_end
+        ).group_by(Transaction.date),
+        'month_details': db.select(Transaction.date, Transaction.description, Transaction.category, Transaction.amount).where(
+            owner, Transaction.date >= date(2024, 6, 1), Transaction.date < date(2024, 7, 1), Transaction.type == 'PURCHASE'
+        ).order_by(Transaction.date.desc()),
+        'largest_expense': db.select(Transaction.amount, Transaction.description, Transaction.date).where(
+            owner, Transaction.type == 'PURCHASE'
+        ).order_by(Transaction.amount.asc()).limit(1)
+    }
+
+def explain(db, stmt):
+    connection = db.session.connection()
+    compiled = stmt.compile(dialect=connection.dialect)
+    params = compiled.construct_params()
+    if compiled.positiontup:
+        params = tuple(params[k] for k in compiled.positiontup)
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.dialect.name == 'sqlite' else 'EXPLAIN (ANALYZE, BUFFERS) '
+    return [str(row[-1]) for row in connection.exec_driver_sql(prefix + str(compiled), params)]
+
+def measure(db, owner, repeat):
+    results = {}
+    for name, stmt in queries(owner).items():
+        plan = explain(db, stmt)
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            db.session.execute(stmt).all()
+            timings.append(time.perf_counter() - start)
+        results[name] = round(statistics.median(timings) * 1000, 2)
+        print(f"\n  {name}: {results[name]} ms median")
+        for line in plan:
+            print(f"    {line}")
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the transactions.user_id filter against the uploads semi-join.")
+    parser.add_argument('--rows', type=int, default=10000000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--uploads-per-user', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    if not os.environ.get('DATABASE_URL'):
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='bench-'), 'owner.db')
+
+    from app import create_app
+    from models import db, Transaction, Upload
+
+    app = create_app()
+    with app.app_context():
+        if db.session.query(Transaction.id).first() is not None:
+            raise SystemExit("Use an empty database: this benchmark seeds its own data.")
+        # Before: the semi-join, no owner index (seeding is faster without them too)
+        for name in OWNER_INDEXES:
+            db.session.execute(db.text(f"DROP INDEX IF EXISTS {name}"))
+        db.session.commit()
+        print(f"Seeding {args.rows:,} transactions for {args.users} users on {db.engine.name}...")
+        user_ids = seed(db, args.rows, args.users, args.uploads_per_user)
+        user_id = user_ids[len(user_ids) // 2]
+
+        db.session.execute(db.text("ANALYZE"))
+        db.session.commit()
+        print("\n=== Before: source_file_id IN (uploads of the user) ===")
+        before = measure(db, Transaction.source_file_id.in_(db.select(Upload.id).where(Upload.user_id == user_id)), args.repeat)
+
+        start = time.perf_counter()
+        for index in Transaction.__table__.indexes:
+            if index.name in OWNER_INDEXES:
+                index.create(db.engine)
+        db.session.execute(db.text("ANALYZE"))
+        db.session.commit()
+        print(f"\nOwner indexes built in {time.perf_counter() - start:.1f}s")
+
+        print("\n=== After: user_id = ? with (user_id, date) / (user_id, type, date) ===")
+        after = measure(db, Transaction.user_id == user_id, args.repeat)
+
+    print("\n--- Median latency (ms) ---")
+    for name in before:
+        print(f"{name:>16}: {before[name]:>10} -> {after[name]:>8}  x{before[name] / after[name]:.0f}" if after[name] else name)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""
+Benchmark suite: process_file on a synthetic dataset (see synthetic_data.py),
+then the dashboard KPI services on the resulting database.
+
+Records rows/s, peak RSS and SQL query counts in a JSON file so runs can be
+compared across commits. Each stage runs in a fresh process, so its peak RSS
+is its own. Query counts are statements sent through SQLAlchemy (a COPY
+issued on the raw connection is not counted).
+
+Usage: python benchmark_suite.py [--users N] [--transactions M] [--years Y]
+                                 [--variants montant,xlsx,...] [--seed S]
+                                 [--kpi-users K] [--repeat R] [--data-dir DIR]
+                                 [--output benchmark_results.json]
+                                 [--compare previous.json]
+       DATABASE_URL=... to run against PostgreSQL (default: throwaway SQLite)
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import statistics
+import subprocess
+import tempfile
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+os.environ['RESULT_CACHE_BACKEND'] = 'none' # Measure the computations, not the cache
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1) # Bytes on macOS, KB on Linux
+
+class QueryCounter:
+    """
+    Counts statements executed on an engine while installed.
+    """
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.engine = engine
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+    def close(self):
+        from sqlalchemy import event
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+
+def ingest_files(database_url, files):
+    """
+    Runs in a child process: process_file on each (path, user_id, rows).
+    """
+    os.environ['DATABASE_URL'] = database_url
+    from app import create_app
+    from models import db, Upload
+    from services.ingestion import process_file
+
+    app = create_app()
+    results = []
+    with app.app_context():
+        counter = QueryCounter(db.engine)
+        for path, user_id, rows in files:
+            upload = Upload(filename=os.path.basename(path), status='processing', user_id=user_id)
+            db.session.add(upload)
+            db.session.commit()
+
+            counter.count = 0
+            start = time.perf_counter()
+            inserted = process_file(path, upload.id)
+            seconds = time.perf_counter() - start
+            results.append({
+                'file': os.path.basename(path),
+                'rows': rows,
+                'inserted': inserted,
+                'seconds': round(seconds, 4),
+                'queries': counter.count
+            })
+        counter.close()
+    return {'files': results, 'peak_rss_mb': peak_rss_mb()}
+
+def kpi_calls():
+    from services.kpi import (
+        get_dashboard_stats, get_cash_flow_history, get_monthly_breakdown, get_annual_breakdown,
+        get_top_expenses, get_top_income, get_advanced_kpis
+    )
+    from services.forecast import generate_forecast
+    from services.analysis import generate_analysis
+
+    return {
+        'dashboard_stats': lambda u: get_dashboard_stats(user_id=u),
+        'cash_flow_month': lambda u: get_cash_flow_history(user_id=u),
+        'cash_flow_day': lambda u: get_cash_flow_history(granularity='day', user_id=u),
+        'monthly_breakdown': lambda u: get_monthly_breakdown(user_id=u),
+        'annual_breakdown': lambda u: get_annual_breakdown(user_id=u),
+        'top_expenses': lambda u: get_top_expenses(user_id=u),
+        'top_income': lambda u: get_top_income(user_id=u),
+        'advanced_kpis': lambda u: get_advanced_kpis(user_id=u),
+        'forecast': lambda u: generate_forecast(user_id=u),
+        'analysis': lambda u: generate_analysis(user_id=u)
+    }
+
+def run_kpis(database_url, user_ids, repeat):
+    """
+    Runs in a child process: each KPI service `repeat` times per user.
+    Reports the median call time and the queries per call.
+    """
+    os.environ['DATABASE_URL'] = database_url
+    from app import create_app
+    from models import db
+
+    app = create_app()
+    results = {}
+    with app.app_context():
+        counter = QueryCounter(db.engine)
+        for name, call in kpi_calls().items():
+            timings = []
+            counter.count = 0
+            for _ in range(repeat):
+                for user_id in user_ids:
+                    start = time.perf_counter()
+                    call(user_id)
+                    timings.append(time.perf_counter() - start)
+                    db.session.rollback() # Drop the identity map between calls
+            calls = repeat * len(user_ids)
+            results[name] = {
+                'median_ms': round(statistics.median(timings) * 1000, 3),
+                'max_ms': round(max(timings) * 1000, 3),
+                'queries_per_call': round(counter.count / calls, 2)
+            }
+        counter.close()
+    return {'services': results, 'peak_rss_mb': peak_rss_mb()}
+
+def in_child(fn, *args):
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(fn, *args).result()
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True, stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return None
+
+def run(args):
+    from synthetic_data import generate_dataset
+
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    database_url = os.environ.get('DATABASE_URL') or 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    data_dir = args.data_dir or os.path.join(workdir, 'data')
+    variants = [v.strip() for v in args.variants.split(',') if v.strip()]
+
+    start = time.perf_counter()
+    manifest = generate_dataset(data_dir, args.users, args.transactions, args.years, variants, args.seed)
+    print(f"Dataset: {len(manifest)} file(s), {sum(m['rows'] for m in manifest)} rows in {time.perf_counter() - start:.1f}s")
+
+    # Users are created up front, one per synthetic user
+    os.environ['DATABASE_URL'] = database_url
+    from app import create_app
+    from models import db, User
+
+    app = create_app()
+    with app.app_context():
+        dialect = db.engine.name
+        users = []
+        for i in range(args.users):
+            user = User(username=f'bench{i}-{args.seed}', email=f'bench{i}-{args.seed}@example.com',
+                        password_hash='-', subscription_status='active')
+            db.session.add(user)
+            users.append(user)
+        db.session.commit()
+        user_ids = [u.id for u in users]
+
+    ingestion = {}
+    for variant in variants:
+        files = [(os.path.join(data_dir, m['file']), user_ids[m['user']], m['rows']) for m in manifest if m['variant'] == variant]
+        if not files:
+            continue
+        result = in_child(ingest_files, database_url, files)
+        rows = sum(f['rows'] for f in result['files'])
+        seconds = sum(f['seconds'] for f in result['files'])
+        ingestion[variant] = {
+            'files': len(files),
+            'rows': rows,
+            'seconds': round(seconds, 3),
+            'rows_per_sec': round(rows / seconds) if seconds else None,
+            'queries_per_file': round(sum(f['queries'] for f in result['files']) / len(files), 1),
+            'peak_rss_mb': result['peak_rss_mb'],
+            'per_file': result['files']
+        }
+        print(f"ingest {variant:>13}: {rows:>9} rows {ingestion[variant]['rows_per_sec']:>9,} rows/s "
+              f"{ingestion[variant]['queries_per_file']:>7} queries/file  peak {result['peak_rss_mb']} MB")
+
+    kpi = in_child(run_kpis, database_url, user_ids[:args.kpi_users], args.repeat)
+    for name, r in kpi['services'].items():
+        print(f"kpi {name:>18}: {r['median_ms']:>9.2f} ms median  {r['queries_per_call']:>5} queries/call")
+    print(f"kpi peak {kpi['peak_rss_mb']} MB")
+
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'dialect': dialect,
+            'python': platform.python_version(),
+            'params': {
+                'users': args.users, 'transactions': args.transactions, 'years': args.years,
+                'variants': variants, 'seed': args.seed, 'kpi_users': args.kpi_users, 'repeat': args.repeat
+            },
+            'rows_per_user': sum(m['rows'] for m in manifest) // max(args.users, 1)
+        },
+        'ingestion': ingestion,
+        'kpi': kpi
+    }
+
+def compare(current, previous):
+    """
+    Prints current vs previous figures, as produced by run().
+    """
+    def change(new, old, higher_is_better):
+        if not old or new is None:
+            return '    n/a'
+        pct = (new - old) / old * 100
+        worse = pct < 0 if higher_is_better else pct > 0
+        return f"{pct:+6.1f}%{' !' if worse and abs(pct) > 10 else ''}"
+
+    print(f"\n--- vs {previous['meta'].get('commit')} ({previous['meta'].get('date')}) ---")
+    for variant, r in current['ingestion'].items():
+        old = previous['ingestion'].get(variant, {})
+        print(f"ingest {variant:>13}: rows/s {change(r['rows_per_sec'], old.get('rows_per_sec'), True)}  "
+              f"peak RSS {change(r['peak_rss_mb'], old.get('peak_rss_mb'), False)}  "
+              f"queries {change(r['queries_per_file'], old.get('queries_per_file'), False)}")
+    for name, r in current['kpi']['services'].items():
+        old = previous['kpi']['services'].get(name, {})
+        print(f"kpi {name:>18}: time {change(r['median_ms'], old.get('median_ms'), False)}  "
+              f"queries {change(r['queries_per_call'], old.get('queries_per_call'), False)}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ingestion and KPI benchmark on synthetic data.")
+    parser.add_argument('--users', type=int, default=4)
+    parser.add_argument('--transactions', type=int, default=5000, help="Transactions per user and year")
+    parser.add_argument('--years', type=int, default=2)
+    parser.add_argument('--variants', default='montant,debit_credit,excel_serial,xlsx')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--kpi-users', type=int, default=3, help="Users the KPI services are timed for")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--data-dir', default=None, help="Where to write the dataset (default: temporary)")
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', default=None, help="Previous results file to compare with")
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+"""
+Applies the pending schema migrations (see migrations/) to DATABASE_URL, or
+lists them. Deployments run it before starting the new version; the app
+only applies them at startup with AUTO_MIGRATE=1 (the default of python app.py).
+
+Usage: python migrate.py [--status] [--to VERSION]
+"""
+import os
+import argparse
+
+os.environ['AUTO_MIGRATE'] = '0' # Applied below, with a report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply or list the schema migrations.")
+    parser.add_argument('--status', action='store_true', help="List the migrations and whether they are applied")
+    parser.add_argument('--to', default=None, help="Stop after this version (e.g. 0002)")
+    args = parser.parse_args(argv)
+
+    from app import create_app
+    from models import db
+    import migrations
+
+    app = create_app()
+    with app.app_context():
+        print(f"Database: {db.engine.url.render_as_string(hide_password=True)}")
+        if args.status:
+            for version, name, applied in migrations.status(db.engine):
+                print(f"{version} {name:<40} {'applied' if applied else 'pending'}")
+            return
+        done = migrations.upgrade(db.engine, target=args.to)
+    print(f"{len(done)} migration(s) applied." if done else "Database is up to date.")
+
+if __name__ == "__main__":
+    main()
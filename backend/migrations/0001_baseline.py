@@ -0,0 +1,49 @@
+"""
+Everything the former migrate_db.py script did: columns added to existing
+tables since the first release, their backfills and indexes.
+"""
+from sqlalchemy import text
+from migrations import add_column, create_index, table_names
+
+def upgrade(connection):
+    # Freemium / subscription
+    add_column(connection, 'users', 'subscription_status', "VARCHAR(20) DEFAULT 'free'")
+    add_column(connection, 'users', 'stripe_customer_id', "VARCHAR(100)")
+    add_column(connection, 'users', 'stripe_subscription_id', "VARCHAR(100)")
+
+    # Content-addressed storage, appends and background ingestion progress
+    for name, ddl in [
+        ('rows_total', "INTEGER"),
+        ('rows_processed', "INTEGER DEFAULT 0"),
+        ('rows_skipped', "INTEGER DEFAULT 0"),
+        ('attempts', "INTEGER DEFAULT 0"),
+        ('heartbeat_at', "TIMESTAMP"),
+        ('content_hash', "VARCHAR(64)"),
+        ('sheet', "VARCHAR(100)"),
+        ('append_to_id', "INTEGER REFERENCES uploads(id)"),
+        ('last_transaction_date', "DATE"),
+        ('started_at', "TIMESTAMP"),
+        ('stage', "VARCHAR(20)"),
+        ('rows_inserted', "INTEGER DEFAULT 0"),
+    ]:
+        add_column(connection, 'uploads', name, ddl)
+    create_index(connection, 'ix_uploads_content_hash', 'uploads', ['content_hash'])
+
+    # Rule that classified a transaction
+    add_column(connection, 'transactions', 'rule_id', "INTEGER")
+
+    # Budgets are owned by a user, one line per (user, period, category)
+    if 'budgets' in table_names(connection):
+        add_column(connection, 'budgets', 'user_id', "INTEGER REFERENCES users(id)")
+        create_index(connection, 'uq_budgets_user_period_category', 'budgets', ['user_id', 'period', 'category'], unique=True)
+
+    # Owner copied from the upload, for user-scoped queries without a join
+    add_column(connection, 'transactions', 'user_id', "INTEGER REFERENCES users(id)")
+    result = connection.execute(text(
+        "UPDATE transactions SET user_id = (SELECT uploads.user_id FROM uploads WHERE uploads.id = transactions.source_file_id) "
+        "WHERE user_id IS NULL AND source_file_id IN (SELECT id FROM uploads WHERE user_id IS NOT NULL)"
+    ))
+    if result.rowcount:
+        print(f"  owner set on {result.rowcount} transaction(s)")
+    create_index(connection, 'ix_transactions_user_date', 'transactions', ['user_id', 'date'])
+    create_index(connection, 'ix_transactions_user_type_date', 'transactions', ['user_id', 'type', 'date'])
@@ -0,0 +1,18 @@
+"""
+Fills monthly_rollups (see services/rollups.py) for the uploads whose
+transactions predate it, in one INSERT ... SELECT.
+"""
+from sqlalchemy import text
+
+def upgrade(connection):
+    month = "strftime('%Y-%m', t.date)" if connection.dialect.name == 'sqlite' else "to_char(t.date, 'YYYY-MM')"
+    result = connection.execute(text(f"""
+        INSERT INTO monthly_rollups (user_id, upload_id, month, type, category, total, count, min_amount, max_amount)
+        SELECT u.user_id, t.source_file_id, {month}, COALESCE(t.type, ''), COALESCE(t.category, ''),
+               SUM(t.amount), COUNT(*), MIN(t.amount), MAX(t.amount)
+        FROM transactions t JOIN uploads u ON u.id = t.source_file_id
+        WHERE t.source_file_id NOT IN (SELECT DISTINCT upload_id FROM monthly_rollups)
+        GROUP BY u.user_id, t.source_file_id, {month}, COALESCE(t.type, ''), COALESCE(t.category, '')
+    """))
+    if result.rowcount:
+        print(f"  {result.rowcount} rollup row(s) built")
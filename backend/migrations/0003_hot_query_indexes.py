@@ -0,0 +1,22 @@
+"""
+Indexes for the dashboard queries (checked by tests/test_query_plans.py):
+
+- (user_id, date, type, amount) and (source_file_id, date, type, amount)
+  cover date-range sums per type and per day of a user or an upload without
+  reading the table; the second also serves deletes and rollup refreshes of
+  an upload. The first replaces (user_id, date).
+- Partial (user_id, amount) indexes on purchases and on sales answer the
+  largest expense / income lookups with the first index entry.
+- (user_id, month) on monthly_rollups, for the month-range reads of a user;
+  it replaces (user_id).
+"""
+from migrations import create_index, drop_index
+
+def upgrade(connection):
+    create_index(connection, 'ix_transactions_user_date_type_amount', 'transactions', ['user_id', 'date', 'type', 'amount'])
+    drop_index(connection, 'ix_transactions_user_date')
+    create_index(connection, 'ix_transactions_upload_date_type_amount', 'transactions', ['source_file_id', 'date', 'type', 'amount'])
+    create_index(connection, 'ix_transactions_user_purchase_amount', 'transactions', ['user_id', 'amount'], where="type = 'PURCHASE'")
+    create_index(connection, 'ix_transactions_user_sale_amount', 'transactions', ['user_id', 'amount'], where="type = 'SALE'")
+    create_index(connection, 'ix_monthly_rollups_user_month', 'monthly_rollups', ['user_id', 'month'])
+    drop_index(connection, 'ix_monthly_rollups_user_id')
@@ -0,0 +1,8 @@
+"""
+users.data_version, the version of a user's data keying the result cache
+(see services/cache.py).
+"""
+from migrations import add_column
+
+def upgrade(connection):
+    add_column(connection, 'users', 'data_version', "INTEGER NOT NULL DEFAULT 0")
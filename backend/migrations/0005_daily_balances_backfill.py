@@ -0,0 +1,40 @@
+"""
+Fills daily_balances (see services/balances.py) for the uploads whose
+transactions predate it, then the series of their owners, each in one
+INSERT ... SELECT with the running totals as window sums.
+"""
+from sqlalchemy import text
+
+COLUMNS = "user_id, upload_id, day, count, net, sales, purchases, balance, sales_to_date, purchases_to_date"
+RUNNING = """
+    SUM(net) OVER (PARTITION BY {key} ORDER BY day),
+    SUM(sales) OVER (PARTITION BY {key} ORDER BY day),
+    SUM(purchases) OVER (PARTITION BY {key} ORDER BY day)
+"""
+
+def upgrade(connection):
+    uploads = connection.execute(text(f"""
+        INSERT INTO daily_balances ({COLUMNS})
+        SELECT user_id, upload_id, day, count, net, sales, purchases, {RUNNING.format(key='upload_id')}
+        FROM (
+            SELECT u.user_id, t.source_file_id AS upload_id, t.date AS day, COUNT(*) AS count, SUM(t.amount) AS net,
+                   SUM(CASE WHEN t.type = 'SALE' THEN t.amount ELSE 0 END) AS sales,
+                   SUM(CASE WHEN t.type = 'PURCHASE' THEN t.amount ELSE 0 END) AS purchases
+            FROM transactions t JOIN uploads u ON u.id = t.source_file_id
+            WHERE t.source_file_id NOT IN (SELECT DISTINCT upload_id FROM daily_balances WHERE upload_id IS NOT NULL)
+            GROUP BY u.user_id, t.source_file_id, t.date
+        ) per_day
+    """))
+    users = connection.execute(text(f"""
+        INSERT INTO daily_balances ({COLUMNS})
+        SELECT user_id, NULL, day, count, net, sales, purchases, {RUNNING.format(key='user_id')}
+        FROM (
+            SELECT user_id, day, SUM(count) AS count, SUM(net) AS net, SUM(sales) AS sales, SUM(purchases) AS purchases
+            FROM daily_balances
+            WHERE upload_id IS NOT NULL AND user_id IS NOT NULL
+              AND user_id NOT IN (SELECT DISTINCT user_id FROM daily_balances WHERE upload_id IS NULL)
+            GROUP BY user_id, day
+        ) per_day
+    """))
+    if uploads.rowcount or users.rowcount:
+        print(f"  {uploads.rowcount} upload and {users.rowcount} user balance row(s) built")
@@ -0,0 +1,10 @@
+"""
+transactions.original_type and original_amount: the type and amount a row
+had before a category rule set its type (and the amount sign with it), so
+they come back when the rule stops matching (see services/rules.py).
+"""
+from migrations import add_column
+
+def upgrade(connection):
+    add_column(connection, 'transactions', 'original_type', "VARCHAR(20)")
+    add_column(connection, 'transactions', 'original_amount', "NUMERIC(15, 2)")
@@ -0,0 +1,125 @@
+"""
+Versioned schema migrations, for SQLite and PostgreSQL.
+
+Each module NNNN_name.py of this package is one step, applied in version
+order by upgrade(). A step defines upgrade(connection), written so it can run
+on any database: db.create_all() builds the current models on a new database,
+so the steps add what it cannot (new columns on existing tables, backfills)
+and skip what already exists. DDL is written out in the step itself, not
+taken from models.py, so a step keeps doing what it did when models change.
+
+Applied versions are recorded in the schema_migrations table.
+"""
+import os
+import re
+import importlib
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import text, inspect
+from sqlalchemy.exc import IntegrityError
+
+VERSION_TABLE = 'schema_migrations'
+LOCK_KEY = 7310452 # PostgreSQL advisory lock held while upgrading
+
+def discover():
+    """Returns [(version, name, module)] of the steps, in version order."""
+    steps = []
+    for filename in sorted(os.listdir(os.path.dirname(__file__))):
+        match = re.match(r'^(\d{4})_(\w+)\.py$', filename)
+        if match:
+            module = importlib.import_module(f'{__name__}.{filename[:-3]}')
+            steps.append((match.group(1), match.group(2), module))
+    return steps
+
+def _ensure_version_table(connection):
+    connection.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {VERSION_TABLE} ("
+        "version VARCHAR(4) PRIMARY KEY, name VARCHAR(100) NOT NULL, applied_at TIMESTAMP NOT NULL)"
+    ))
+
+def applied_versions(connection):
+    _ensure_version_table(connection)
+    return {row[0] for row in connection.execute(text(f"SELECT version FROM {VERSION_TABLE}"))}
+
+def status(engine):
+    """Returns [(version, name, applied)] for every step."""
+    with engine.begin() as connection:
+        applied = applied_versions(connection)
+    return [(version, name, version in applied) for version, name, _ in discover()]
+
+@contextmanager
+def lock(engine):
+    """
+    Serializes schema changes across processes (several app processes
+    starting at once): a PostgreSQL advisory lock, held on a connection of
+    its own. SQLite needs none.
+    """
+    if engine.dialect.name != 'postgresql':
+        yield
+        return
+    with engine.connect() as connection:
+        connection.execute(text("SELECT pg_advisory_lock(:key)"), {'key': LOCK_KEY})
+        connection.commit()
+        try:
+            yield
+        finally:
+            connection.execute(text("SELECT pg_advisory_unlock(:key)"), {'key': LOCK_KEY})
+            connection.commit()
+
+def upgrade(engine, target=None, verbose=True):
+    """
+    Applies the pending steps up to `target` (a version, default: all), each
+    in its own transaction, under lock(): concurrent callers wait for the
+    first one, then find nothing left to apply. A step SQLite partly applied
+    (its driver does not wrap DDL in the transaction) can simply run again.
+    Returns the versions applied.
+    """
+    done = []
+    with lock(engine), engine.connect() as connection:
+        applied = applied_versions(connection)
+        connection.commit()
+        for version, name, module in discover():
+            if version in applied or (target and version > target):
+                continue
+            if verbose:
+                print(f"Migration {version}_{name}...")
+            try:
+                with connection.begin():
+                    module.upgrade(connection)
+                    connection.execute(
+                        text(f"INSERT INTO {VERSION_TABLE} (version, name, applied_at) VALUES (:version, :name, :at)"),
+                        {'version': version, 'name': name, 'at': datetime.utcnow()}
+                    )
+            except IntegrityError:
+                if version not in applied_versions(connection):
+                    raise
+                connection.commit() # Another process recorded it meanwhile (SQLite)
+                continue
+            done.append(version)
+    return done
+
+# Helpers for the steps
+
+def table_names(connection):
+    return set(inspect(connection).get_table_names())
+
+def column_names(connection, table):
+    return {c['name'] for c in inspect(connection).get_columns(table)}
+
+def add_column(connection, table, name, ddl):
+    """ALTER TABLE ... ADD COLUMN unless the table already has it. Returns True if added."""
+    if table not in table_names(connection) or name in column_names(connection, table):
+        return False
+    print(f"  + {table}.{name}")
+    connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+    return True
+
+def create_index(connection, name, table, columns, unique=False, where=None):
+    """CREATE INDEX IF NOT EXISTS, optionally partial (`where`, same SQL on both dialects)."""
+    sql = f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"
+    if where:
+        sql += f" WHERE {where}"
+    connection.execute(text(sql))
+
+def drop_index(connection, name):
+    connection.execute(text(f"DROP INDEX IF EXISTS {name}"))
@@ -17,6 +17,9 @@ class User(db.Model):
     stripe_customer_id = db.Column(db.String(100), nullable=True)
     stripe_subscription_id = db.Column(db.String(100), nullable=True)
 
+    # Bumped whenever the user's transactions or budgets change (see services/cache.py)
+    data_version = db.Column(db.Integer, nullable=False, default=0)
+
 class Upload(db.Model):
     __tablename__ = 'uploads'
     id = db.Column(db.Integer, primary_key=True)
@@ -25,9 +28,71 @@ class Upload(db.Model):
     status = db.Column(db.String(50), default='pending') # pending, processing, completed, error
     error_message = db.Column(db.Text)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    content_hash = db.Column(db.String(64), index=True) # SHA-256 of the file, names the stored blob
+    sheet = db.Column(db.String(100), nullable=True) # Sheet of an .xlsx workbook, None = auto
+    append_to_id = db.Column(db.Integer, db.ForeignKey('uploads.id'), nullable=True) # Statement refresh of that upload
+    last_transaction_date = db.Column(db.Date, nullable=True) # High-water mark for appends
+
+    # Background ingestion progress (see services/jobs.py)
+    rows_total = db.Column(db.Integer, nullable=True) # Estimated from the file, None if unknown
+    rows_processed = db.Column(db.Integer, default=0)
+    rows_skipped = db.Column(db.Integer, default=0) # Invalid date or zero amount
+    attempts = db.Column(db.Integer, default=0)
+    heartbeat_at = db.Column(db.DateTime, nullable=True) # Last progress write by the worker
+    started_at = db.Column(db.DateTime, nullable=True) # Parsing start, for the ETA
+    stage = db.Column(db.String(20), nullable=True) # 'reading', 'inserting' while processing
+    rows_inserted = db.Column(db.Integer, default=0)
+
+class ColumnProfile(db.Model):
+    """
+    Column mapping of a known statement layout ("bank profile"), keyed by the
+    fingerprint of its header row. user_id None = shared by every user.
+    """
+    __tablename__ = 'column_profiles'
+    __table_args__ = (db.UniqueConstraint('fingerprint', 'user_id', name='uq_column_profiles_fingerprint_user'),)
+    id = db.Column(db.Integer, primary_key=True)
+    fingerprint = db.Column(db.String(40), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    name = db.Column(db.String(100))
+    columns = db.Column(db.Text) # JSON list of the normalized header names
+    mapping = db.Column(db.Text, nullable=False) # JSON {standard key: column name}
+    date_format = db.Column(db.String(30)) # DATE_FORMATS entry seen in the date column
+    hits = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class CategoryRule(db.Model):
+    """
+    Categorization rule of a user, or of every user when user_id is None.
+    Matches on `pattern` according to `kind`, optionally within an amount
+    range (absolute value), and sets the category and/or the type.
+    """
+    __tablename__ = 'category_rules'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True, index=True)
+    kind = db.Column(db.String(20), nullable=False) # 'keyword', 'regex', 'third_party', 'amount'
+    pattern = db.Column(db.String(255)) # Unused for 'amount'
+    amount_min = db.Column(db.Numeric(15, 2), nullable=True)
+    amount_max = db.Column(db.Numeric(15, 2), nullable=True)
+    category = db.Column(db.String(50), nullable=True)
+    type = db.Column(db.String(20), nullable=True) # 'SALE', 'PURCHASE', 'OTHER'
+    priority = db.Column(db.Integer, default=100) # Lower is tried first
+    active = db.Column(db.Boolean, default=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 class Transaction(db.Model):
     __tablename__ = 'transactions'
+    # Kept in step with migrations/ (see 0003_hot_query_indexes.py)
+    __table_args__ = (
+        db.Index('ix_transactions_user_date_type_amount', 'user_id', 'date', 'type', 'amount'),
+        db.Index('ix_transactions_user_type_date', 'user_id', 'type', 'date'),
+        db.Index('ix_transactions_upload_date_type_amount', 'source_file_id', 'date', 'type', 'amount'),
+        db.Index('ix_transactions_user_purchase_amount', 'user_id', 'amount',
+                 sqlite_where=db.text("type = 'PURCHASE'"), postgresql_where=db.text("type = 'PURCHASE'")),
+        db.Index('ix_transactions_user_sale_amount', 'user_id', 'amount',
+                 sqlite_where=db.text("type = 'SALE'"), postgresql_where=db.text("type = 'SALE'")),
+    )
     id = db.Column(db.Integer, primary_key=True)
     date = db.Column(db.Date, nullable=False)
     description = db.Column(db.Text)
@@ -36,11 +101,64 @@ class Transaction(db.Model):
     category = db.Column(db.String(50))
     third_party = db.Column(db.String(100))
     source_file_id = db.Column(db.Integer, db.ForeignKey('uploads.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True) # Owner of the upload, copied for user-scoped queries
+    rule_id = db.Column(db.Integer, nullable=True) # CategoryRule that set category/type, None = built-in keywords
+    original_type = db.Column(db.String(20), nullable=True) # Type and amount before a rule set the type, None = no such rule
+    original_amount = db.Column(db.Numeric(15, 2), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+class MonthlyRollup(db.Model):
+    """
+    Transactions of an upload summed per (month, type, category), kept in
+    step with the transactions table by services/rollups.py. Missing type or
+    category is stored as '' so the key stays unique.
+    """
+    __tablename__ = 'monthly_rollups'
+    __table_args__ = (
+        db.UniqueConstraint('upload_id', 'month', 'type', 'category', name='uq_monthly_rollups_key'),
+        db.Index('ix_monthly_rollups_user_month', 'user_id', 'month'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True) # Owner of the upload
+    upload_id = db.Column(db.Integer, db.ForeignKey('uploads.id'), nullable=False)
+    month = db.Column(db.String(7), nullable=False) # 'YYYY-MM'
+    type = db.Column(db.String(20), nullable=False, default='')
+    category = db.Column(db.String(50), nullable=False, default='')
+    total = db.Column(db.Numeric(15, 2), nullable=False, default=0)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    min_amount = db.Column(db.Numeric(15, 2))
+    max_amount = db.Column(db.Numeric(15, 2))
+
+class DailyBalance(db.Model):
+    """
+    Transactions summed per day, with running totals: `balance`,
+    `sales_to_date` and `purchases_to_date` include every transaction dated
+    up to and including `day`. One series per upload, and one per user
+    (upload_id None) over all their uploads. Kept in step with the
+    transactions table by services/balances.py.
+    """
+    __tablename__ = 'daily_balances'
+    __table_args__ = (
+        db.Index('ix_daily_balances_upload_day', 'upload_id', 'day'),
+        db.Index('ix_daily_balances_user_upload_day', 'user_id', 'upload_id', 'day'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True) # Owner of the upload
+    upload_id = db.Column(db.Integer, db.ForeignKey('uploads.id'), nullable=True) # None = the user's series
+    day = db.Column(db.Date, nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    net = db.Column(db.Numeric(15, 2), nullable=False, default=0)
+    sales = db.Column(db.Numeric(15, 2), nullable=False, default=0)
+    purchases = db.Column(db.Numeric(15, 2), nullable=False, default=0)
+    balance = db.Column(db.Numeric(15, 2), nullable=False, default=0)
+    sales_to_date = db.Column(db.Numeric(15, 2), nullable=False, default=0)
+    purchases_to_date = db.Column(db.Numeric(15, 2), nullable=False, default=0)
+
 class Budget(db.Model):
     __tablename__ = 'budgets'
+    __table_args__ = (db.UniqueConstraint('user_id', 'period', 'category', name='uq_budgets_user_period_category'),)
     id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True) # None = imported before budgets had an owner
     period = db.Column(db.Date, nullable=False) # First day of the month
     category = db.Column(db.String(50))
     amount = db.Column(db.Numeric(15, 2), nullable=False)
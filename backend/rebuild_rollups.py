@@ -0,0 +1,29 @@
+"""
+Rebuilds the monthly rollup (see services/rollups.py) and the daily balances
+(see services/balances.py) from the stored transactions, to repair them
+(migrations 0002 and 0005 backfill databases that predate them). Each upload
+is rebuilt in its own transaction, the daily balances one owner at a time.
+
+Usage: python rebuild_rollups.py [--upload ID ...]
+       (without --upload: every upload)
+"""
+import time
+import argparse
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rebuild the monthly rollup and the daily balances from the transactions.")
+    parser.add_argument('--upload', type=int, action='append', default=None, help="Only this upload (repeatable)")
+    args = parser.parse_args(argv)
+
+    from app import create_app
+    from services import balances, rollups
+
+    app = create_app()
+    start = time.perf_counter()
+    with app.app_context():
+        count = rollups.rebuild(args.upload)
+        balances.rebuild(args.upload)
+    print(f"Rollup and daily balances rebuilt for {count} upload(s) in {time.perf_counter() - start:.1f}s.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+"""
+Applies the current categorization rules (see services/rules.py) to the
+transactions already stored, e.g. after editing global rules on a large
+database. Rows are updated chunk by chunk, each chunk in its own transaction,
+so the web app keeps working meanwhile.
+
+Usage: python reclassify.py [--user ID] [--chunk-size N]
+       (without --user: every user)
+"""
+import argparse
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Re-classify stored transactions with the current rules.")
+    parser.add_argument('--user', type=int, default=None, help="Only this user's transactions (default: all users)")
+    parser.add_argument('--chunk-size', type=int, default=None, help="Rows per committed chunk")
+    args = parser.parse_args(argv)
+
+    from app import create_app
+    from services.rules import reclassify
+
+    app = create_app()
+    with app.app_context():
+        stats = reclassify(args.user, chunk_size=args.chunk_size, all_users=args.user is None)
+    print(f"{stats['updated']} of {stats['scanned']} transaction(s) updated "
+          f"in {stats['chunks']} chunk(s), {stats['seconds']}s.")
+
+if __name__ == "__main__":
+    main()
@@ -1,49 +1,322 @@
+"""
+Re-ingests the files stored in uploads/: content-addressed blobs
+(<sha256>.<ext>) and files stored under their name by older versions.
+
+By default only files that have no Upload record yet are restored. With
+--reprocess, files that already have uploads are parsed again and their
+transactions replaced in place (same upload ids), e.g. after a parser fix.
+
+Files are parsed in parallel by a process pool, once per sheet their uploads
+picked (Excel); inserts go through a small
+number of writer threads, each with its own database connection. Finished
+files are recorded in a checkpoint file so an interrupted or partly failed
+run can resume; the checkpoint is removed once a run completes cleanly.
+
+Raw rows are read from the Arrow snapshot written at ingestion when there is
+one (see services/snapshots.py), which skips the CSV/Excel parse. After a fix
+in the file reading itself, use --from-source to parse the original files
+again (their snapshots are rewritten).
+
+Usage: python restore_history.py [--reprocess] [--from-source] [--workers N]
+                                 [--writers N] [--checkpoint PATH] [--fresh]
+"""
 import os
-from app import create_app
-from models import db, Upload
-from services.ingestion import process_file
+import json
+import time
+import queue
+import argparse
+import threading
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from services.ingestion import read_header, iter_chunks, normalize_columns, normalize_frame, insert_transactions
+from services.storage import blob_name
+from services import balances, cache, snapshots, rules, rollups
+
+def parse_file(file_path, sheet=None, from_source=False):
+    """
+    Runs in a worker process: reads and normalizes a file (`sheet` of a
+    workbook, default: the one ingestion picks) without touching the DB.
+    Returns (filename, sheet, normalized frame or None, rows read, seconds, pid, error).
+    """
+    import pandas as pd
+
+    start = time.perf_counter()
+    filename = os.path.basename(file_path)
+    try:
+        rows_read = 0
+        frames = []
+        snapshot = None
+
+        # The Arrow snapshot written at ingestion spares parsing the file again
+        meta = None if from_source else snapshots.load_meta(file_path, sheet)
+        header = pd.DataFrame(columns=meta['header']) if meta else read_header(file_path, sheet)
+        cols = normalize_columns(header)
+        if 'date' not in cols:
+            raise ValueError("Could not detect a 'Date' column. Please ensure your file has a date column.")
+
+        if snapshots.covers(meta, cols.values()):
+            chunks = snapshots.iter_chunks(file_path, sheet, columns=set(cols.values()), meta=meta)
+        else:
+            chunks = iter_chunks(file_path, cols=cols, sheet=sheet)
+            snapshot = snapshots.open_writer(file_path, sheet, header=list(header.columns))
+
+        try:
+            for chunk in chunks:
+                if snapshot:
+                    snapshot.write(chunk)
+                frames.append(normalize_frame(chunk, cols))
+                rows_read += len(chunk)
+            if snapshot:
+                snapshot.commit()
+                snapshot = None
+        finally:
+            if snapshot:
+                snapshot.abort()
+
+        normalized = pd.concat(frames) if frames else None
+        if normalized is None or normalized.empty:
+            raise ValueError("No valid transactions found. Check column names and data format.")
+        return filename, sheet, normalized, rows_read, time.perf_counter() - start, os.getpid(), None
+    except Exception as e:
+        return filename, sheet, None, 0, time.perf_counter() - start, os.getpid(), str(e)
+
+def work_key(filename, sheet):
+    """Checkpoint entry of a (file, sheet): the file name alone for the default sheet."""
+    return filename if sheet is None else f"{filename}#{sheet}"
+
+class Checkpoint:
+    """
+    JSON file listing the (file, sheet) entries already restored, rewritten atomically.
+    """
+    def __init__(self, path, fresh=False):
+        self.path = path
+        self.done = set()
+        self.lock = threading.Lock()
+        if not fresh and os.path.exists(path):
+            with open(path) as f:
+                self.done = set(json.load(f).get('done', []))
+
+    def mark(self, filename):
+        with self.lock:
+            self.done.add(filename)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'done': sorted(self.done)}, f)
+            os.replace(tmp, self.path)
+
+def content_hash_of(filename):
+    """
+    SHA-256 encoded in a content-addressed file name, None for legacy files.
+    """
+    stem = os.path.splitext(filename)[0]
+    if len(stem) == 64 and all(c in '0123456789abcdef' for c in stem):
+        return stem
+    return None
+
+def uploads_for_file(filename, sheet=None):
+    """Uploads of a stored file that read `sheet` (None: the default one)."""
+    from models import Upload
+
+    content_hash = content_hash_of(filename)
+    if content_hash:
+        uploads = Upload.query.filter_by(content_hash=content_hash).all()
+    else:
+        uploads = Upload.query.filter(Upload.filename == filename, Upload.content_hash.is_(None)).all()
+    return [u for u in uploads if (u.sheet or None) == sheet]
+
+def write_result(result, reprocess):
+    """
+    Runs in a writer thread (inside an app context): stores one parsed file.
+    Each upload is replaced or created in a single transaction.
+    Returns the number of transactions inserted; raises if the file failed.
+    """
+    from models import db, Upload, Transaction
+
+    filename, sheet, normalized, _, _, _, error = result
+    existing = uploads_for_file(filename, sheet)
+
+    # Rows of a statement refresh live in the upload it refreshed
+    refreshes = [u for u in existing if u.append_to_id]
+    existing = [u for u in existing if not u.append_to_id]
+    if refreshes and not existing:
+        print(f"Skipping {filename} (refresh of upload {refreshes[0].append_to_id})")
+        return 0
+
+    if existing and not reprocess:
+        print(f"Skipping {filename} (already in DB)")
+        return 0
 
-app = create_app()
+    if error:
+        if not existing:
+            db.session.add(Upload(filename=filename, content_hash=content_hash_of(filename), sheet=sheet, status='error', error_message=error))
+            db.session.commit()
+        raise ValueError(error) # Existing uploads keep their current rows
 
-def restore_uploads():
+    refreshed = [u for u in existing if Upload.query.filter_by(append_to_id=u.id).first()]
+    if refreshed:
+        # Their rows include refreshes the file alone would not give back
+        raise ValueError(f"upload(s) {', '.join(str(u.id) for u in refreshed)} were refreshed since; delete and re-import them instead")
+
+    uploads = existing or [Upload(filename=filename, content_hash=content_hash_of(filename), sheet=sheet, status='processing')]
+    inserted = 0
+    try:
+        for upload in uploads:
+            if upload.id is None:
+                db.session.add(upload)
+                db.session.flush()
+            else:
+                Transaction.query.filter_by(source_file_id=upload.id).delete()
+                rollups.delete(upload.id)
+                balances.delete(upload.id)
+            # Category rules depend on the owner, parsing did not know it
+            ruleset = rules.for_user(upload.user_id)
+            classified = ruleset.apply(normalized) if ruleset else normalized
+            inserted += insert_transactions(classified, upload.id, upload.user_id)
+            rollups.add(upload.id, upload.user_id, classified)
+            balances.add(upload.id, upload.user_id, classified)
+            cache.invalidate(upload.user_id)
+            upload.status = 'completed'
+            upload.error_message = None
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    action = 'Reprocessed' if existing else 'Restored'
+    print(f"{action} {filename} with {len(normalized)} transactions ({len(uploads)} upload(s)).")
+    return inserted
+
+def writer_loop(app, results, checkpoint, reprocess, stats):
     with app.app_context():
-        upload_folder = os.path.join(app.root_path, 'uploads')
-        if not os.path.exists(upload_folder):
-            print("Uploads folder not found.")
-            return
-
-        files = [f for f in os.listdir(upload_folder) if os.path.isfile(os.path.join(upload_folder, f))]
-        
-        print(f"Found files: {files}")
-        
-        for filename in files:
-            # Check if exists in DB
-            existing = Upload.query.filter_by(filename=filename).first()
-            if existing:
-                print(f"Skipping {filename} (already in DB)")
-                continue
-                
-            print(f"Restoring {filename}...")
+        while True:
+            result = results.get()
+            if result is None:
+                return
+            key = work_key(result[0], result[1])
             try:
-                # Create new upload record
-                new_upload = Upload(filename=filename, status='processing')
-                db.session.add(new_upload)
-                db.session.commit()
-                
-                # Process file
-                file_path = os.path.join(upload_folder, filename)
-                count = process_file(file_path, new_upload.id)
-                
-                new_upload.status = 'completed'
-                db.session.commit()
-                print(f"Successfully restored {filename} with {count} transactions.")
-                
+                inserted = write_result(result, reprocess)
+                checkpoint.mark(key)
+                with stats['lock']:
+                    stats['inserted'] += inserted
             except Exception as e:
-                print(f"Failed to restore {filename}: {e}")
-                if 'new_upload' in locals():
-                    new_upload.status = 'error'
-                    new_upload.error_message = str(e)
-                    db.session.commit()
+                print(f"Failed to restore {key}: {e}")
+                with stats['lock']:
+                    stats['failed'] += 1
+
+def restore_uploads(reprocess=False, workers=None, writers=None, checkpoint_path=None, fresh=False, from_source=False):
+    from app import create_app
+    from models import db, Upload
+
+    app = create_app()
+    upload_folder = os.path.join(app.root_path, 'uploads')
+    if not os.path.exists(upload_folder):
+        print("Uploads folder not found.")
+        return
+
+    files = sorted(
+        f for f in os.listdir(upload_folder)
+        if os.path.isfile(os.path.join(upload_folder, f)) and not f.startswith('.') # Skip uploads being received
+    )
+    print(f"Found files: {len(files)}")
+
+    checkpoint = Checkpoint(checkpoint_path or os.path.join(app.root_path, 'restore_checkpoint.json'), fresh=fresh)
+
+    with app.app_context():
+        # Sheets the uploads of each stored file read, parsed once each
+        known = {}
+        for u in Upload.query.with_entities(Upload.filename, Upload.content_hash, Upload.sheet):
+            known.setdefault(blob_name(u.content_hash, u.filename) if u.content_hash else u.filename, set()).add(u.sheet or None)
+        if writers is None:
+            # SQLite serializes writers anyway
+            writers = 1 if db.engine.name == 'sqlite' else 2
+
+    todo = []
+    for filename in files:
+        if filename in known and not reprocess:
+            print(f"Skipping {filename} (already in DB)")
+            continue
+        for sheet in sorted(known.get(filename, {None}), key=lambda s: s or ''):
+            if work_key(filename, sheet) not in checkpoint.done:
+                todo.append((os.path.join(upload_folder, filename), sheet))
+
+    print(f"{len(todo)} file(s) or sheet(s) to process, {len(checkpoint.done)} already done according to the checkpoint.")
+    if not todo:
+        return
+
+    workers = workers or os.cpu_count() or 1
+    results = queue.Queue(maxsize=writers * 2) # Back-pressure on the parsers
+    stats = {'lock': threading.Lock(), 'inserted': 0, 'failed': 0}
+    per_worker = {}
+
+    writer_threads = [
+        threading.Thread(target=writer_loop, args=(app, results, checkpoint, reprocess, stats), daemon=True)
+        for _ in range(writers)
+    ]
+    for thread in writer_threads:
+        thread.start()
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        paths = iter(todo)
+        while True:
+            # Keep a bounded number of parsed frames in flight
+            while len(pending) < workers * 2:
+                item = next(paths, None)
+                if item is None:
+                    break
+                path, sheet = item
+                pending.add(pool.submit(parse_file, path, sheet, from_source))
+            if not pending:
+                break
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                _, _, _, rows_read, seconds, pid, _ = result
+                worker = per_worker.setdefault(pid, {'files': 0, 'rows': 0, 'seconds': 0.0})
+                worker['files'] += 1
+                worker['rows'] += rows_read
+                worker['seconds'] += seconds
+                results.put(result)
+
+    for _ in writer_threads:
+        results.put(None)
+    for thread in writer_threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    print("\n--- Parse throughput per worker ---")
+    for pid, worker in sorted(per_worker.items()):
+        rate = worker['rows'] / worker['seconds'] if worker['seconds'] else 0
+        print(f"worker {pid}: {worker['files']} file(s), {worker['rows']} rows, {rate:,.0f} rows/s")
+    total_rate = stats['inserted'] / elapsed if elapsed else 0
+    print(f"Total: {len(todo)} file(s) or sheet(s), {stats['inserted']} transactions inserted in {elapsed:.1f}s "
+          f"({total_rate:,.0f} rows/s) with {workers} worker(s) and {writers} writer(s).")
+
+    if stats['failed']:
+        print(f"{stats['failed']} file(s) failed. Run again to retry them, finished files are skipped.")
+    elif os.path.exists(checkpoint.path):
+        os.remove(checkpoint.path) # Complete run: next run starts from scratch
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Restore or reprocess stored uploads in parallel.")
+    parser.add_argument('--reprocess', action='store_true', help="Re-derive transactions of files that already have uploads")
+    parser.add_argument('--from-source', action='store_true', help="Parse the original files, not their snapshots")
+    parser.add_argument('--workers', type=int, default=None, help="Parser processes (default: CPU count)")
+    parser.add_argument('--writers', type=int, default=None, help="DB writer connections (default: 1 on SQLite, 2 otherwise)")
+    parser.add_argument('--checkpoint', default=None, help="Checkpoint file (default: restore_checkpoint.json)")
+    parser.add_argument('--fresh', action='store_true', help="Ignore an existing checkpoint")
+    args = parser.parse_args(argv)
+
+    restore_uploads(
+        reprocess=args.reprocess,
+        workers=args.workers,
+        writers=args.writers,
+        checkpoint_path=args.checkpoint,
+        fresh=args.fresh,
+        from_source=args.from_source
+    )
 
 if __name__ == "__main__":
-    restore_uploads()
+    main()
@@ -1,10 +1,14 @@
 import os
-from flask import Blueprint, request, jsonify, current_app
+import glob
+import hashlib
+import functools
+import tempfile
+from flask import Blueprint, request, jsonify, current_app, Response, stream_with_context, make_response
 from werkzeug.utils import secure_filename
-from datetime import datetime
-from models import db, Upload, Transaction, Budget, User
-from services.ingestion import process_file
-from services.kpi import get_dashboard_stats, get_cash_flow_history, get_monthly_breakdown, get_annual_breakdown, get_top_expenses, get_top_income, get_advanced_kpis
+from datetime import datetime, date
+from models import db, Upload, Transaction, Budget, User, CategoryRule
+from services import jobs, storage, rules, progress, dashboard, rollups, balances, cache
+from services.kpi import GRANULARITIES, get_dashboard_stats, get_cash_flow_history, get_monthly_breakdown, get_annual_breakdown, get_top_expenses, get_top_income, get_advanced_kpis
 from services.budget import import_budget, get_budget_comparison
 from services.forecast import generate_forecast
 from services.analysis import generate_analysis
@@ -17,6 +21,84 @@ ALLOWED_EXTENSIONS = {'csv', 'xlsx', 'xls'}
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def date_arg(name):
+    """Query parameter `name` as a date (YYYY-MM-DD), None if absent. ValueError if malformed."""
+    value = request.args.get(name)
+    return date.fromisoformat(value) if value else None
+
+def cash_flow_args(default='month'):
+    """
+    (granularity, start, end) of a cash flow request, or an error message.
+    """
+    granularity = request.args.get('granularity', default=default)
+    if granularity not in GRANULARITIES:
+        return None, f"Unknown granularity: {granularity} ({', '.join(GRANULARITIES)})"
+    try:
+        start, end = date_arg('start'), date_arg('end')
+    except ValueError:
+        return None, "start and end must be dates (YYYY-MM-DD)"
+    if start and end and start > end:
+        return None, "start must not be after end"
+    return (granularity, start, end), None
+
+def _source_digest():
+    """Digest of the backend code: a deployment changing responses changes every ETag."""
+    digest = hashlib.sha1()
+    root = os.path.dirname(os.path.abspath(__file__))
+    for path in sorted(glob.glob(os.path.join(root, '*.py')) + glob.glob(os.path.join(root, 'services', '*.py'))):
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+SOURCE_DIGEST = _source_digest()
+
+def _revalidate(response):
+    # Browsers keep the response but ask again each time, sending If-None-Match
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Authorization')
+    return response
+
+def conditional(view):
+    """
+    Strong ETag for a view computed from the user's data alone: it derives
+    from their data version (see services/cache.py), today's date and the
+    query parameters, so a matching If-None-Match is answered 304 before the
+    view runs any query. Goes below @jwt_required().
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        current_user_id = int(get_jwt_identity())
+        version = cache.data_version(current_user_id)
+        if version is None:
+            return view(*args, **kwargs)
+        params = sorted(request.args.items(multi=True))
+        tag = hashlib.sha1(
+            f"{SOURCE_DIGEST}:{current_user_id}:{version}:{datetime.utcnow().date()}:{request.path}:{params}".encode('utf-8')
+        ).hexdigest()
+        if request.if_none_match.contains_weak(tag): # Weak comparison, as If-None-Match wants
+            response = make_response('', 304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(tag)
+        return _revalidate(response)
+    return wrapper
+
+def conditional_on_body(view):
+    """
+    ETag of the response body, for views showing state the data version does
+    not follow (upload progress): a match saves the transfer, not the work.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        response = make_response(view(*args, **kwargs))
+        if response.status_code != 200:
+            return response
+        response.add_etag()
+        return _revalidate(response.make_conditional(request))
+    return wrapper
+
 @api_bp.route('/upload', methods=['POST'])
 @jwt_required()
 def upload_file():
@@ -25,7 +107,7 @@ def upload_file():
     # Check upload limit for free users
     user = User.query.get(current_user_id)
     if user.subscription_status != 'active':
-        upload_count = Upload.query.filter_by(user_id=current_user_id).count()
+        upload_count = Upload.query.filter_by(user_id=current_user_id, append_to_id=None).count() # Refreshes are free
         if upload_count >= 2:
             return jsonify({
                 "error": "Upload limit reached",
@@ -41,59 +123,131 @@ def upload_file():
     
     if file and allowed_file(file.filename):
         filename = secure_filename(file.filename)
-        upload_folder = os.path.join(current_app.root_path, 'uploads')
-        if not os.path.exists(upload_folder):
-            os.makedirs(upload_folder)
-            
-        file_path = os.path.join(upload_folder, filename)
-        file.save(file_path)
-        
-        # Check for duplicates for this user
-        existing_upload = Upload.query.filter_by(filename=filename, status='completed', user_id=current_user_id).first()
+        sheet = request.form.get('sheet') or None # Sheet to import from an .xlsx workbook
+
+        # Stored under its SHA-256: identical content is kept once on disk
+        content_hash, _ = storage.save_stream(current_app, file.stream, filename)
+
+        # Same content already imported by this user: nothing to parse again
+        existing_upload = Upload.query.filter(
+            Upload.content_hash == content_hash,
+            Upload.sheet.is_(None) if sheet is None else Upload.sheet == sheet,
+            Upload.status.in_(['pending', 'processing', 'completed']),
+            Upload.user_id == current_user_id
+        ).order_by(Upload.id.desc()).first()
         if existing_upload:
-             return jsonify({"error": "File already uploaded. Please reset data if you want to re-upload."}), 409
+            return jsonify({
+                "message": "This file was already imported.",
+                "upload_id": existing_upload.id,
+                "status": existing_upload.status,
+                "duplicate": True
+            }), 200
 
-        # Create Upload record
-        new_upload = Upload(filename=filename, status='processing', user_id=current_user_id)
+        # Create Upload record, picked up by the ingestion workers (services/jobs.py)
+        new_upload = Upload(filename=filename, content_hash=content_hash, sheet=sheet, status='pending', user_id=current_user_id)
         db.session.add(new_upload)
         db.session.commit()
-        
-        try:
-            count = process_file(file_path, new_upload.id)
-            return jsonify({
-                "message": f"File processed successfully. {count} transactions imported.",
-                "upload_id": new_upload.id
-            }), 200
-        except Exception as e:
-            import traceback
-            traceback.print_exc()
-            return jsonify({"error": f"Processing error: {str(e)}"}), 500
+        jobs.enqueue(current_app)
+
+        return jsonify({
+            "message": "File received. Processing has started.",
+            "upload_id": new_upload.id,
+            "status": new_upload.status
+        }), 202
             
     return jsonify({"error": "Invalid file type"}), 400
 
+@api_bp.route('/uploads/<int:upload_id>/append', methods=['POST'])
+@jwt_required()
+def append_upload(upload_id):
+    """
+    Refreshes a statement with a newer export of it: only the rows past what
+    is already stored are inserted, into the same upload.
+    """
+    current_user_id = int(get_jwt_identity())
+    target = Upload.query.get(upload_id)
+    if not target:
+        return jsonify({"error": "Upload not found"}), 404
+    if target.user_id != current_user_id:
+        return jsonify({"error": "Unauthorized"}), 403
+    if target.append_to_id:
+        target = Upload.query.get(target.append_to_id) # Refresh of a refresh: same statement
+    if target.status != 'completed':
+        return jsonify({"error": "Only a completed upload can be refreshed."}), 409
+
+    in_progress = Upload.query.filter(
+        Upload.append_to_id == target.id,
+        Upload.status.in_(['pending', 'processing'])
+    ).first()
+    if in_progress:
+        return jsonify({"error": "A refresh of this upload is already in progress.", "upload_id": in_progress.id}), 409
+
+    if 'file' not in request.files:
+        return jsonify({"error": "No file part"}), 400
+    file = request.files['file']
+    if file.filename == '':
+        return jsonify({"error": "No selected file"}), 400
+    if not allowed_file(file.filename):
+        return jsonify({"error": "Invalid file type"}), 400
+
+    filename = secure_filename(file.filename)
+    sheet = request.form.get('sheet') or target.sheet
+    content_hash, _ = storage.save_stream(current_app, file.stream, filename)
+
+    if content_hash == target.content_hash or Upload.query.filter(
+        Upload.append_to_id == target.id,
+        Upload.content_hash == content_hash,
+        Upload.status == 'completed'
+    ).first():
+        return jsonify({
+            "message": "This file was already imported.",
+            "upload_id": target.id,
+            "status": target.status,
+            "duplicate": True
+        }), 200
+
+    refresh = Upload(
+        filename=filename, content_hash=content_hash, sheet=sheet, status='pending',
+        user_id=current_user_id, append_to_id=target.id
+    )
+    db.session.add(refresh)
+    db.session.commit()
+    jobs.enqueue(current_app)
+
+    return jsonify({
+        "message": "File received. New rows are being added.",
+        "upload_id": refresh.id,
+        "append_to": target.id,
+        "status": refresh.status
+    }), 202
+
 @api_bp.route('/upload-budget', methods=['POST'])
+@jwt_required()
 def upload_budget():
+    current_user_id = int(get_jwt_identity())
     if 'file' not in request.files:
         return jsonify({"error": "No file part"}), 400
     file = request.files['file']
     
     if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        upload_folder = os.path.join(current_app.root_path, 'uploads')
-        if not os.path.exists(upload_folder):
-            os.makedirs(upload_folder)
-        file_path = os.path.join(upload_folder, filename)
-        file.save(file_path)
-        
+        # Parsed right away: kept out of the uploads folder, which holds statements
+        ext = os.path.splitext(secure_filename(file.filename))[1].lower()
+        fd, file_path = tempfile.mkstemp(suffix=ext, prefix='budget-')
+        os.close(fd)
         try:
-            count = import_budget(file_path)
+            file.save(file_path)
+            count = import_budget(file_path, user_id=current_user_id)
             return jsonify({"message": f"Budget imported successfully. {count} entries."}), 200
         except Exception as e:
+            db.session.rollback()
             return jsonify({"error": str(e)}), 500
+        finally:
+            os.remove(file_path)
     return jsonify({"error": "Invalid file"}), 400
 
 @api_bp.route('/dashboard/stats', methods=['GET'])
 @jwt_required()
+@conditional
 def dashboard_stats():
     current_user_id = int(get_jwt_identity())
     upload_id = request.args.get('upload_id', type=int)
@@ -108,29 +262,42 @@ def dashboard_stats():
 
 @api_bp.route('/dashboard/cashflow', methods=['GET'])
 @jwt_required()
+@conditional
 def cashflow_history():
+    """
+    Net flow and running balance per `granularity` bucket (day, week, month,
+    quarter) from `start` to `end` (YYYY-MM-DD, both included, either may be
+    omitted), or over the calendar `year` (default: the latest one).
+    """
     current_user_id = int(get_jwt_identity())
-    granularity = request.args.get('granularity', default='month')
     year = request.args.get('year', type=int)
     upload_id = request.args.get('upload_id', type=int)
+    args, error = cash_flow_args()
+    if error:
+        return jsonify({"error": error}), 400
+    granularity, start, end = args
 
     if upload_id:
         upload = Upload.query.get(upload_id)
         if not upload or upload.user_id != current_user_id:
             return jsonify({"error": "Unauthorized access to this upload"}), 403
 
-    history = get_cash_flow_history(year=year, granularity=granularity, upload_id=upload_id, user_id=current_user_id)
+    history = get_cash_flow_history(year=year, granularity=granularity, upload_id=upload_id, user_id=current_user_id, start=start, end=end)
     return jsonify(history)
 
 @api_bp.route('/budget/comparison', methods=['GET'])
+@jwt_required()
+@conditional
 def budget_comparison():
+    current_user_id = int(get_jwt_identity())
     month = request.args.get('month', type=int)
     year = request.args.get('year', type=int)
-    comparison = get_budget_comparison(month, year)
+    comparison = get_budget_comparison(month, year, user_id=current_user_id)
     return jsonify(comparison)
 
 @api_bp.route('/forecast', methods=['GET'])
 @jwt_required()
+@conditional
 def forecast():
     current_user_id = int(get_jwt_identity())
     months = request.args.get('months', default=6, type=int)
@@ -144,21 +311,193 @@ def forecast():
     data = generate_forecast(months, upload_id=upload_id, user_id=current_user_id)
     return jsonify(data)
 
+def serialize_upload(u):
+    if u.status == 'completed':
+        progress = 100
+    elif u.rows_total:
+        progress = min(round((u.rows_processed or 0) / u.rows_total * 100), 99)
+    else:
+        progress = 0
+
+    return {
+        "id": u.id,
+        "filename": u.filename,
+        "sheet": u.sheet,
+        "append_to": u.append_to_id,
+        "last_transaction_date": u.last_transaction_date.isoformat() if u.last_transaction_date else None,
+        "date": u.upload_date.strftime('%Y-%m-%d %H:%M'),
+        "status": u.status,
+        "error": u.error_message,
+        "rows_processed": u.rows_processed or 0,
+        "rows_skipped": u.rows_skipped or 0,
+        "rows_inserted": u.rows_inserted or 0,
+        "stage": u.stage,
+        "rows_total": u.rows_total,
+        "progress": progress
+    }
+
 @api_bp.route('/uploads', methods=['GET'])
 @jwt_required()
+@conditional_on_body
 def get_uploads():
     current_user_id = int(get_jwt_identity())
     uploads = Upload.query.filter_by(user_id=current_user_id).order_by(Upload.upload_date.desc()).all()
-    return jsonify([{
-        "id": u.id,
-        "filename": u.filename,
-        "date": u.upload_date.strftime('%Y-%m-%d %H:%M'),
-        "status": u.status,
-        "error": u.error_message
-    } for u in uploads])
+    return jsonify([serialize_upload(u) for u in uploads])
+
+@api_bp.route('/uploads/<int:upload_id>', methods=['GET'])
+@jwt_required()
+@conditional_on_body
+def get_upload_status(upload_id):
+    current_user_id = int(get_jwt_identity())
+    upload = Upload.query.get(upload_id)
+    if not upload:
+        return jsonify({"error": "Upload not found"}), 404
+    if upload.user_id != current_user_id:
+        return jsonify({"error": "Unauthorized"}), 403
+    return jsonify(serialize_upload(upload))
+
+@api_bp.route('/rules', methods=['GET'])
+@jwt_required()
+def get_rules():
+    """
+    The user's categorization rules, then the global ones (read-only).
+    """
+    current_user_id = int(get_jwt_identity())
+    user_rules = CategoryRule.query.filter(
+        db.or_(CategoryRule.user_id == current_user_id, CategoryRule.user_id.is_(None))
+    ).order_by(CategoryRule.user_id.is_(None), CategoryRule.priority, CategoryRule.id).all()
+    return jsonify({
+        "rules": [rules.serialize_rule(r) for r in user_rules],
+        "reclassification": rules.reclassify_status(current_user_id)
+    })
+
+@api_bp.route('/rules', methods=['POST'])
+@jwt_required()
+def create_rule():
+    current_user_id = int(get_jwt_identity())
+    data = request.get_json(silent=True) or {}
+    error = rules.validate(data)
+    if error:
+        return jsonify({"error": error}), 400
+
+    rule = CategoryRule(user_id=current_user_id)
+    rules.update_rule(rule, data)
+    db.session.add(rule)
+    db.session.commit()
+    return jsonify(rules.serialize_rule(rule)), 201
+
+@api_bp.route('/rules/<int:rule_id>', methods=['PUT'])
+@jwt_required()
+def update_rule(rule_id):
+    current_user_id = int(get_jwt_identity())
+    rule = CategoryRule.query.get(rule_id)
+    if not rule:
+        return jsonify({"error": "Rule not found"}), 404
+    if rule.user_id != current_user_id:
+        return jsonify({"error": "Unauthorized"}), 403
+
+    data = request.get_json(silent=True) or {}
+    error = rules.validate(data)
+    if error:
+        return jsonify({"error": error}), 400
+
+    rules.update_rule(rule, data)
+    db.session.commit()
+    return jsonify(rules.serialize_rule(rule))
+
+@api_bp.route('/rules/<int:rule_id>', methods=['DELETE'])
+@jwt_required()
+def delete_rule(rule_id):
+    current_user_id = int(get_jwt_identity())
+    rule = CategoryRule.query.get(rule_id)
+    if not rule:
+        return jsonify({"error": "Rule not found"}), 404
+    if rule.user_id != current_user_id:
+        return jsonify({"error": "Unauthorized"}), 403
+
+    db.session.delete(rule)
+    db.session.commit()
+    return jsonify({"message": "Rule deleted"}), 200
+
+@api_bp.route('/rules/apply', methods=['POST'])
+@jwt_required()
+def apply_rules():
+    """
+    Re-classifies the user's stored transactions with the current rules, in
+    the background. Poll GET /rules for the outcome.
+    """
+    current_user_id = int(get_jwt_identity())
+    if not rules.start_reclassify(current_app._get_current_object(), current_user_id):
+        return jsonify({"error": "A re-classification is already running."}), 409
+    return jsonify({"message": "Re-classification started."}), 202
+
+@api_bp.route('/uploads/<int:upload_id>/events', methods=['GET'])
+@jwt_required()
+def upload_events(upload_id):
+    """
+    Streams the ingestion progress of an upload as Server-Sent Events:
+    rows read, inserted and skipped, stage and ETA, until it is done.
+    """
+    current_user_id = int(get_jwt_identity())
+    upload = Upload.query.get(upload_id)
+    if not upload:
+        return jsonify({"error": "Upload not found"}), 404
+    if upload.user_id != current_user_id:
+        return jsonify({"error": "Unauthorized"}), 403
+    db.session.rollback() # The stream reads the row again
+
+    events = progress.stream(
+        upload_id,
+        poll_interval=current_app.config['PROGRESS_POLL_INTERVAL'],
+        max_seconds=current_app.config['PROGRESS_STREAM_SECONDS']
+    )
+    return Response(stream_with_context(events), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no' # Unbuffered behind nginx
+    })
+
+@api_bp.route('/dashboard/bundle', methods=['GET'])
+@jwt_required()
+@conditional
+def dashboard_bundle():
+    """
+    Several dashboard sections in one request, from one aggregation pass.
+    `sections`: comma separated names (default: all), see services/dashboard.py.
+    Other parameters are those of the per-section endpoints.
+    """
+    current_user_id = int(get_jwt_identity())
+    upload_id = request.args.get('upload_id', type=int)
+
+    if upload_id:
+        upload = Upload.query.get(upload_id)
+        if not upload or upload.user_id != current_user_id:
+            return jsonify({"error": "Unauthorized access to this upload"}), 403
+
+    sections = [s.strip() for s in request.args.get('sections', '').split(',') if s.strip()]
+    unknown = [s for s in sections if s not in dashboard.SECTIONS]
+    if unknown:
+        return jsonify({"error": f"Unknown section(s): {', '.join(unknown)}", "sections": dashboard.SECTIONS}), 400
+    args, error = cash_flow_args(default='day')
+    if error:
+        return jsonify({"error": error}), 400
+    granularity, start, end = args
+
+    data = dashboard.build_bundle(
+        sections or None,
+        upload_id=upload_id,
+        user_id=current_user_id,
+        year=request.args.get('year', type=int),
+        granularity=granularity,
+        start=start,
+        end=end,
+        limit=request.args.get('limit', default=0, type=int),
+        months=request.args.get('months', default=6, type=int)
+    )
+    return jsonify(data)
 
 @api_bp.route('/dashboard/monthly', methods=['GET'])
 @jwt_required()
+@conditional
 def monthly_breakdown():
     current_user_id = int(get_jwt_identity())
     year = request.args.get('year', type=int)
@@ -174,6 +513,7 @@ def monthly_breakdown():
 
 @api_bp.route('/dashboard/annual', methods=['GET'])
 @jwt_required()
+@conditional
 def annual_breakdown():
     current_user_id = int(get_jwt_identity())
     upload_id = request.args.get('upload_id', type=int)
@@ -188,6 +528,7 @@ def annual_breakdown():
 
 @api_bp.route('/dashboard/top-expenses', methods=['GET'])
 @jwt_required()
+@conditional
 def top_expenses():
     current_user_id = int(get_jwt_identity())
     limit = request.args.get('limit', default=10, type=int)
@@ -203,6 +544,7 @@ def top_expenses():
 
 @api_bp.route('/dashboard/top-income', methods=['GET'])
 @jwt_required()
+@conditional
 def top_income():
     current_user_id = int(get_jwt_identity())
     limit = request.args.get('limit', default=10, type=int)
@@ -218,6 +560,7 @@ def top_income():
 
 @api_bp.route('/dashboard/advanced-kpis', methods=['GET'])
 @jwt_required()
+@conditional
 def advanced_kpis():
     current_user_id = int(get_jwt_identity())
     upload_id = request.args.get('upload_id', type=int)
@@ -232,6 +575,7 @@ def advanced_kpis():
 
 @api_bp.route('/dashboard/details', methods=['GET'])
 @jwt_required()
+@conditional
 def get_details():
     current_user_id = int(get_jwt_identity())
     month = request.args.get('month') # Format: YYYY-MM
@@ -266,9 +610,7 @@ def get_details():
         if upload_id:
             query = query.filter(Transaction.source_file_id == upload_id)
         elif current_user_id:
-            query = query.filter(Transaction.source_file_id.in_(
-                db.session.query(Upload.id).filter(Upload.user_id == current_user_id)
-            ))
+            query = query.filter(Transaction.user_id == current_user_id)
 
         transactions = query.order_by(Transaction.date.desc()).all()
         
@@ -284,6 +626,7 @@ def get_details():
 
 @api_bp.route('/dashboard/analysis', methods=['GET'])
 @jwt_required()
+@conditional
 def get_analysis():
     try:
         current_user_id = int(get_jwt_identity())
@@ -311,22 +654,36 @@ def delete_upload(upload_id):
         if upload.user_id != current_user_id:
             return jsonify({"error": "Unauthorized"}), 403
 
+        if upload.append_to_id and upload.status == 'completed':
+            return jsonify({"error": "The rows of a refresh belong to the upload it refreshed. Delete that upload instead."}), 400
+
+        # Refreshes of this upload go with it
+        deleted = Upload.query.filter_by(append_to_id=upload_id).all() + [upload]
+        busy = [u for u in deleted if u.status in ('pending', 'processing')]
+        if busy:
+            # A worker would keep inserting rows under the deleted upload
+            return jsonify({"error": "This upload is still being processed. Delete it once it is done.", "upload_id": busy[0].id}), 409
+
         # Delete related transactions first (manual cascade)
-        Transaction.query.filter_by(source_file_id=upload_id).delete()
+        for u in deleted:
+            Transaction.query.filter_by(source_file_id=u.id).delete()
+        rollups.delete(*(u.id for u in deleted))
+        balances.delete(*(u.id for u in deleted))
+        cache.invalidate(current_user_id)
         
-        # Delete the upload record
-        db.session.delete(upload)
+        # Delete the upload records, refreshes first (they reference the upload)
+        for u in deleted:
+            db.session.delete(u)
+            db.session.flush()
         db.session.commit()
         
-        # Optional: Delete the actual file from disk
-        try:
-            upload_folder = os.path.join(current_app.root_path, 'uploads')
-            file_path = os.path.join(upload_folder, upload.filename)
-            if os.path.exists(file_path):
-                os.remove(file_path)
-        except Exception as e:
-            print(f"Error deleting file from disk: {e}")
-            # We don't fail the request if file deletion fails, as DB is consistent
+        # Delete the stored files unless another upload has the same content
+        for u in deleted:
+            try:
+                storage.release_blob(current_app, u)
+            except Exception as e:
+                print(f"Error deleting file from disk: {e}")
+                # We don't fail the request if file deletion fails, as DB is consistent
 
         return jsonify({"message": "Upload deleted successfully"}), 200
     except Exception as e:
@@ -2,6 +2,7 @@ from models import db, Transaction, Upload
 from sqlalchemy import func, case
 from datetime import datetime, timedelta
 from services.kpi import get_dashboard_stats, get_advanced_kpis, get_top_expenses
+from services.cache import cached
 
 SECTOR_BENCHMARKS = {
     'BAKERY': {
@@ -55,14 +56,19 @@ def detect_sector(upload_id):
                 
     return 'GENERAL'
 
-def generate_analysis(upload_id=None, user_id=None):
+@cached
+def generate_analysis(upload_id=None, user_id=None, stats=None, adv_stats=None, top_expenses=None):
     """
     Analyzes financial data with sector-specific context.
+    The KPIs it builds on are computed unless given (see services/dashboard.py).
     """
     # Get base stats
-    stats = get_dashboard_stats(upload_id=upload_id, user_id=user_id)
-    adv_stats = get_advanced_kpis(upload_id=upload_id, user_id=user_id)
-    top_expenses = get_top_expenses(limit=100, upload_id=upload_id, user_id=user_id) # Get all expenses for categorization
+    if stats is None:
+        stats = get_dashboard_stats(upload_id=upload_id, user_id=user_id)
+    if adv_stats is None:
+        adv_stats = get_advanced_kpis(upload_id=upload_id, user_id=user_id)
+    if top_expenses is None:
+        top_expenses = get_top_expenses(limit=100, upload_id=upload_id, user_id=user_id) # Get all expenses for categorization
     
     sector_key = detect_sector(upload_id)
     sector_data = SECTOR_BENCHMARKS[sector_key]
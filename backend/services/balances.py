@@ -0,0 +1,281 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+import numpy as np
+import pandas as pd
+from sqlalchemy import func, case
+from models import db, Transaction, Upload, User, DailyBalance
+
+# Per-day columns of a series, in cents while being applied
+COLUMNS = ['count', 'net', 'sales', 'purchases']
+
+def scope(upload_id=None, user_id=None):
+    """Filters on DailyBalance selecting the series of an upload or of a user, None without either."""
+    if upload_id:
+        return [DailyBalance.upload_id == upload_id]
+    if user_id:
+        return [DailyBalance.user_id == user_id, DailyBalance.upload_id.is_(None)]
+    return None
+
+def _cents(value):
+    return int(round(value * 100)) if value is not None else 0
+
+def _decimal(cents):
+    return Decimal(int(cents)).scaleb(-2)
+
+def _as_date(value):
+    return value.date() if isinstance(value, datetime) else value
+
+def _daily(days, types, cents):
+    """Per-day deltas (DataFrame of COLUMNS indexed by day) of rows given as parallel arrays."""
+    codes, uniques = pd.factorize(days)
+
+    def per_day(weights):
+        return np.bincount(codes, weights=weights, minlength=len(uniques)).round().astype('int64')
+
+    deltas = pd.DataFrame({
+        'count': np.bincount(codes, minlength=len(uniques)),
+        'net': per_day(cents),
+        'sales': per_day(np.where(types == 'SALE', cents, 0)),
+        'purchases': per_day(np.where(types == 'PURCHASE', cents, 0))
+    }, index=[_as_date(d) for d in uniques], columns=COLUMNS)
+    return deltas.sort_index()
+
+def _stored(upload_id, days=None):
+    """Per-day columns stored for an upload, as deltas, on the listed days (default: all)."""
+    filters = [DailyBalance.upload_id == upload_id]
+    if days is not None:
+        filters.append(DailyBalance.day.in_(days))
+    rows = db.session.query(DailyBalance.day, *(getattr(DailyBalance, c) for c in COLUMNS)).filter(*filters).all()
+    return pd.DataFrame(
+        [(r.count, _cents(r.net), _cents(r.sales), _cents(r.purchases)) for r in rows],
+        index=[r.day for r in rows], columns=COLUMNS, dtype='int64'
+    )
+
+def _apply(deltas, upload_id, user_id):
+    """
+    Adds per-day deltas to the series of an upload owned by `user_id`, or to
+    the user's own series when `upload_id` is None, then brings its running
+    totals up to date from the first day changed. Days left without
+    transactions are dropped.
+    """
+    if upload_id is None and user_id is None:
+        return
+    values = deltas[COLUMNS].to_numpy(dtype='int64')
+    changed = values.any(axis=1)
+    if not changed.any():
+        return
+    days, values = deltas.index[changed], values[changed]
+    table = DailyBalance.__table__
+    if upload_id is None:
+        # A user's uploads can be ingested concurrently: one writer per series (no-op on SQLite)
+        db.session.query(User.id).filter(User.id == user_id).with_for_update().scalar()
+        filters = [table.c.user_id == user_id, table.c.upload_id.is_(None)]
+    else:
+        filters = [table.c.upload_id == upload_id]
+
+    first, last = min(days), max(days)
+    existing = dict(db.session.execute(
+        db.select(table.c.day, table.c.id).where(*filters, table.c.day >= first, table.c.day <= last)
+    ).all())
+    updates, inserts = [], []
+    for day, (count, net, sales, purchases) in zip(days, values.tolist()):
+        change = {'d_count': count, 'd_net': _decimal(net), 'd_sales': _decimal(sales), 'd_purchases': _decimal(purchases)}
+        if day in existing:
+            updates.append({'row_id': existing[day], **change})
+        else:
+            inserts.append({
+                'user_id': user_id, 'upload_id': upload_id, 'day': day, 'count': count,
+                'net': change['d_net'], 'sales': change['d_sales'], 'purchases': change['d_purchases'],
+                'balance': 0, 'sales_to_date': 0, 'purchases_to_date': 0
+            })
+    if updates:
+        db.session.execute(table.update().where(table.c.id == db.bindparam('row_id')).values(
+            count=table.c.count + db.bindparam('d_count'),
+            net=table.c.net + db.bindparam('d_net', type_=table.c.net.type),
+            sales=table.c.sales + db.bindparam('d_sales', type_=table.c.sales.type),
+            purchases=table.c.purchases + db.bindparam('d_purchases', type_=table.c.purchases.type)
+        ), updates)
+    if inserts:
+        db.session.execute(table.insert(), inserts)
+    db.session.execute(table.delete().where(*filters, table.c.day >= first, table.c.day <= last, table.c.count <= 0))
+    _accumulate(filters, first)
+
+def _accumulate(filters, first):
+    """Recomputes the running totals of a series from `first` on, in one UPDATE ... FROM."""
+    table = DailyBalance.__table__
+    before = db.session.execute(
+        db.select(table.c.balance, table.c.sales_to_date, table.c.purchases_to_date)
+        .where(*filters, table.c.day < first).order_by(table.c.day.desc()).limit(1)
+    ).first()
+    base = [db.literal(value or 0, table.c.balance.type) for value in (before or (0, 0, 0))]
+    order = {'order_by': table.c.day}
+    running = db.select(
+        table.c.id,
+        (base[0] + func.sum(table.c.net).over(**order)).label('running_balance'),
+        (base[1] + func.sum(table.c.sales).over(**order)).label('running_sales'),
+        (base[2] + func.sum(table.c.purchases).over(**order)).label('running_purchases')
+    ).where(*filters, table.c.day >= first).subquery()
+    db.session.execute(table.update().where(table.c.id == running.c.id).values(
+        balance=running.c.running_balance,
+        sales_to_date=running.c.running_sales,
+        purchases_to_date=running.c.running_purchases
+    ))
+
+def add(upload_id, user_id, normalized):
+    """
+    Adds a chunk of normalized rows just inserted for `upload_id` to its
+    series and to its owner's, in the session's transaction.
+    """
+    if normalized.empty:
+        return
+    cents = (normalized['amount'].astype(float) * 100).round().astype('int64')
+    deltas = _daily(normalized['date'].to_numpy(dtype=object), normalized['type'].fillna('').to_numpy(dtype=object), cents.to_numpy())
+    _apply(deltas, upload_id, user_id)
+    _apply(deltas, None, user_id)
+
+def delete(*upload_ids, user_id=None):
+    """
+    Drops the series of uploads whose transactions are being deleted, and
+    takes them out of their owners'. Pass the owner as `user_id` when the
+    Upload rows may already be gone.
+    """
+    for upload_id in upload_ids:
+        owner = user_id
+        if owner is None:
+            owner = db.session.query(Upload.user_id).filter(Upload.id == upload_id).scalar()
+        _apply(-_stored(upload_id), None, owner)
+        DailyBalance.query.filter(DailyBalance.upload_id == upload_id).delete(synchronize_session=False)
+
+def move(source_id, target_id):
+    """Merges the series of `source_id` into `target_id` (rows of a statement refresh)."""
+    deltas = _stored(source_id)
+    source_user = db.session.query(Upload.user_id).filter(Upload.id == source_id).scalar()
+    target_user = db.session.query(Upload.user_id).filter(Upload.id == target_id).scalar()
+    DailyBalance.query.filter(DailyBalance.upload_id == source_id).delete(synchronize_session=False)
+    _apply(deltas, target_id, target_user)
+    if source_user != target_user:
+        _apply(-deltas, None, source_user)
+        _apply(deltas, None, target_user)
+
+def refresh(upload_id, days=None):
+    """
+    Brings the series of an upload, and its owner's, back in line with its
+    transactions on the listed days (default: all of them). For changes
+    that are not plain inserts (re-classification, sign flips).
+    """
+    filters = [Transaction.source_file_id == upload_id]
+    if days is not None:
+        days = sorted({_as_date(d) for d in days})
+        if not days:
+            return
+        filters.append(Transaction.date.in_(days))
+    rows = db.session.query(
+        Transaction.date, func.count(), func.sum(Transaction.amount),
+        func.sum(case((Transaction.type == 'SALE', Transaction.amount), else_=0)),
+        func.sum(case((Transaction.type == 'PURCHASE', Transaction.amount), else_=0))
+    ).filter(*filters).group_by(Transaction.date).all()
+    actual = pd.DataFrame(
+        [(count, _cents(net), _cents(sales), _cents(purchases)) for _, count, net, sales, purchases in rows],
+        index=[_as_date(r[0]) for r in rows], columns=COLUMNS, dtype='int64'
+    )
+    deltas = actual.sub(_stored(upload_id, days), fill_value=0).astype('int64').sort_index()
+    user_id = db.session.query(Upload.user_id).filter(Upload.id == upload_id).scalar()
+    _apply(deltas, upload_id, user_id)
+    _apply(deltas, None, user_id)
+
+def rebuild(upload_ids=None):
+    """
+    Rebuilds the series of the given uploads (default: all of them) and of
+    their owners from the transactions, one committed owner at a time: all
+    the owner's uploads are rebuilt with them. Returns the number of uploads
+    rebuilt.
+    """
+    uploads = Upload.query.with_entities(Upload.id, Upload.user_id).order_by(Upload.id).all()
+    if upload_ids is not None:
+        wanted = set(upload_ids)
+        owners = {u.user_id for u in uploads if u.id in wanted and u.user_id is not None}
+        uploads = [u for u in uploads if u.id in wanted or u.user_id in owners]
+    by_owner = {}
+    for upload in uploads:
+        by_owner.setdefault(upload.user_id, []).append(upload.id)
+
+    for user_id, ids in by_owner.items():
+        DailyBalance.query.filter(DailyBalance.upload_id.in_(ids)).delete(synchronize_session=False)
+        _insert_series(ids)
+        if user_id is not None:
+            DailyBalance.query.filter(DailyBalance.user_id == user_id, DailyBalance.upload_id.is_(None)).delete(synchronize_session=False)
+            _insert_series(ids, user_id)
+        db.session.commit()
+    return sum(len(ids) for ids in by_owner.values())
+
+def _insert_series(upload_ids, user_id=None):
+    """
+    Inserts the series of each of `upload_ids`, or of their owner `user_id`
+    over all of them, from their transactions with an INSERT ... SELECT.
+    """
+    if user_id is None:
+        owner, upload, keys = Transaction.user_id, Transaction.source_file_id, ('owner_key', 'upload_key', 'day_key')
+    else:
+        owner, upload, keys = db.literal(user_id, db.Integer), db.cast(db.null(), db.Integer), ('day_key',)
+    # Labels unlike the source column names: PostgreSQL reads those as input columns in GROUP BY
+    per_day = db.select(
+        owner.label('owner_key'), upload.label('upload_key'), Transaction.date.label('day_key'),
+        func.count().label('day_count'),
+        func.sum(Transaction.amount).label('day_net'),
+        func.sum(case((Transaction.type == 'SALE', Transaction.amount), else_=0)).label('day_sales'),
+        func.sum(case((Transaction.type == 'PURCHASE', Transaction.amount), else_=0)).label('day_purchases')
+    ).where(Transaction.source_file_id.in_(upload_ids))
+    per_day = per_day.group_by(*(db.text(k) for k in keys)).subquery()
+    order = {'order_by': per_day.c.day_key, 'partition_by': per_day.c.upload_key if user_id is None else None}
+    db.session.execute(DailyBalance.__table__.insert().from_select(
+        ['user_id', 'upload_id', 'day', 'count', 'net', 'sales', 'purchases', 'balance', 'sales_to_date', 'purchases_to_date'],
+        db.select(
+            per_day.c.owner_key, per_day.c.upload_key, per_day.c.day_key, per_day.c.day_count,
+            per_day.c.day_net, per_day.c.day_sales, per_day.c.day_purchases,
+            func.sum(per_day.c.day_net).over(**order),
+            func.sum(per_day.c.day_sales).over(**order),
+            func.sum(per_day.c.day_purchases).over(**order)
+        )
+    ))
+
+def _row_at(day=None, upload_id=None, user_id=None):
+    """(balance, sales, purchases) of every transaction of the scope dated up to `day` (None = all)."""
+    filters = scope(upload_id, user_id)
+    if filters is None:
+        # No series across users: sum the transactions
+        query = db.session.query(
+            func.sum(Transaction.amount),
+            func.sum(case((Transaction.type == 'SALE', Transaction.amount), else_=0)),
+            func.sum(case((Transaction.type == 'PURCHASE', Transaction.amount), else_=0))
+        )
+        row = (query.filter(Transaction.date <= day) if day is not None else query).first()
+    else:
+        query = db.session.query(DailyBalance.balance, DailyBalance.sales_to_date, DailyBalance.purchases_to_date).filter(*filters)
+        if day is not None:
+            query = query.filter(DailyBalance.day <= day)
+        row = query.order_by(DailyBalance.day.desc()).first()
+    return tuple(v or 0 for v in row) if row else (0, 0, 0)
+
+def balance_at(day=None, upload_id=None, user_id=None):
+    """Balance at the end of `day` (None = after the latest transaction): one index lookup."""
+    return _row_at(_as_date(day), upload_id, user_id)[0]
+
+def totals_between(start=None, end=None, upload_id=None, user_id=None):
+    """
+    Net flow, sales and purchases of the transactions dated from `start` to
+    `end` (both included, None = unbounded), as {'net', 'sales',
+    'purchases'}: the running totals at `end` less those before `start`,
+    two index lookups.
+    """
+    start, end = _as_date(start), _as_date(end)
+    closing = _row_at(end, upload_id, user_id)
+    opening = _row_at(start - timedelta(days=1), upload_id, user_id) if start is not None else (0, 0, 0)
+    return dict(zip(['net', 'sales', 'purchases'], (c - o for c, o in zip(closing, opening))))
+
+def opening_sql(start, upload_id=None, user_id=None):
+    """Scalar SQL expression of the balance before `start`, for statements that start from it."""
+    filters = scope(upload_id, user_id)
+    if filters is None:
+        return db.select(func.coalesce(func.sum(Transaction.amount), 0)).where(Transaction.date < start).scalar_subquery()
+    latest = db.select(DailyBalance.balance).where(*filters, DailyBalance.day < start).order_by(DailyBalance.day.desc()).limit(1)
+    return func.coalesce(latest.scalar_subquery(), 0)
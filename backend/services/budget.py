@@ -1,50 +1,98 @@
 import pandas as pd
 from models import db, Budget, Transaction
 from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from datetime import datetime
+from services.ingestion import clean_amounts
+from services.cache import cached, invalidate
 
-def import_budget(file_path):
+def parse_budget(df):
+    """
+    Normalizes a budget sheet (columns Period, Category, Amount) into
+    period (first day of the month), category, amount. Rows without a valid
+    period are dropped; lines repeating a (period, category) are summed.
+    Returns (frame, number of rows dropped).
+    """
+    df = df.rename(columns=lambda c: str(c).lower().strip())
+    if 'period' not in df.columns:
+        raise ValueError("Missing 'Period' column (YYYY-MM).")
+
+    raw = df['period']
+    if pd.api.types.is_datetime64_any_dtype(raw):
+        periods = raw
+    else:
+        # YYYY-MM first, then whatever else pandas recognizes
+        text = raw.astype(str).str.strip()
+        periods = pd.to_datetime(text, format='%Y-%m', errors='coerce')
+        missing = periods.isna()
+        if missing.any():
+            periods[missing] = pd.to_datetime(text[missing], format='mixed', dayfirst=True, errors='coerce')
+
+    if 'category' in df.columns:
+        categories = df['category'].astype(str).str.strip()
+        categories = categories.where(df['category'].notna() & (categories != ''), 'General')
+    else:
+        categories = pd.Series('General', index=df.index)
+    amounts = clean_amounts(df['amount']) if 'amount' in df.columns else pd.Series(0.0, index=df.index)
+
+    frame = pd.DataFrame({
+        'period': periods.dt.to_period('M').dt.start_time.dt.date,
+        'category': categories.str.slice(0, 50),
+        'amount': amounts.round(2)
+    })
+    valid = periods.notna()
+    frame = frame[valid].groupby(['period', 'category'], as_index=False, sort=False)['amount'].sum()
+    return frame, int((~valid).sum())
+
+def import_budget(file_path, user_id=None):
     """
     Imports budget from Excel/CSV. Expected columns: Period (YYYY-MM), Category, Amount.
+    Upserts on (user, period, category): importing a revised plan replaces
+    the amounts of the months and categories it lists instead of adding to them.
+    Returns the number of budget lines written.
     """
     if file_path.endswith('.csv'):
-        df = pd.read_csv(file_path)
+        df = pd.read_csv(file_path, sep=None, engine='python')
     else:
         df = pd.read_excel(file_path)
-        
-    # Normalize columns
-    df.columns = df.columns.str.lower().str.strip()
-    
-    # Expected keys: period, category, amount
-    budgets = []
-    for _, row in df.iterrows():
-        try:
-            period_str = str(row.get('period', ''))
-            # Handle various date formats, assume YYYY-MM or Date object
-            if isinstance(row.get('period'), datetime):
-                period_date = row['period'].date().replace(day=1)
-            else:
-                period_date = pd.to_datetime(period_str).date().replace(day=1)
-                
-            amount = pd.to_numeric(row.get('amount', 0), errors='coerce')
-            category = row.get('category', 'General')
-            
-            budgets.append(Budget(
-                period=period_date,
-                category=category,
-                amount=amount
-            ))
-        except Exception as e:
-            print(f"Skipping row: {e}")
-            continue
-            
-    db.session.bulk_save_objects(budgets)
+
+    frame, dropped = parse_budget(df)
+    if dropped:
+        print(f"Budget import: {dropped} row(s) without a valid period skipped.")
+    if frame.empty:
+        return 0
+
+    records = [
+        {'user_id': user_id, 'period': period, 'category': category, 'amount': amount}
+        for period, category, amount in zip(frame['period'], frame['category'], frame['amount'].tolist())
+    ]
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        insert = postgresql_insert if dialect == 'postgresql' else sqlite_insert
+        stmt = insert(Budget.__table__)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['user_id', 'period', 'category'],
+            set_={'amount': stmt.excluded.amount}
+        )
+        db.session.execute(stmt, records)
+    else:
+        # No portable upsert: replace the listed keys in the same transaction
+        for period in frame['period'].unique():
+            Budget.query.filter(
+                Budget.user_id == user_id,
+                Budget.period == period,
+                Budget.category.in_(frame.loc[frame['period'] == period, 'category'].tolist())
+            ).delete(synchronize_session=False)
+        db.session.execute(Budget.__table__.insert(), records)
+    invalidate(user_id)
     db.session.commit()
-    return len(budgets)
+    return len(records)
 
-def get_budget_comparison(month=None, year=None):
+@cached
+def get_budget_comparison(month=None, year=None, user_id=None):
     """
-    Compares Actual vs Budget for a specific month/year.
+    Compares Actual vs Budget for a specific month/year, for one user.
     """
     if not month or not year:
         now = datetime.utcnow()
@@ -65,13 +113,15 @@ def get_budget_comparison(month=None, year=None):
     # Actual Sales
     actual_sales = db.session.query(func.sum(Transaction.amount)).filter(
         Transaction.type == 'SALE',
-        Transaction.date >= start_date,
-        Transaction.date < end_date
+        Transaction.date >= start_date.date(), # Date bounds: SQLite compares them as text
+        Transaction.date < end_date.date(),
+        Transaction.user_id == user_id
     ).scalar() or 0
     
     # Budgeted Amount (Assuming budget is for Net Income or Sales? Let's assume Sales for positive budget)
     budgeted_amount = db.session.query(func.sum(Budget.amount)).filter(
-        Budget.period == start_date
+        Budget.user_id == user_id,
+        Budget.period == start_date.date()
     ).scalar() or 0
     
     return {
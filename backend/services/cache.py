@@ -0,0 +1,254 @@
+import hashlib
+import inspect
+import pickle
+import logging
+import functools
+import threading
+from collections import OrderedDict
+from datetime import date, datetime
+from flask import current_app, has_app_context
+from models import db, User, Upload
+
+try:
+    import redis
+except ImportError: # Optional: only the 'redis' backend needs it
+    redis = None
+
+log = logging.getLogger(__name__)
+
+# Parameter values a cache key can be built from; other calls are not cached
+KEY_TYPES = (type(None), bool, int, float, str, date)
+
+class MemoryBackend:
+    """
+    Entries of this process, least recently used evicted first once there
+    are more than `max_entries` or their pickles exceed `max_bytes`.
+    """
+    name = 'memory'
+
+    def __init__(self, max_entries=2048, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= len(previous)
+            self.entries[key] = value
+            self.bytes += len(value)
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= len(evicted)
+                self.evictions += 1
+
+    def delete_prefix(self, prefix):
+        with self.lock:
+            for key in [k for k in self.entries if k.startswith(prefix)]:
+                self.bytes -= len(self.entries.pop(key))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries), 'bytes': self.bytes, 'evictions': self.evictions,
+                'max_entries': self.max_entries, 'max_bytes': self.max_bytes
+            }
+
+class RedisBackend:
+    """
+    Entries shared by every process using the same Redis. Eviction is
+    Redis's own: give it a maxmemory with an LRU policy (allkeys-lru).
+    Entries also expire after `ttl` seconds.
+    """
+    name = 'redis'
+    PREFIX = 'result-cache:'
+
+    def __init__(self, url, ttl=86400):
+        if redis is None:
+            raise RuntimeError("The 'redis' result cache backend needs the redis package (pip install redis).")
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key):
+        return self.client.get(self.PREFIX + key)
+
+    def set(self, key, value):
+        self.client.set(self.PREFIX + key, value, ex=self.ttl)
+
+    def delete_prefix(self, prefix):
+        keys = list(self.client.scan_iter(match=self.PREFIX + prefix + '*', count=1000))
+        if keys:
+            self.client.delete(*keys)
+
+    def clear(self):
+        self.delete_prefix('')
+
+    def stats(self):
+        return {
+            'entries': sum(1 for _ in self.client.scan_iter(match=self.PREFIX + '*', count=1000)),
+            'bytes': self.client.info('memory').get('used_memory'), # Whole Redis instance
+            'ttl': self.ttl
+        }
+
+class ResultCache:
+    """
+    Pickled results in a backend, with hit and miss counters (per process).
+    A backend error is logged and the result computed as if uncached.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def get(self, key):
+        try:
+            value = self.backend.get(key)
+        except Exception as e:
+            self.errors += 1
+            log.warning("Result cache read failed: %s", e)
+            return None
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return pickle.loads(value) # A copy: callers may modify what they get
+
+    def set(self, key, result):
+        try:
+            self.backend.set(key, pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+        except Exception as e:
+            self.errors += 1
+            log.warning("Result cache write failed: %s", e)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        stats = {
+            'backend': self.backend.name,
+            'hits': self.hits,
+            'misses': self.misses,
+            'errors': self.errors,
+            'hit_ratio': round(self.hits / lookups, 4) if lookups else None
+        }
+        try:
+            stats.update(self.backend.stats())
+        except Exception as e:
+            stats['error'] = str(e)
+        return stats
+
+def init_app(app):
+    """
+    Sets up the result cache of RESULT_CACHE_BACKEND ('memory', 'redis' or
+    'none') as app.extensions['result_cache'].
+    """
+    kind = app.config.get('RESULT_CACHE_BACKEND', 'memory')
+    if kind == 'memory':
+        backend = MemoryBackend(app.config['RESULT_CACHE_MAX_ENTRIES'], app.config['RESULT_CACHE_MAX_BYTES'])
+    elif kind == 'redis':
+        backend = RedisBackend(app.config['RESULT_CACHE_REDIS_URL'], app.config['RESULT_CACHE_TTL'])
+    elif kind == 'none':
+        backend = None
+    else:
+        raise ValueError(f"Unknown RESULT_CACHE_BACKEND: {kind}")
+    app.extensions['result_cache'] = ResultCache(backend) if backend else None
+    return app.extensions['result_cache']
+
+def current():
+    """Result cache of the current app, None if disabled or outside an app context."""
+    if not has_app_context():
+        return None
+    return current_app.extensions.get('result_cache')
+
+def data_version(user_id):
+    """
+    Token of the current state of a user's data, None if there is no such
+    user. Changes with every invalidate(); the creation time keeps a user
+    recreated under the same id from reading the former one's entries.
+    """
+    row = db.session.query(User.data_version, User.created_at).filter(User.id == user_id).first()
+    if row is None:
+        return None
+    return f"{row.data_version or 0}.{row.created_at.timestamp() if row.created_at else 0}"
+
+def invalidate(user_id=None, upload_id=None):
+    """
+    Bumps the data version of a user, or of the owner of an upload, in the
+    session's transaction: once committed, results cached before are no
+    longer read, by any process. Call it with every change to their
+    transactions or budgets.
+    """
+    if user_id is None and upload_id is not None:
+        user_id = db.session.query(Upload.user_id).filter(Upload.id == upload_id).scalar()
+    if user_id is None:
+        return
+    db.session.execute(
+        db.update(User).where(User.id == user_id)
+        .values(data_version=db.func.coalesce(User.data_version, 0) + 1)
+    )
+
+def forget(user_id):
+    """Drops the cached results of a user (deleted user), to free the space early."""
+    cache = current()
+    if cache:
+        try:
+            cache.backend.delete_prefix(f"{user_id}:")
+        except Exception as e:
+            log.warning("Result cache cleanup failed: %s", e)
+
+def _keyable(value):
+    if isinstance(value, (list, tuple)):
+        return all(isinstance(v, KEY_TYPES) for v in value)
+    return isinstance(value, KEY_TYPES)
+
+def cached(func):
+    """
+    Caches the results of a service function taking `user_id`, keyed by the
+    user's data version, today's date (for rolling windows) and the call's
+    parameters. Calls without a user, or with parameters other than plain
+    values (precomputed results), are not cached.
+    """
+    name = f"{func.__module__}.{func.__name__}"
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        cache = current()
+        if cache is None:
+            return func(*args, **kwargs)
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        params = bound.arguments
+        user_id = params.get('user_id')
+        if user_id is None or not all(_keyable(v) for v in params.values()):
+            return func(*args, **kwargs)
+        version = data_version(user_id)
+        if version is None:
+            return func(*args, **kwargs)
+
+        digest = hashlib.sha1(repr(sorted(params.items())).encode('utf-8')).hexdigest()
+        key = f"{user_id}:{version}:{datetime.utcnow().date().isoformat()}:{name}:{digest}"
+        result = cache.get(key)
+        if result is None:
+            result = func(*args, **kwargs)
+            cache.set(key, result)
+        return result
+
+    return wrapper
@@ -0,0 +1,88 @@
+import json
+import os
+import re
+import numpy as np
+import pandas as pd
+
+# Keyword sets used to type and categorize transactions
+KEYWORDS_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'keywords.json')
+
+class KeywordMatcher:
+    """
+    Ordered (label, keywords) pairs compiled once into a single regex.
+    A text gets the first label, in the given order, having a keyword contained
+    in it, whatever the keyword's position in the text.
+    """
+    def __init__(self, labels):
+        self.labels = []
+        branches = []
+        keywords = []
+        for label, words in labels:
+            words = [w.lower() for w in words if w]
+            if not words:
+                continue
+            alternation = '|'.join(re.escape(w) for w in words)
+            # One lookahead per label: branches are tried in label order
+            branches.append(f'(?=.*?(?:{alternation}))(?P<g{len(self.labels)}>)')
+            self.labels.append(label)
+            keywords.extend(words)
+
+        self.pattern = '^(?:' + '|'.join(branches) + ')' if branches else None
+        self.any_pattern = '|'.join(re.escape(w) for w in keywords) if keywords else None
+        self._regex = re.compile(self.pattern, re.DOTALL) if self.pattern else None
+        self._any_regex = re.compile(self.any_pattern) if self.any_pattern else None
+
+    def match(self, text):
+        """
+        Label for a single lowercase text, or None.
+        """
+        m = self._regex.match(text) if self._regex else None
+        if not m:
+            return None
+        return self.labels[int(m.lastgroup[1:])]
+
+    def contains_any(self, texts):
+        """
+        Boolean mask: does each lowercase text contain any keyword.
+        """
+        if not self._any_regex:
+            return pd.Series(False, index=texts.index)
+
+        codes, uniques = pd.factorize(texts)
+        found = pd.Series(uniques, dtype=object).str.contains(self.any_pattern, regex=True).to_numpy(dtype=bool)
+        return pd.Series(np.where(codes >= 0, found[codes], False), index=texts.index)
+
+    def classify(self, texts, default=None):
+        """
+        Labels a whole column of lowercase texts. Each distinct text goes through
+        the regex once.
+        """
+        codes, uniques = pd.factorize(texts)
+        if self._regex is None or len(uniques) == 0:
+            return pd.Series(default, index=texts.index, dtype=object)
+
+        matched = pd.Series(uniques, dtype=object).str.extract(self.pattern, flags=re.DOTALL).notna().to_numpy()
+        first = np.where(matched.any(axis=1), matched.argmax(axis=1), len(self.labels))
+
+        choices = np.array(self.labels + [default], dtype=object)
+        labels = choices[first]
+        # Missing texts (code -1) get the default
+        result = np.where(codes >= 0, labels[codes], default)
+        return pd.Series(result, index=texts.index, dtype=object)
+
+def load_keywords(path=None):
+    """
+    Reads the keyword sets: {'expense': [...], 'categories': [{'name', 'keywords'}, ...]}.
+    Category order is the matching precedence.
+    """
+    with open(path or KEYWORDS_FILE, encoding='utf-8') as f:
+        data = json.load(f)
+
+    expense = [k.lower() for k in data.get('expense', [])]
+    categories = {c['name']: [k.lower() for k in c.get('keywords', [])] for c in data.get('categories', [])}
+    return expense, categories
+
+EXPENSE_KEYWORDS, CATEGORY_KEYWORDS = load_keywords()
+
+EXPENSE_MATCHER = KeywordMatcher([('PURCHASE', EXPENSE_KEYWORDS)])
+CATEGORY_MATCHER = KeywordMatcher(list(CATEGORY_KEYWORDS.items()))
@@ -0,0 +1,203 @@
+import pandas as pd
+from datetime import datetime, timedelta
+from sqlalchemy import func
+from models import db, Transaction, MonthlyRollup
+from services.kpi import summarize_advanced_kpis
+from services.forecast import project_forecast
+from services.analysis import generate_analysis
+from services import rollups
+from services.cache import cached
+
+# Sections of /dashboard/bundle, each the payload of the endpoint of the same name
+SECTIONS = ['stats', 'advanced_kpis', 'cashflow', 'monthly', 'annual', 'top_expenses', 'top_income', 'forecast', 'analysis']
+
+def _scope(upload_id=None, user_id=None):
+    if upload_id:
+        return Transaction.source_file_id == upload_id
+    if user_id:
+        return Transaction.user_id == user_id
+    return db.true()
+
+def _cents(value):
+    # Numeric(15, 2) sums as exact integers, then back to floats at the end
+    return int(round(value * 100)) if value is not None else 0
+
+def aggregate(upload_id=None, user_id=None):
+    """
+    The aggregation every dashboard section is derived from, in one
+    statement: net amount per (day, type), and per (type, category) for
+    sales and purchases (from the monthly rollup). Returns (daily, categories) DataFrames with amounts
+    in cents.
+    """
+    scope = _scope(upload_id, user_id)
+    total = func.sum(Transaction.amount).label('total')
+    daily = db.select(
+        db.literal(0).label('kind'), Transaction.date.label('day'), Transaction.type,
+        db.null().label('category'), total
+    ).where(scope).group_by(Transaction.date, Transaction.type)
+    categories = db.select(
+        db.literal(1).label('kind'), db.null().label('day'), MonthlyRollup.type,
+        MonthlyRollup.category, func.sum(MonthlyRollup.total).label('total')
+    ).where(*rollups.scope(upload_id, user_id), MonthlyRollup.type.in_(['SALE', 'PURCHASE'])).group_by(MonthlyRollup.type, MonthlyRollup.category)
+
+    rows = db.session.execute(db.union_all(daily, categories)).all()
+    days = pd.DataFrame(
+        [(r.day, r.type, _cents(r.total)) for r in rows if r.kind == 0],
+        columns=['day', 'type', 'cents']
+    )
+    days['day'] = pd.to_datetime(days['day'])
+    by_category = pd.DataFrame(
+        [(r.type, r.category, _cents(r.total)) for r in rows if r.kind == 1],
+        columns=['type', 'category', 'cents']
+    )
+    return days, by_category
+
+def _extremes(upload_id=None, user_id=None):
+    """Largest purchase and largest sale, as in get_advanced_kpis."""
+    columns = [Transaction.amount, Transaction.description, Transaction.date, Transaction.category]
+    scope = _scope(upload_id, user_id)
+    # Literal types, for SQLite to pick the partial indexes (see models.Transaction)
+    purchase, sale = db.literal('PURCHASE', literal_execute=True), db.literal('SALE', literal_execute=True)
+    largest_expense = db.session.query(*columns).filter(scope, Transaction.type == purchase).order_by(Transaction.amount.asc()).first()
+    largest_income = db.session.query(*columns).filter(scope, Transaction.type == sale).order_by(Transaction.amount.desc()).first()
+    return largest_expense, largest_income
+
+def _income_expense(days):
+    sales = days['cents'].where(days['type'] == 'SALE', 0)
+    purchases = days['cents'].where(days['type'] == 'PURCHASE', 0)
+    return sales, purchases
+
+def _breakdown(days, period_format):
+    """
+    Income, expense and margin per period; periods with any transaction are
+    listed. Each is divided by 100 once, from the summed cents.
+    """
+    sales, purchases = _income_expense(days)
+    grouped = pd.DataFrame({
+        'period': days['day'].dt.strftime(period_format),
+        'income': sales,
+        'expense': purchases
+    }).groupby('period', sort=True).sum()
+    return [
+        (r.Index, float(r.income / 100), float(r.expense / 100), float((r.income + r.expense) / 100))
+        for r in grouped.itertuples()
+    ]
+
+def _top(by_category, type_, limit, ascending):
+    rows = by_category[by_category['type'] == type_].groupby('category', dropna=False)['cents'].sum()
+    rows = rows.sort_values(ascending=ascending, kind='stable')
+    if limit and limit > 0:
+        rows = rows.head(limit)
+    return [
+        {
+            "category": category if isinstance(category, str) and category and category != 'nan' else 'Uncategorized',
+            "amount": abs(cents / 100) if type_ == 'PURCHASE' else cents / 100
+        }
+        for category, cents in rows.items()
+    ]
+
+def _period_labels(days, granularity):
+    """Bucket labels of the days, as kpi.get_cash_flow_history() gives them."""
+    if granularity == 'week':
+        return (days - pd.to_timedelta(days.dt.weekday, unit='D')).dt.strftime('%Y-%m-%d')
+    if granularity == 'quarter':
+        return days.dt.year.astype(str) + '-Q' + days.dt.quarter.astype(str)
+    return days.dt.strftime('%Y-%m-%d' if granularity == 'day' else '%Y-%m')
+
+@cached
+def build_bundle(sections=None, upload_id=None, user_id=None, year=None, granularity='day', limit=0, months=6, start=None, end=None):
+    """
+    Computes the requested dashboard sections (default: all of SECTIONS) from
+    a single aggregation query, plus one query per largest transaction when
+    advanced_kpis or analysis is requested. Each section has the same shape
+    as the endpoint of the same name; `year`, `granularity`, `start`, `end` (cashflow),
+    `limit` (top_expenses/top_income) and `months` (forecast) are their
+    parameters.
+    """
+    sections = [s for s in (sections or SECTIONS) if s in SECTIONS]
+    days, by_category = aggregate(upload_id, user_id)
+    now = datetime.utcnow()
+    bundle = {}
+
+    if not year:
+        year = int(days['day'].max().year) if not days.empty else now.year
+    year_start, year_end = pd.Timestamp(year, 1, 1), pd.Timestamp(year + 1, 1, 1)
+    in_year = days[(days['day'] >= year_start) & (days['day'] < year_end)]
+    sales, purchases = _income_expense(days)
+    balance = days['cents'].sum() / 100
+
+    stats = None
+    if 'stats' in sections or 'analysis' in sections:
+        window = (days['day'] >= pd.Timestamp(2000, 1, 1)) & (days['day'] <= pd.Timestamp(now))
+        total_sales = sales[window].sum()
+        total_purchases = purchases[window].sum()
+        stats = {
+            "total_sales": float(total_sales / 100),
+            "total_purchases": float(total_purchases / 100),
+            "margin": float((total_sales + total_purchases) / 100),
+            "current_balance": float(balance)
+        }
+        if 'stats' in sections:
+            bundle['stats'] = stats
+
+    advanced = None
+    if 'advanced_kpis' in sections or 'analysis' in sections:
+        last_year = days['day'] >= pd.Timestamp(now - timedelta(days=365))
+        advanced = summarize_advanced_kpis(
+            float(sales[last_year].sum() / 100), float(purchases[last_year].sum() / 100),
+            *_extremes(upload_id, user_id)
+        )
+        if 'advanced_kpis' in sections:
+            bundle['advanced_kpis'] = advanced
+
+    if 'cashflow' in sections:
+        # As kpi.cash_flow_range(): the given bounds, else the year
+        if start or end:
+            low = pd.Timestamp(start) if start else None
+            in_range = days
+            if start:
+                in_range = in_range[in_range['day'] >= low]
+            if end:
+                in_range = in_range[in_range['day'] <= pd.Timestamp(end)]
+        else:
+            low, in_range = year_start, in_year
+        net = in_range.groupby(_period_labels(in_range['day'], granularity), sort=True)['cents'].sum()
+        cumulative = days.loc[days['day'] < low, 'cents'].sum() if low is not None else 0
+        history = []
+        for period, cents in net.items():
+            cumulative += cents
+            history.append({"date": period, "net_flow": float(cents / 100), "balance": float(cumulative / 100)})
+        bundle['cashflow'] = history
+
+    if 'monthly' in sections:
+        bundle['monthly'] = [{
+            "month": month,
+            "income": income,
+            "expense": expense,
+            "margin": margin,
+            "margin_pct": round(margin / income * 100 if income > 0 else 0, 2)
+        } for month, income, expense, margin in _breakdown(in_year, '%Y-%m')]
+
+    if 'annual' in sections:
+        bundle['annual'] = [{
+            "year": y,
+            "income": income,
+            "expense": expense,
+            "margin": margin
+        } for y, income, expense, margin in _breakdown(days, '%Y')]
+
+    if 'top_expenses' in sections:
+        bundle['top_expenses'] = _top(by_category, 'PURCHASE', limit, ascending=True)
+    if 'top_income' in sections:
+        bundle['top_income'] = _top(by_category, 'SALE', limit, ascending=False)
+
+    if 'forecast' in sections:
+        history = [{"month": m, "income": i, "expense": e} for m, i, e, _ in _breakdown(days, '%Y-%m')]
+        bundle['forecast'] = project_forecast(history, balance, months) if history else []
+
+    if 'analysis' in sections:
+        bundle['analysis'] = generate_analysis(
+            upload_id=upload_id, user_id=user_id, stats=stats, adv_stats=advanced,
+            top_expenses=_top(by_category, 'PURCHASE', 100, ascending=True)
+        )
+    return bundle
@@ -1,26 +1,19 @@
-from models import db, Transaction, Upload
+from models import db, MonthlyRollup
 from sqlalchemy import func, case
 from datetime import datetime, timedelta
 import pandas as pd
 import numpy as np
-from utils import format_date_sql
+from services import balances, rollups
+from services.cache import cached
 
+@cached
 def generate_forecast(months=6, upload_id=None, user_id=None):
-    # 1. Get historical monthly data
-    query = db.session.query(
-        format_date_sql(Transaction.date, '%Y-%m').label('month'),
-        func.sum(case((Transaction.type == 'SALE', Transaction.amount), else_=0)).label('income'),
-        func.sum(case((Transaction.type == 'PURCHASE', Transaction.amount), else_=0)).label('expense')
-    )
-    
-    if upload_id:
-        query = query.filter(Transaction.source_file_id == upload_id)
-    elif user_id:
-        query = query.filter(Transaction.source_file_id.in_(
-            db.session.query(Upload.id).filter(Upload.user_id == user_id)
-        ))
-        
-    historical_data = query.group_by('month').order_by('month').all()
+    # 1. Get historical monthly data (monthly rollup, see services/rollups.py)
+    historical_data = db.session.query(
+        MonthlyRollup.month,
+        func.sum(case((MonthlyRollup.type == 'SALE', MonthlyRollup.total), else_=0)).label('income'),
+        func.sum(case((MonthlyRollup.type == 'PURCHASE', MonthlyRollup.total), else_=0)).label('expense')
+    ).filter(*rollups.scope(upload_id, user_id)).group_by(MonthlyRollup.month).order_by(MonthlyRollup.month).all()
     
     if not historical_data:
         return []
@@ -33,7 +26,16 @@ def generate_forecast(months=6, upload_id=None, user_id=None):
             "income": float(r.income or 0),
             "expense": float(r.expense or 0)
         })
-    
+
+    # Get current balance
+    current_balance = balances.balance_at(None, upload_id=upload_id, user_id=user_id)
+    return project_forecast(data, current_balance, months)
+
+def project_forecast(data, current_balance, months=6):
+    """
+    Projects `months` months from the monthly history (list of
+    {month 'YYYY-MM', income, expense}, in order) and the current balance.
+    """
     # 2. Calculate Seasonality & Trends
     # Simple approach: Calculate average income/expense for each month (1-12)
     monthly_avg = {} # { 1: {income: X, expense: Y, count: N}, ... }
@@ -61,17 +63,6 @@ def generate_forecast(months=6, upload_id=None, user_id=None):
     last_month_str = data[-1]['month']
     last_date = datetime.strptime(last_month_str, '%Y-%m')
     
-    # Get current balance
-    balance_query = db.session.query(func.sum(Transaction.amount))
-    if upload_id:
-        balance_query = balance_query.filter(Transaction.source_file_id == upload_id)
-    elif user_id:
-        balance_query = balance_query.filter(Transaction.source_file_id.in_(
-            db.session.query(Upload.id).filter(Upload.user_id == user_id)
-        ))
-
-    current_balance = balance_query.scalar() or 0
-    
     forecast = []
     running_balance = float(current_balance)
     
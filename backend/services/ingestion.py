@@ -1,7 +1,57 @@
 import pandas as pd
+import numpy as np
 from datetime import datetime
 import re
+import os
+import io
+import csv
+import codecs
+import logging
+from collections import Counter
 from models import db, Transaction, Upload
+from services import balances, cache, profiles, progress, rollups, snapshots, rules as category_rules
+from services.classification import EXPENSE_KEYWORDS, CATEGORY_KEYWORDS, EXPENSE_MATCHER, CATEGORY_MATCHER
+
+log = logging.getLogger(__name__)
+
+# Rows read, normalized and committed at a time by process_file
+CHUNK_SIZE = int(os.getenv('INGESTION_CHUNK_SIZE', 50000))
+
+# Explicit date formats tried on string columns, with the shape a cell must
+# have to be converted with it. Cells of any other shape use parse_date, so
+# ambiguous layouts (yyyy/mm/dd, 2-digit years...) keep their dayfirst result.
+DATE_FORMATS = [
+    ('%Y-%m-%d', r'\d{4}-\d{2}-\d{2}$'),
+    ('ISO8601', r'\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}(:\d{2}(\.\d+)?)?$'),
+    ('%d/%m/%Y', r'\d{1,2}/\d{1,2}/\d{4}$'),
+    ('%d/%m/%Y %H:%M', r'\d{1,2}/\d{1,2}/\d{4} \d{1,2}:\d{2}$'),
+    ('%d/%m/%Y %H:%M:%S', r'\d{1,2}/\d{1,2}/\d{4} \d{1,2}:\d{2}:\d{2}$'),
+    ('%d-%m-%Y', r'\d{1,2}-\d{1,2}-\d{4}$'),
+    ('%d.%m.%Y', r'\d{1,2}\.\d{1,2}\.\d{4}$'),
+]
+# Cells looked at to pick the format of a column
+DATE_SAMPLE_SIZE = 200
+
+# Bytes looked at to pick the read_csv options of a CSV file
+SNIFF_BYTES = 64 * 1024
+CSV_DELIMITERS = ';,\t|'
+# Mapped columns read as text: no type inference on them
+TEXT_COLUMNS = ['description', 'third_party', 'category']
+
+# Leading rows of a sheet searched for the header (title rows sit above it)
+EXCEL_HEADER_SCAN = 30
+
+# Regex patterns for column detection, one compiled alternation per standard key
+COLUMN_PATTERNS = {
+    'date': [r'date', r'dt', r'jour', r'période'],
+    'description': [r'libellé', r'label', r'description', r'motif', r'memo', r'écriture'],
+    'amount': [r'montant', r'amount', r'net'], # Removed 'solde' to avoid confusion with Balance or "Date de solde"
+    'debit': [r'debit', r'débit'],
+    'credit': [r'credit', r'crédit'],
+    'third_party': [r'tiers', r'third.*party', r'client', r'fournisseur', r'nom', r'name', r'compte.*tiers'],
+    'category': [r'catégorie', r'category', r'compte.*général', r'famille']
+}
+COMPILED_COLUMN_PATTERNS = {key: re.compile('|'.join(patterns)) for key, patterns in COLUMN_PATTERNS.items()}
 
 def normalize_columns(df):
     """
@@ -10,17 +60,6 @@ def normalize_columns(df):
     """
     df.columns = df.columns.str.lower().str.strip()
     
-    # Regex patterns for column detection
-    patterns = {
-        'date': [r'date', r'dt', r'jour', r'période'],
-        'description': [r'libellé', r'label', r'description', r'motif', r'memo', r'écriture'],
-        'amount': [r'montant', r'amount', r'net'], # Removed 'solde' to avoid confusion with Balance or "Date de solde"
-        'debit': [r'debit', r'débit'],
-        'credit': [r'credit', r'crédit'],
-        'third_party': [r'tiers', r'third.*party', r'client', r'fournisseur', r'nom', r'name', r'compte.*tiers'],
-        'category': [r'catégorie', r'category', r'compte.*général', r'famille']
-    }
-    
     normalized_cols = {}
     used_columns = set()
     
@@ -28,19 +67,35 @@ def normalize_columns(df):
     priority_keys = ['date', 'debit', 'credit', 'amount', 'description', 'third_party', 'category']
     
     for standard in priority_keys:
-        regex_list = patterns.get(standard, [])
+        pattern = COMPILED_COLUMN_PATTERNS[standard]
         for col in df.columns:
-            if col in used_columns:
-                continue
+            if col in used_columns or col.startswith('unnamed:'):
+                continue # Blank header cells are named 'Unnamed: n' by pandas
                 
             # Check if column matches any pattern for this standard key
-            if any(re.search(p, col) for p in regex_list):
+            if pattern.search(col):
                 normalized_cols[standard] = col
                 used_columns.add(col)
                 break # Found a match for this key, move to next key
     
     return normalized_cols
 
+def resolve_columns(df, user_id=None):
+    """
+    normalize_columns behind the header-fingerprint cache: a header row already
+    seen (by this user, or as a global profile) reuses its stored mapping and
+    date format without running detection.
+    Returns (mapping, profile or None, fingerprint).
+    """
+    df.columns = df.columns.str.lower().str.strip()
+    fingerprint = profiles.header_fingerprint(df.columns)
+
+    profile = profiles.lookup(fingerprint, user_id)
+    if profile and all(col in df.columns for col in profile['mapping'].values()):
+        return dict(profile['mapping']), profile, fingerprint
+
+    return normalize_columns(df), None, fingerprint
+
 def parse_amount(row, cols):
     """
     Calculates the signed amount from the row.
@@ -75,22 +130,6 @@ def determine_type(amount, description):
     """
     description = str(description).lower()
     
-    # List of keywords that strongly indicate an expense
-    # List of keywords that strongly indicate an expense
-    expense_keywords = [
-        'achat', 'payment', 'paiement', 'prélèvement', 'prelevement', 'carte', 'cb', 
-        'retrait', 'commission', 'frais', 'cotisation', 'assurance', 'mutuelle',
-        'loyer', 'edf', 'engie', 'eau', 'orange', 'sfr', 'bouygues', 'free',
-        'amazon', 'cdiscount', 'fnac', 'darty', 'boulanger', 'leroy merlin', 'castorama',
-        'ikea', 'decathlon', 'uber', 'sncf', 'train', 'avion', 'hotel', 'restaurant',
-        'mcdo', 'burger', 'kfc', 'subway', 'starbucks', 'carrefour', 'leclerc', 'auchan',
-        'lidl', 'intermarché', 'monoprix', 'franprix', 'casino', 'super u', 'hyper u',
-        'impôt', 'taxe', 'urssaf', 'rsi', 'cipav', 'tva', 'solde', 'consommable', 
-        'honoraire', 'main d\'oeuvre', 'prestation', 'facture', 'charge', 'fourniture',
-        'entretien', 'réparation', 'maintenance', 'emprunt', 'crédit', 'agios', 'banque',
-        'salaire', 'paie', 'virement'
-    ]
-    
     # If amount is already negative, it's definitely a purchase
     if amount < 0:
         return 'PURCHASE', amount
@@ -98,7 +137,7 @@ def determine_type(amount, description):
     # If amount is positive, check if it's actually an expense disguised as positive
     if amount > 0:
         # Check for expense keywords
-        if any(keyword in description for keyword in expense_keywords):
+        if any(keyword in description for keyword in EXPENSE_KEYWORDS):
             return 'PURCHASE', -amount # Flip sign to negative
             
         return 'SALE', amount # Default to Sale/Income
@@ -110,126 +149,851 @@ def auto_categorize(description):
     Assigns a category based on keywords in the description.
     """
     desc = description.lower()
-    keywords = {
-        'Logement': ['loyer', 'immobilier', 'housing', 'rent'],
-        'Alimentation': ['carrefour', 'leclerc', 'auchan', 'lidl', 'courses', 'restaurant', 'mcdo', 'burger', 'food'],
-        'Transport': ['uber', 'sncf', 'train', 'essence', 'total', 'shell', 'parking', 'péage'],
-        'Santé': ['pharmacie', 'docteur', 'médecin', 'hopital', 'mutuelle'],
-        'Loisirs': ['netflix', 'spotify', 'cinéma', 'vacances', 'voyage', 'hotel'],
-        'Salaire': ['salaire', 'virement', 'paie', 'income'],
-        'Services': ['edf', 'engie', 'internet', 'orange', 'sfr', 'bouygues', 'free', 'abonnement']
-    }
-    
-    for category, tags in keywords.items():
+    for category, tags in CATEGORY_KEYWORDS.items():
         if any(tag in desc for tag in tags):
             return category
             
     return 'Autre'
 
-def process_file(file_path, upload_id):
+def parse_date(value):
     """
-    Reads file, normalizes data, and saves transactions to DB.
-    Supports: .csv, .xlsx
+    Parses a single date cell. Returns a datetime.date, or None if the value
+    cannot be interpreted as a date.
     """
+    if pd.isna(value):
+        return None
+
     try:
-        if file_path.endswith('.csv'):
+        # Handle various date formats including Excel serial dates
+        if isinstance(value, (int, float)):
+            # Excel serial date
+            return pd.to_datetime(value, unit='D', origin='1899-12-30').date()
+
+        # Check if it looks like YYYY-MM-DD
+        str_val = str(value)
+        if re.match(r'\d{4}-\d{2}-\d{2}', str_val):
+            return pd.to_datetime(value).date() # ISO format, no dayfirst
+        return pd.to_datetime(value, dayfirst=True).date()
+    except Exception:
+        return None # Invalid date
+
+def _as_text(series):
+    """
+    Casts a column to stripped strings the same way str(value).strip() does,
+    missing values included ('nan').
+    """
+    values = series.astype(object)
+    values = values.where(values.notna(), 'nan')
+    return values.astype(str).str.strip()
+
+def infer_date_format(values, sample_size=None):
+    """
+    Picks the DATE_FORMATS entry whose shape matches most of the first
+    non-empty cells of a string column. Returns (format, shape) or (None, None).
+    """
+    sample = values.dropna().head(sample_size or DATE_SAMPLE_SIZE)
+    if sample.empty:
+        return None, None
+
+    best, best_score = (None, None), 0
+    for fmt, shape in DATE_FORMATS:
+        score = int(sample.str.match(shape).sum())
+        if score > best_score:
+            best, best_score = (fmt, shape), score
+    return best
+
+def parse_dates(series, report=None, date_format=None):
+    """
+    Column-wise version of parse_date.
+    String columns are converted in one call with the format inferred from a
+    sample (or `date_format`, a DATE_FORMATS entry known in advance); cells
+    that do not fit it go through parse_date (slow path), once per distinct
+    value. If `report` is a dict, it receives the chosen 'format' and adds up
+    the 'fallback' and 'invalid' row counts.
+    """
+    if report is None:
+        report = {}
+    report.setdefault('fallback', 0)
+    report.setdefault('invalid', 0)
+
+    if pd.api.types.is_datetime64_any_dtype(series):
+        report['format'] = 'datetime'
+        return series.dt.date.astype(object).where(series.notna(), None)
+
+    if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+        # Whole column is Excel serial dates
+        report['format'] = 'excel-serial'
+        parsed = pd.to_datetime(series, unit='D', origin='1899-12-30', errors='coerce')
+        report['invalid'] += int((parsed.isna() & series.notna()).sum())
+        return parsed.dt.date.astype(object).where(parsed.notna(), None)
+
+    dates = pd.Series(None, index=series.index, dtype=object)
+    present = series.notna()
+    todo = present
+
+    if pd.api.types.infer_dtype(series, skipna=True) == 'string':
+        shape = dict(DATE_FORMATS).get(date_format)
+        fmt = date_format if shape else None
+        if not fmt:
+            fmt, shape = infer_date_format(series)
+        if fmt:
+            report['format'] = fmt
+            candidates = present & series.str.match(shape).fillna(False).astype(bool)
+            parsed = pd.to_datetime(series[candidates], format=fmt, errors='coerce')
+            parsed = parsed[parsed.notna()]
+            dates[parsed.index] = parsed.dt.date.astype(object)
+            todo = present & dates.isna()
+
+    # Slow path: mixed cells or values that do not fit the inferred format
+    if todo.any():
+        slow = series[todo]
+        report['fallback'] += len(slow)
+        lookup = {value: parse_date(value) for value in slow.unique()}
+        parsed = slow.map(lookup)
+        parsed = parsed[parsed.notna()]
+        dates[parsed.index] = parsed
+        report['invalid'] += len(slow) - len(parsed)
+
+    return dates.where(dates.notna(), None)
+
+def clean_amounts(series):
+    """
+    Converts an amount column to floats.
+    String cells are stripped of currency symbols and (non-breaking) spaces and
+    use ',' as decimal separator, e.g. '1 234,56 €' -> 1234.56.
+    Unparseable or empty cells become 0.
+    """
+    if not pd.api.types.is_numeric_dtype(series):
+        try:
+            cleaned = series.str.replace('€', '', regex=False) \
+                            .str.replace('$', '', regex=False) \
+                            .str.replace('[ \u00a0\u202f]', '', regex=True) \
+                            .str.replace(',', '.', regex=False)
+            # Non-string cells of object columns come back as NaN: keep the original
+            series = cleaned.where(cleaned.notna(), series)
+        except AttributeError:
+            pass # Object column without any string cell
+    return pd.to_numeric(series, errors='coerce').astype(float).fillna(0.0)
+
+def parse_amounts(df, cols):
+    """
+    Column-wise version of parse_amount.
+    """
+    if 'debit' in cols and 'credit' in cols:
+        # Credit = Money In (+), Debit = Money Out (-)
+        return clean_amounts(df[cols['credit']]) - clean_amounts(df[cols['debit']])
+    if 'amount' in cols:
+        return clean_amounts(df[cols['amount']])
+    return pd.Series(0.0, index=df.index)
+
+def determine_types(amounts, descriptions):
+    """
+    Column-wise version of determine_type.
+    Returns a tuple (types, corrected_amounts).
+    """
+    is_expense = amounts > 0
+    is_expense &= EXPENSE_MATCHER.contains_any(descriptions.str.lower())
+
+    types = np.select(
+        [amounts < 0, is_expense, amounts > 0],
+        ['PURCHASE', 'PURCHASE', 'SALE'],
+        default='OTHER'
+    )
+    corrected = amounts.where(~is_expense, -amounts) # Flip sign to negative
+    return pd.Series(types, index=amounts.index), corrected
+
+def auto_categorize_column(descriptions):
+    """
+    Column-wise version of auto_categorize. First matching category wins.
+    """
+    return CATEGORY_MATCHER.classify(descriptions.str.lower(), default='Autre')
+
+def normalize_frame(df, cols, report=None, date_format=None, since=None, rules=None):
+    """
+    Turns a raw statement DataFrame into normalized transaction columns:
+    date, description, amount, type, category, third_party.
+    Rows without a valid date or with a zero amount are dropped.
+    With `since` (a date), older rows are dropped right after date parsing,
+    before the rest of the row is parsed, and counted in report['older'].
+    `report` (optional dict) accumulates the parse_dates counters and 'skipped'.
+    `rules` (a services.rules.RuleSet) overrides category and type where its
+    rules match, and adds rule_id, original_type and original_amount columns.
+    """
+    if report is None:
+        report = {}
+    dates = parse_dates(df[cols['date']], report, date_format)
+
+    if since is not None:
+        present = dates.notna()
+        older = pd.Series(False, index=dates.index)
+        older[present] = (dates[present] < since).astype(bool)
+        report['older'] = report.get('older', 0) + int(older.sum())
+        df = df[~older]
+        dates = dates[~older]
+    amounts = parse_amounts(df, cols)
+
+    keep = dates.notna() & (amounts != 0)
+    report['skipped'] = report.get('skipped', 0) + int((~keep).sum())
+    df = df[keep]
+    dates = dates[keep]
+    amounts = amounts[keep]
+
+    if 'description' in cols:
+        descriptions = _as_text(df[cols['description']])
+    else:
+        descriptions = pd.Series('', index=df.index, dtype=object)
+
+    types, corrected_amounts = determine_types(amounts, descriptions)
+
+    # Category logic: Use column if exists, else auto-categorize
+    categories = auto_categorize_column(descriptions)
+    if 'category' in cols:
+        given = _as_text(df[cols['category']])
+        missing = (given == '') | (given.str.lower() == 'nan')
+        categories = given.where(~missing, categories)
+
+    if 'third_party' in cols:
+        third_parties = _as_text(df[cols['third_party']])
+    else:
+        third_parties = pd.Series('', index=df.index, dtype=object)
+
+    normalized = pd.DataFrame({
+        'date': dates,
+        'description': descriptions,
+        'amount': corrected_amounts,
+        'type': types,
+        'category': categories,
+        'third_party': third_parties
+    })
+    if rules is not None and not normalized.empty:
+        normalized = rules.apply(normalized)
+    return normalized
+
+def read_file(file_path):
+    """
+    Loads a .csv / .xls / .xlsx file into a DataFrame.
+    """
+    if file_path.endswith('.csv'):
+        # Try different separators
+        try:
+            return pd.read_csv(file_path, sep=None, engine='python')
+        except:
+            return pd.read_csv(file_path)
+
+    # Handle Excel files
+    try:
+        if file_path.endswith('.xls'):
+            return pd.read_excel(file_path, engine='xlrd')
+        elif file_path.endswith('.xlsx'):
+            return pd.read_excel(file_path, engine='openpyxl')
+        else:
+            return pd.read_excel(file_path)
+    except ImportError as e:
+        if 'xlrd' in str(e):
+            raise ValueError("Missing 'xlrd' library for .xls files. Please install it: pip install xlrd")
+        if 'openpyxl' in str(e):
+            raise ValueError("Missing 'openpyxl' library for .xlsx files. Please install it: pip install openpyxl")
+        raise e
+
+def _load_workbook(file_path):
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise ValueError("Missing 'openpyxl' library for .xlsx files. Please install it: pip install openpyxl")
+    # Read-only: rows are streamed from the XML instead of building the whole workbook
+    return load_workbook(file_path, read_only=True, data_only=True)
+
+def _excel_columns(row):
+    """
+    Column names of a header row, named like read_excel does for blank and
+    duplicate cells.
+    """
+    names, seen = [], Counter()
+    for i, value in enumerate(row):
+        name = f'Unnamed: {i}' if value is None or str(value).strip() == '' else str(value)
+        if seen[name]:
+            seen[name] += 1
+            name = f'{name}.{seen[name] - 1}'
+        else:
+            seen[name] += 1
+        names.append(name)
+    return names
+
+def _find_excel_header(rows):
+    """
+    Index of the header among the first rows of a sheet: the first row whose
+    names map to a date and an amount column, else to a date column, else the
+    first row as filled as the table body.
+    """
+    mapped = [normalize_columns(pd.DataFrame(columns=_excel_columns(row))) for row in rows]
+    for i, cols in enumerate(mapped):
+        if 'date' in cols and cols.keys() & {'amount', 'debit', 'credit'}:
+            return i
+    for i, cols in enumerate(mapped):
+        if 'date' in cols:
+            return i
+
+    filled = [sum(v is not None and str(v).strip() != '' for v in row) for row in rows]
+    counts = Counter(n for n in filled if n)
+    if not counts:
+        return 0
+    modal = counts.most_common(1)[0][0]
+    return next(i for i, n in enumerate(filled) if n >= modal)
+
+class ExcelSheet:
+    """
+    One sheet of an .xlsx workbook opened in read-only mode, so rows are
+    streamed from the file instead of building the whole workbook in memory.
+    Opening parses the shared strings table, the costly part on big exports:
+    open once, then read the header, the row estimate and the chunks from it.
+    Without a `sheet` name, the first sheet whose header has a date column is
+    used, else the first sheet.
+    """
+    def __init__(self, file_path, sheet=None):
+        self.workbook = _load_workbook(file_path)
+        try:
+            self.ws, self.header_at, self.header = self._pick(sheet)
+        except Exception:
+            self.workbook.close()
+            raise
+
+    def _pick(self, sheet):
+        if sheet:
+            if sheet not in self.workbook.sheetnames:
+                raise ValueError(f"Sheet '{sheet}' not found. Available sheets: {', '.join(self.workbook.sheetnames)}")
+            candidates = [self.workbook[sheet]]
+        else:
+            candidates = self.workbook.worksheets
+
+        first = None
+        for ws in candidates:
+            head = [row for row, _ in zip(ws.iter_rows(values_only=True), range(EXCEL_HEADER_SCAN))]
+            if not head:
+                continue
+            header_at = _find_excel_header(head)
+            columns = _excel_columns(head[header_at])
+            if first is None:
+                first = (ws, header_at, columns)
+            if 'date' in normalize_columns(pd.DataFrame(columns=columns)):
+                return ws, header_at, columns
+        if first is None:
+            raise ValueError("The workbook has no data.")
+        return first
+
+    def columns(self):
+        """Header as an empty DataFrame, like read_header."""
+        return pd.DataFrame(columns=self.header)
+
+    def rows_total(self):
+        """Data rows declared by the sheet, None if it does not say."""
+        if self.ws.max_row is None:
+            return None
+        return max(self.ws.max_row - self.header_at - 1, 0)
+
+    def iter_chunks(self, chunksize=None, wanted=None):
+        """
+        DataFrames of at most `chunksize` rows from below the header, with
+        lowercased column names. Only the `wanted` (lowercase) columns are kept;
+        fully empty rows are skipped.
+        """
+        chunksize = chunksize or CHUNK_SIZE
+        names = [n.lower().strip() for n in self.header]
+        keep = [i for i, n in enumerate(names) if not wanted or n in wanted]
+        columns = [names[i] for i in keep]
+
+        self.ws.reset_dimensions() # Exports often declare a wrong sheet size: read to the last row
+        buffer = []
+        for row in self.ws.iter_rows(min_row=self.header_at + 2, values_only=True):
+            values = [row[i] if i < len(row) else None for i in keep]
+            if all(v is None for v in values):
+                continue
+            buffer.append(values)
+            if len(buffer) >= chunksize:
+                yield pd.DataFrame(buffer, columns=columns)
+                buffer = []
+        if buffer:
+            yield pd.DataFrame(buffer, columns=columns)
+
+    def close(self):
+        self.workbook.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def sniff_csv(file_path, sample_bytes=None):
+    """
+    Reads the first KB of a CSV export to pick its read_csv options: encoding
+    (UTF-8, else cp1252/latin-1 as produced by French Excel), delimiter,
+    decimal separator and the number of title lines above the header.
+    Returns a dict of read_csv keyword arguments, None if nothing was found.
+    """
+    with open(file_path, 'rb') as f:
+        raw = f.read(sample_bytes or SNIFF_BYTES)
+        complete = not f.read(1)
+
+    if not complete and b'\n' in raw:
+        raw = raw[:raw.rindex(b'\n')] # Drop the truncated last line
+    if not raw.strip():
+        return None
+
+    if raw.startswith(codecs.BOM_UTF8):
+        encoding = 'utf-8-sig'
+    else:
+        encoding = None
+        for candidate in ['utf-8', 'cp1252', 'latin-1']:
+            try:
+                raw.decode(candidate)
+                encoding = candidate
+                break
+            except UnicodeDecodeError:
+                continue
+    text = raw.decode(encoding)
+    lines = text.replace('\r\n', '\n').split('\n')
+
+    def field_counts(sep):
+        return [len(next(csv.reader([line], delimiter=sep))) if line.strip() else 0 for line in lines]
+
+    # Delimiter giving the most lines with the same (> 1) number of fields
+    best = None
+    for sep in CSV_DELIMITERS:
+        counts = field_counts(sep)
+        modal, lines_with = Counter(c for c in counts if c).most_common(1)[0]
+        score = (modal > 1, lines_with, modal)
+        if best is None or score > best[0]:
+            best = (score, sep, counts, modal)
+    _, sep, counts, modal = best
+    if modal == 1:
+        sep = ','
+
+    # Title lines ("Compte courant n°...", export date...) sit above the header
+    skiprows = counts.index(modal)
+
+    # Decimal comma: numbers like 1234,56 and none like 1234.56
+    decimal = '.'
+    if sep != ',':
+        cells = [cell.strip() for line in lines[skiprows + 1:] if line.strip()
+                 for cell in next(csv.reader([line], delimiter=sep))]
+        if any(re.match(r'[-+]?\d[\d \u00a0]*,\d+$', c) for c in cells) and \
+                not any(re.match(r'[-+]?\d+\.\d+$', c) for c in cells):
+            decimal = ','
+
+    return {'sep': sep, 'encoding': encoding, 'decimal': decimal, 'skiprows': skiprows}
+
+def _csv_options(file_path):
+    options = sniff_csv(file_path)
+    if options is None:
+        return None
+    if options['encoding'].startswith('utf-8'):
+        # Sniffed on the first KB only: a stray cp1252 byte further down must not fail the upload
+        options['encoding_errors'] = 'replace'
+    return options
+
+def read_header(file_path, sheet=None):
+    """
+    Column names of a file, as an empty DataFrame, without reading its rows.
+    `sheet` picks the sheet of an .xlsx workbook.
+    """
+    if file_path.endswith('.csv'):
+        options = _csv_options(file_path)
+        if options is not None:
+            try:
+                return pd.read_csv(file_path, engine='c', nrows=0, **options)
+            except (pd.errors.ParserError, UnicodeDecodeError, ValueError):
+                pass
+        try:
+            return pd.read_csv(file_path, sep=None, engine='python', nrows=0)
+        except:
+            return pd.read_csv(file_path, nrows=0)
+
+    if file_path.endswith('.xlsx'):
+        with ExcelSheet(file_path, sheet) as excel:
+            return excel.columns()
+
+    return read_file(file_path).iloc[:0]
+
+def _select(df, wanted):
+    """
+    Lowercases and strips column names, keeping only `wanted` ones if given.
+    """
+    df.columns = df.columns.str.lower().str.strip()
+    if wanted:
+        df = df[[c for c in df.columns if c in wanted]]
+    return df
+
+def iter_chunks(file_path, chunksize=None, cols=None, sheet=None):
+    """
+    Yields the file as successive DataFrames of at most `chunksize` rows,
+    with lowercased and stripped column names.
+    CSV files are streamed from disk so only one chunk is held in memory.
+    With `cols` (the mapping from normalize_columns), only the mapped columns
+    are parsed, and the text ones are read as strings without type inference.
+    .xlsx workbooks are streamed too (see ExcelSheet).
+    """
+    chunksize = chunksize or CHUNK_SIZE
+    wanted = set(cols.values()) if cols else None
+    text = {cols[key] for key in TEXT_COLUMNS if key in cols} if cols else set()
+
+    if file_path.endswith('.csv'):
+        reader, first = None, None
+        options = _csv_options(file_path)
+        if options is not None:
+            # C engine with the sniffed options; mapped text columns skip type inference
+            header = read_header(file_path, sheet)
+            names = [c for c in header.columns if not wanted or str(c).lower().strip() in wanted]
+            try:
+                reader = pd.read_csv(
+                    file_path, engine='c', chunksize=chunksize,
+                    usecols=names if wanted else None,
+                    dtype={c: 'str' for c in names if str(c).lower().strip() in text},
+                    **options
+                )
+                first = next(reader, None)
+            except (pd.errors.ParserError, UnicodeDecodeError, ValueError):
+                reader = None
+
+        if reader is None:
             # Try different separators
             try:
-                df = pd.read_csv(file_path, sep=None, engine='python')
+                reader = pd.read_csv(file_path, sep=None, engine='python', chunksize=chunksize)
+                first = next(reader, None)
             except:
-                df = pd.read_csv(file_path)
+                reader = pd.read_csv(file_path, chunksize=chunksize)
+                first = next(reader, None)
+
+        if first is not None:
+            yield _select(first, wanted)
+            for chunk in reader:
+                yield _select(chunk, wanted)
+        return
+
+    if file_path.endswith('.xlsx'):
+        with ExcelSheet(file_path, sheet) as excel:
+            yield from excel.iter_chunks(chunksize, wanted)
+        return
+
+    # .xls workbooks are loaded whole, then sliced
+    df = _select(read_file(file_path), wanted)
+    for start in range(0, len(df), chunksize):
+        yield df.iloc[start:start + chunksize]
+
+def count_rows(file_path, sheet=None):
+    """
+    Cheap estimate of the number of data rows, used for progress reporting.
+    Returns None when it cannot be known without parsing the file.
+    """
+    try:
+        if file_path.endswith('.csv'):
+            lines = 0
+            with open(file_path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    lines += block.count(b'\n')
+            return max(lines - 1, 0) # Header
+        if file_path.endswith('.xlsx'):
+            with ExcelSheet(file_path, sheet) as excel:
+                return excel.rows_total()
+    except Exception:
+        pass
+    return None
+
+def update_progress(upload_id, rows_processed=None, rows_total=None, rows_skipped=None, rows_inserted=None, stage=None, started=False):
+    """
+    Records progress on the Upload row. Committed with the current chunk,
+    then announced with progress.publish.
+    """
+    values = {'heartbeat_at': datetime.utcnow()}
+    if rows_processed is not None:
+        values['rows_processed'] = rows_processed
+    if rows_skipped is not None:
+        values['rows_skipped'] = rows_skipped
+    if rows_total is not None:
+        values['rows_total'] = rows_total
+    if rows_inserted is not None:
+        values['rows_inserted'] = rows_inserted
+    if stage is not None:
+        values['stage'] = stage
+    if started:
+        values['started_at'] = values['heartbeat_at']
+    Upload.query.filter_by(id=upload_id).update(values)
+
+def _copy_frame(connection, table, frame, nullable=()):
+    """
+    PostgreSQL: streams a DataFrame into `table` with COPY FROM STDIN (CSV).
+    Every field is quoted so empty strings stay empty strings, not NULL,
+    except in the `nullable` columns where they are NULL.
+    """
+    buffer = io.StringIO()
+    frame.to_csv(buffer, index=False, header=False, quoting=csv.QUOTE_ALL)
+    buffer.seek(0)
+
+    options = 'FORMAT csv' + (f", FORCE_NULL ({', '.join(nullable)})" if nullable else '')
+    sql = f"COPY {table} ({', '.join(frame.columns)}) FROM STDIN WITH ({options})"
+    cursor = connection.connection.dbapi_connection.cursor()
+    try:
+        if hasattr(cursor, 'copy_expert'):
+            cursor.copy_expert(sql, buffer) # psycopg2
         else:
-            # Handle Excel files
-            try:
-                if file_path.endswith('.xls'):
-                    df = pd.read_excel(file_path, engine='xlrd')
-                elif file_path.endswith('.xlsx'):
-                    df = pd.read_excel(file_path, engine='openpyxl')
-                else:
-                    df = pd.read_excel(file_path)
-            except ImportError as e:
-                if 'xlrd' in str(e):
-                    raise ValueError("Missing 'xlrd' library for .xls files. Please install it: pip install xlrd")
-                if 'openpyxl' in str(e):
-                    raise ValueError("Missing 'openpyxl' library for .xlsx files. Please install it: pip install openpyxl")
-                raise e
-            
-        cols = normalize_columns(df)
-        
+            with cursor.copy(sql) as copy: # psycopg 3
+                copy.write(buffer.getvalue())
+    finally:
+        cursor.close()
+
+def row_fingerprints(normalized):
+    """
+    64-bit hash of (date, description, amount, third_party) for each normalized
+    row, to recognise rows that are already stored.
+    """
+    keys = pd.DataFrame({
+        'date': normalized['date'].astype(str),
+        'description': normalized['description'].astype(str),
+        'amount': normalized['amount'].astype(float).map('{:.2f}'.format),
+        'third_party': normalized['third_party'].astype(str)
+    })
+    return pd.util.hash_pandas_object(keys, index=False)
+
+def high_water_mark(upload_id):
+    """
+    Returns (last transaction date, Counter of the row fingerprints stored on
+    that date) for an upload, or (None, empty Counter) if it has no rows.
+    """
+    upload = Upload.query.get(upload_id)
+    last = upload.last_transaction_date if upload else None
+    if last is None:
+        last = db.session.query(db.func.max(Transaction.date)).filter(Transaction.source_file_id == upload_id).scalar()
+    if last is None:
+        return None, Counter()
+
+    rows = db.session.query(
+        Transaction.date, Transaction.description, Transaction.amount, Transaction.third_party
+    ).filter(Transaction.source_file_id == upload_id, Transaction.date == last).all()
+    stored = pd.DataFrame(rows, columns=['date', 'description', 'amount', 'third_party'])
+    return last, Counter(row_fingerprints(stored).tolist()) if len(stored) else Counter()
+
+def new_rows(normalized, high_water, seen):
+    """
+    Rows of a refreshed statement that are not stored yet: those dated after the
+    high-water mark, and on that day those beyond the copies already stored.
+    `seen` (Counter of fingerprints) is consumed as stored rows are matched.
+    """
+    if high_water is None or normalized.empty:
+        return normalized
+
+    keep = (normalized['date'] > high_water).astype(bool)
+    same_day = (normalized['date'] == high_water).astype(bool)
+    if same_day.any():
+        for index, fingerprint in zip(normalized.index[same_day], row_fingerprints(normalized[same_day])):
+            if seen[fingerprint] > 0:
+                seen[fingerprint] -= 1 # Already stored
+            else:
+                keep[index] = True
+    return normalized[keep]
+
+def insert_transactions(normalized, upload_id, user_id=None):
+    """
+    Inserts one chunk of normalized rows in the session's transaction, without
+    building ORM objects: COPY on PostgreSQL, a single executemany elsewhere.
+    `user_id` is the owner of the upload, stored on each row.
+    Returns the number of rows inserted.
+    """
+    if normalized.empty:
+        return 0
+
+    created_at = datetime.utcnow()
+    fields = ['date', 'description', 'amount', 'type', 'category', 'third_party']
+    if 'rule_id' in normalized:
+        fields += ['rule_id', 'original_type', 'original_amount'] # Set by category rules
+    rows = normalized[fields].assign(
+        source_file_id=upload_id,
+        user_id=user_id,
+        created_at=created_at.isoformat(sep=' ')
+    )
+
+    columns = list(rows.columns)
+    connection = db.session.connection()
+    if connection.dialect.name == 'postgresql':
+        _copy_frame(connection, Transaction.__tablename__, rows, nullable=[c for c in ['rule_id', 'original_type', 'original_amount', 'user_id'] if c in columns])
+    elif connection.dialect.name == 'sqlite':
+        # Raw executemany with values already in SQLAlchemy's SQLite storage format
+        rows['date'] = [d.isoformat() for d in rows['date']]
+        rows['created_at'] = created_at.strftime('%Y-%m-%d %H:%M:%S.%f')
+        sql = f"INSERT INTO {Transaction.__tablename__} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+        connection.exec_driver_sql(sql, list(zip(*(rows[c].tolist() for c in columns))))
+    else:
+        rows['created_at'] = created_at
+        records = [dict(zip(columns, values)) for values in zip(*(rows[c].tolist() for c in columns))]
+        db.session.execute(Transaction.__table__.insert(), records)
+
+    return len(normalized)
+
+class UploadDeleted(Exception):
+    """The upload was deleted while its file was being processed."""
+
+def _discard_rows(upload_id, user_id):
+    """Deletes the rows an upload got so far, with its rollups and balances."""
+    Transaction.query.filter_by(source_file_id=upload_id).delete()
+    rollups.delete(upload_id)
+    balances.delete(upload_id, user_id=user_id) # The Upload row may be gone
+    cache.invalidate(user_id)
+
+def process_file(file_path, upload_id, chunksize=None, sheet=None, append_to=None):
+    """
+    Reads file, normalizes data, and saves transactions to DB.
+    Supports: .csv, .xlsx (`sheet` picks the sheet, default: the first one
+    with a date column)
+
+    The file is processed in chunks of `chunksize` rows (default CHUNK_SIZE),
+    each chunk being committed as it goes so memory stays flat whatever the
+    file size. If anything fails, the rows already inserted for this upload
+    are deleted and the upload is flagged as 'error'. If the upload itself
+    is deleted meanwhile, its rows are deleted too and processing stops.
+
+    With `append_to` (an upload id), the file is a newer export of that
+    statement: only rows past its high-water mark are parsed and inserted,
+    then moved to that upload once the whole file went through.
+
+    The raw chunks are kept in an Arrow snapshot next to the file (see
+    services/snapshots.py). When one exists, it is read instead of the file.
+    """
+    excel = None
+    snapshot = None
+    user_id = None
+    try:
+        count = 0
+        rows_read = 0
+        last_date = None
+        report = {}
+
+        high_water, seen = high_water_mark(append_to) if append_to else (None, None)
+
+        upload = Upload.query.get(upload_id)
+        user_id = upload.user_id if upload else None
+        ruleset = category_rules.for_user(user_id)
+
+        # Columns are mapped from the header alone, so only mapped ones are parsed
+        meta = snapshots.load_meta(file_path, sheet)
+        if meta:
+            header, rows_total = pd.DataFrame(columns=meta['header']), meta['rows']
+        elif file_path.endswith('.xlsx'):
+            excel = ExcelSheet(file_path, sheet) # Opened once: header, row estimate and rows
+            header, rows_total = excel.columns(), excel.rows_total()
+        else:
+            header, rows_total = read_header(file_path, sheet), count_rows(file_path, sheet)
+        update_progress(upload_id, rows_processed=0, rows_total=rows_total, rows_inserted=0, stage='reading', started=True)
+        db.session.commit()
+        progress.publish(upload_id)
+
+        cols, profile, fingerprint = resolve_columns(header, user_id)
+        columns = list(header.columns)
+        date_format = profile['date_format'] if profile else None
+
         # Validation: Must have at least Date
         if 'date' not in cols:
             raise ValueError("Could not detect a 'Date' column. Please ensure your file has a date column.")
-        
-        transactions = []
-        
-        for _, row in df.iterrows():
-            # Date parsing
-            date_val = row[cols['date']]
-            if pd.isna(date_val):
-                continue
-                
-            try:
-                # Handle various date formats including Excel serial dates
-                if isinstance(date_val, (int, float)):
-                    # Excel serial date
-                    date_obj = pd.to_datetime(date_val, unit='D', origin='1899-12-30').date()
-                else:
-                    # Check if it looks like YYYY-MM-DD
-                    str_val = str(date_val)
-                    if re.match(r'\d{4}-\d{2}-\d{2}', str_val):
-                         date_obj = pd.to_datetime(date_val).date() # ISO format, no dayfirst
-                    else:
-                         date_obj = pd.to_datetime(date_val, dayfirst=True).date()
-            except:
-                continue # Skip invalid dates
-            
-            # Amount calculation
-            amount = parse_amount(row, cols)
-            
-            # Skip zero amounts if desired, or keep them. Let's keep non-zero.
-            if amount == 0:
-                continue
 
-            # Determine Type & Correct Amount
-            description = str(row.get(cols.get('description'), '')).strip()
-            type_val, corrected_amount = determine_type(amount, description)
-                
-            third_party = row.get(cols.get('third_party'), '')
-            
-            # Category logic: Use column if exists, else auto-categorize
-            if 'category' in cols:
-                category = str(row.get(cols['category'], '')).strip()
-                if not category or category.lower() == 'nan':
-                     category = auto_categorize(description)
+        if snapshots.covers(meta, cols.values()):
+            chunks = snapshots.iter_chunks(file_path, sheet, set(cols.values()), meta)
+        else:
+            if file_path.endswith('.xlsx') and excel is None:
+                excel = ExcelSheet(file_path, sheet)
+            if excel:
+                chunks = excel.iter_chunks(chunksize, set(cols.values()))
             else:
-                category = auto_categorize(description)
-            
-            transactions.append(Transaction(
-                date=date_obj,
-                description=description,
-                amount=corrected_amount,
-                type=type_val,
-                category=category,
-                third_party=str(third_party).strip(),
-                source_file_id=upload_id
-            ))
-            
-        if not transactions:
+                chunks = iter_chunks(file_path, chunksize, cols, sheet)
+            snapshot = snapshots.open_writer(file_path, sheet, columns)
+        for chunk in chunks:
+            if db.session.query(Upload.id).filter(Upload.id == upload_id).scalar() is None:
+                raise UploadDeleted(upload_id)
+            if snapshot:
+                try:
+                    snapshot.write(chunk)
+                except Exception as e:
+                    log.warning("Upload %s: snapshot dropped (%s)", upload_id, e) # Only an optimization
+                    snapshot.abort()
+                    snapshot = None
+            normalized = normalize_frame(chunk, cols, report, date_format, since=high_water, rules=ruleset)
+            if append_to:
+                normalized = new_rows(normalized, high_water, seen)
+            if not normalized.empty:
+                chunk_last = max(normalized['date'])
+                last_date = chunk_last if last_date is None else max(last_date, chunk_last)
+            count += insert_transactions(normalized, upload_id, user_id)
+            rollups.add(upload_id, user_id, normalized) # Committed with the chunk
+            balances.add(upload_id, user_id, normalized)
+            if date_format is None and report.get('format') in dict(DATE_FORMATS):
+                date_format = report['format'] # Later chunks skip the inference
+            rows_read += len(chunk)
+            update_progress(upload_id, rows_processed=rows_read, rows_skipped=report.get('skipped', 0),
+                            rows_inserted=count, stage='inserting')
+            if not normalized.empty:
+                cache.invalidate(user_id) # Dashboards see each chunk as it is committed
+            db.session.commit()
+            progress.publish(upload_id)
+
+        if snapshot:
+            snapshot.commit()
+            snapshot = None
+
+        if not count and not append_to:
              raise ValueError("No valid transactions found. Check column names and data format.")
 
-        db.session.bulk_save_objects(transactions)
-        
         # Update Upload status
         upload = Upload.query.get(upload_id)
+        if upload is None:
+            raise UploadDeleted(upload_id)
         upload.status = 'completed'
+        upload.last_transaction_date = last_date
+        if append_to:
+            # New rows join the refreshed statement in the same commit as the status
+            Transaction.query.filter_by(source_file_id=upload_id).update(
+                {'source_file_id': append_to}, synchronize_session=False
+            )
+            rollups.move(upload_id, append_to)
+            balances.move(upload_id, append_to)
+            cache.invalidate(user_id)
+            target = Upload.query.get(append_to)
+            if last_date and (target.last_transaction_date is None or last_date > target.last_transaction_date):
+                target.last_transaction_date = last_date
+        upload.rows_total = rows_read
+        upload.rows_skipped = report.get('skipped', 0)
+        upload.rows_inserted = count
+        upload.stage = None
+        if profile:
+            profiles.record_use(profile, date_format)
+        else:
+            profiles.learn(fingerprint, columns, cols, user_id, date_format)
         db.session.commit()
+        progress.publish(upload_id, finished=True)
+
+        if report.get('fallback') or report.get('invalid'):
+            log.info("Upload %s: dates parsed as %s, %s row(s) needed the slow path, %s invalid date(s) skipped.",
+                     upload_id, report.get('format'), report['fallback'], report['invalid'])
         
-        return len(transactions)
+        return count
         
+    except UploadDeleted:
+        db.session.rollback()
+        _discard_rows(upload_id, user_id)
+        db.session.commit()
+        progress.publish(upload_id, finished=True)
+        log.info("Upload %s was deleted while being processed, its rows were discarded.", upload_id)
+        return 0
     except Exception as e:
         db.session.rollback()
+        # Chunks already committed must not survive a failed upload
+        _discard_rows(upload_id, user_id)
         upload = Upload.query.get(upload_id)
-        upload.status = 'error'
-        upload.error_message = str(e)
+        if upload: # Gone if it was deleted while being processed
+            upload.status = 'error'
+            upload.error_message = str(e)
+            upload.stage = None
+            upload.rows_inserted = 0
         db.session.commit()
+        progress.publish(upload_id, finished=True)
         raise e
+    finally:
+        if excel:
+            excel.close()
+        if snapshot:
+            snapshot.abort()
@@ -0,0 +1,149 @@
+import threading
+import traceback
+from datetime import datetime, timedelta
+from models import db, Upload, Transaction
+from services.ingestion import process_file
+from services.storage import blob_path
+from services import balances, cache, progress, rollups
+
+def claim_next_upload():
+    """
+    Atomically moves the oldest 'pending' upload to 'processing' and returns it.
+    Safe across app instances: PostgreSQL skips rows locked by another worker,
+    and the conditional UPDATE only succeeds for the first claimer on any dialect.
+    Returns None if nothing is pending.
+    """
+    candidate = db.session.query(Upload.id).filter(
+        Upload.status == 'pending'
+    ).order_by(Upload.id).with_for_update(skip_locked=True).first()
+
+    if not candidate:
+        db.session.rollback()
+        return None
+
+    claimed = Upload.query.filter_by(id=candidate.id, status='pending').update({
+        'status': 'processing',
+        'attempts': db.func.coalesce(Upload.attempts, 0) + 1,
+        'heartbeat_at': datetime.utcnow()
+    }, synchronize_session=False)
+    db.session.commit()
+
+    if not claimed:
+        return None # Another worker got it first
+    progress.publish(candidate.id)
+    return Upload.query.get(candidate.id)
+
+def recover_stale_uploads(stale_after, max_attempts):
+    """
+    Re-queues uploads left in 'processing' by a worker that died (no progress
+    for `stale_after` seconds), or flags them as 'error' once they have been
+    attempted `max_attempts` times.
+    Returns the number of uploads recovered.
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=stale_after)
+    stale = Upload.query.filter(
+        Upload.status == 'processing',
+        db.or_(Upload.heartbeat_at < cutoff, Upload.heartbeat_at.is_(None))
+    ).with_for_update(skip_locked=True).all()
+
+    for upload in stale:
+        if (upload.attempts or 0) >= max_attempts:
+            Transaction.query.filter_by(source_file_id=upload.id).delete()
+            rollups.delete(upload.id)
+            balances.delete(upload.id)
+            cache.invalidate(upload.user_id)
+            upload.status = 'error'
+            upload.error_message = 'Processing was interrupted too many times.'
+        else:
+            upload.status = 'pending'
+
+    db.session.commit()
+    for upload in stale:
+        progress.publish(upload.id)
+    return len(stale)
+
+def run_job(app, upload):
+    """
+    Ingests one claimed upload. process_file records the outcome on the upload.
+    """
+    # Rows left behind by an interrupted attempt
+    Transaction.query.filter_by(source_file_id=upload.id).delete()
+    rollups.delete(upload.id)
+    balances.delete(upload.id)
+    cache.invalidate(upload.user_id)
+    db.session.commit()
+
+    try:
+        process_file(blob_path(app, upload), upload.id, sheet=upload.sheet, append_to=upload.append_to_id)
+    except Exception:
+        traceback.print_exc()
+
+class IngestionWorkerPool:
+    """
+    Threads that claim 'pending' uploads and run process_file on them.
+    Configured from app.config: INGESTION_WORKERS, INGESTION_POLL_INTERVAL,
+    INGESTION_STALE_SECONDS and INGESTION_MAX_ATTEMPTS.
+    """
+    def __init__(self, app, workers=None):
+        self.app = app
+        self.workers = app.config['INGESTION_WORKERS'] if workers is None else workers
+        self.poll_interval = app.config['INGESTION_POLL_INTERVAL']
+        self.stale_after = app.config['INGESTION_STALE_SECONDS']
+        self.max_attempts = app.config['INGESTION_MAX_ATTEMPTS']
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'ingestion-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def notify(self):
+        """Wakes idle workers, e.g. right after a new upload was enqueued."""
+        self._wake.set()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                with self.app.app_context():
+                    recover_stale_uploads(self.stale_after, self.max_attempts)
+                    upload = claim_next_upload()
+                    if upload:
+                        run_job(self.app, upload)
+                        continue
+            except Exception:
+                traceback.print_exc()
+
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+def init_app(app):
+    """
+    Starts the in-process worker pool and exposes it as app.extensions['ingestion'].
+    With INGESTION_WORKERS = 0 (the default, e.g. for scripts) uploads are
+    only enqueued, for a separate worker.py; `python app.py` turns it on.
+    """
+    pool = IngestionWorkerPool(app).start()
+    app.extensions['ingestion'] = pool
+    return pool
+
+def enqueue(app):
+    """
+    Signals that a new 'pending' upload is available.
+    """
+    pool = app.extensions.get('ingestion')
+    if pool:
+        pool.notify()
@@ -1,46 +1,28 @@
-from models import db, Transaction, Budget, Upload
+from models import db, Transaction, Budget, MonthlyRollup
 from sqlalchemy import func, extract, case
-from datetime import datetime, timedelta
-from utils import format_date_sql
+from datetime import date, datetime, timedelta
+from utils import format_date_sql, week_start_sql
+from services import balances, rollups
+from services.cache import cached
 
+# Month-level figures are read from the monthly rollup (see services/rollups.py),
+# balances and date-range totals from the daily balances (services/balances.py),
+# day-level ones from the transactions.
+
+@cached
 def get_dashboard_stats(start_date=None, end_date=None, upload_id=None, user_id=None):
     if not start_date:
         start_date = datetime(2000, 1, 1)
     if not end_date:
         end_date = datetime.utcnow()
 
-    filters = [
-        Transaction.date >= start_date,
-        Transaction.date <= end_date
-    ]
-    if upload_id:
-        filters.append(Transaction.source_file_id == upload_id)
-    elif user_id:
-        filters.append(Transaction.source_file_id.in_(
-            db.session.query(Upload.id).filter(Upload.user_id == user_id)
-        ))
-
-    total_sales = db.session.query(func.sum(Transaction.amount)).filter(
-        Transaction.type == 'SALE',
-        *filters
-    ).scalar() or 0
-
-    total_purchases = db.session.query(func.sum(Transaction.amount)).filter(
-        Transaction.type == 'PURCHASE',
-        *filters
-    ).scalar() or 0
+    totals = balances.totals_between(start_date, end_date, upload_id=upload_id, user_id=user_id)
+    total_sales = totals['sales']
+    total_purchases = totals['purchases']
     
     margin = total_sales + total_purchases
 
-    balance_query = db.session.query(func.sum(Transaction.amount))
-    if upload_id:
-        balance_query = balance_query.filter(Transaction.source_file_id == upload_id)
-    elif user_id:
-        balance_query = balance_query.filter(Transaction.source_file_id.in_(
-            db.session.query(Upload.id).filter(Upload.user_id == user_id)
-        ))
-        
-    current_balance = balance_query.scalar() or 0
+    current_balance = balances.balance_at(None, upload_id=upload_id, user_id=user_id)
 
     return {
         "total_sales": float(total_sales),
@@ -49,118 +31,145 @@ def get_dashboard_stats(start_date=None, end_date=None, upload_id=None, user_id=
         "current_balance": float(current_balance)
     }
 
-def get_cash_flow_history(year=None, granularity='month', upload_id=None, user_id=None):
-    if not year:
-        max_date_query = db.session.query(func.max(Transaction.date))
-        if upload_id:
-            max_date_query = max_date_query.filter(Transaction.source_file_id == upload_id)
-        elif user_id:
-            max_date_query = max_date_query.filter(Transaction.source_file_id.in_(
-                db.session.query(Upload.id).filter(Upload.user_id == user_id)
-            ))
-        max_date = max_date_query.scalar()
-        
-        if max_date:
-            year = max_date.year if isinstance(max_date, datetime) else int(str(max_date)[:4])
-        else:
-            year = datetime.utcnow().year
+def _default_year(upload_id=None, user_id=None):
+    """Year of the latest transaction in the scope, else the current year."""
+    latest = rollups.latest_month(upload_id, user_id)
+    return int(latest[:4]) if latest else datetime.utcnow().year
 
-    start_date = datetime(year, 1, 1)
-    end_date = datetime(year + 1, 1, 1)
-    
+# Cash flow buckets; month-level ones can be read from the rollup
+GRANULARITIES = ['day', 'week', 'month', 'quarter']
+MONTH_LEVEL = ('month', 'quarter')
+
+def _quarter_sql(month):
+    """'YYYY-Qn' from a 'YYYY-MM' text expression."""
+    number = (db.cast(func.substr(month, 6, 2), db.Integer) + 2) // 3
+    return func.substr(month, 1, 4) + '-Q' + db.cast(number, db.String)
+
+def _period_sql(granularity, column):
+    """Bucket label of a transaction date, sorting in time order."""
     if granularity == 'day':
-        date_format = '%Y-%m-%d'
+        return format_date_sql(column, '%Y-%m-%d')
+    if granularity == 'week':
+        return week_start_sql(column)
+    month = format_date_sql(column, '%Y-%m')
+    return month if granularity == 'month' else _quarter_sql(month)
+
+def cash_flow_range(year=None, start=None, end=None, upload_id=None, user_id=None):
+    """
+    (start, end) dates, both included, of a cash flow request: the given
+    bounds (None = unbounded), else the calendar year `year`, by default the
+    year of the latest transaction.
+    """
+    if start or end:
+        return start, end
+    if not year:
+        year = _default_year(upload_id, user_id)
+    return date(year, 1, 1), date(year, 12, 31)
+
+@cached
+def get_cash_flow_history(year=None, granularity='month', upload_id=None, user_id=None, start=None, end=None):
+    """
+    Net flow per `granularity` bucket (GRANULARITIES; weeks are labelled by
+    their Monday, quarters 'YYYY-Qn') from `start` to `end`, see
+    cash_flow_range(), with the balance after each bucket.
+
+    One statement: the balance before `start` (a daily balances lookup) is
+    labelled '' so that it sorts first, and the running balance is SUM()
+    OVER (ORDER BY period). Whole months come from the rollup; days, and the
+    partial months at either end of the range, from the transactions.
+    """
+    start, end = cash_flow_range(year, start, end, upload_id, user_id)
+    if isinstance(start, datetime):
+        start = start.date()
+    if isinstance(end, datetime):
+        end = end.date()
+
+    month = MonthlyRollup.month
+    month_level = granularity in MONTH_LEVEL
+    if month_level:
+        # Whole months of the range, [first_whole, last_whole), come from the rollup
+        first_whole = None if start is None else (start if start.day == 1 else rollups.next_month(start))
+        last_whole = None if end is None else rollups.month_start(end + timedelta(days=1))
+        if first_whole is not None and last_whole is not None and first_whole >= last_whole:
+            first_whole = last_whole = None # Within one month
+    parts = []
+
+    if start is not None:
+        parts.append(db.select(db.literal('').label('period_key'), balances.opening_sql(start, upload_id, user_id).label('amount')))
+    # Rollup: whole months for month-level buckets
+    if month_level and (first_whole is not None or last_whole is not None or start is None):
+        filters = rollups.scope(upload_id, user_id)
+        if first_whole is not None:
+            filters.append(month >= first_whole.strftime('%Y-%m'))
+        if last_whole is not None:
+            filters.append(month < last_whole.strftime('%Y-%m'))
+        bucket = month if granularity == 'month' else _quarter_sql(month)
+        parts.append(db.select(bucket.label('period_key'), MonthlyRollup.total.label('amount')).where(*filters))
+
+    # Transactions: what the rollup did not cover
+    day = Transaction.date
+    intervals = [] # (first, last), dates included, None = unbounded
+    if not month_level:
+        intervals.append((start, end))
+    elif first_whole is None and last_whole is None and start is not None and end is not None:
+        intervals.append((start, end))
     else:
-        date_format = '%Y-%m'
-    
-    filters = [
-        Transaction.date >= start_date,
-        Transaction.date < end_date
+        if start is not None and first_whole is not None and start < first_whole:
+            intervals.append((start, first_whole - timedelta(days=1)))
+        if end is not None and last_whole is not None and last_whole <= end:
+            intervals.append((last_whole, end))
+    owner = [Transaction.source_file_id == upload_id] if upload_id else ([Transaction.user_id == user_id] if user_id else [])
+    for first, last in intervals:
+        filters = list(owner)
+        if first is not None:
+            filters.append(day >= first)
+        if last is not None:
+            filters.append(day <= last)
+        # Summed per date first (in index order), so only distinct days get a label
+        per_day = db.select(day.label('day'), func.sum(Transaction.amount).label('amount')).where(*filters).group_by(day).subquery()
+        parts.append(db.select(_period_sql(granularity, per_day.c.day).label('period_key'), per_day.c.amount))
+
+    flows = db.union_all(*parts).subquery() if len(parts) > 1 else parts[0].subquery()
+    rows = db.session.execute(
+        db.select(
+            flows.c.period_key,
+            func.sum(flows.c.amount).label('net_flow'),
+            func.sum(func.sum(flows.c.amount)).over(order_by=flows.c.period_key).label('balance')
+        ).group_by(flows.c.period_key).order_by(flows.c.period_key)
+    ).all()
+
+    return [
+        {"date": r.period_key, "net_flow": float(r.net_flow), "balance": float(r.balance)}
+        for r in rows if r.period_key != ''
     ]
-    if upload_id:
-        filters.append(Transaction.source_file_id == upload_id)
-    elif user_id:
-        filters.append(Transaction.source_file_id.in_(
-            db.session.query(Upload.id).filter(Upload.user_id == user_id)
-        ))
-
-    results = db.session.query(
-        format_date_sql(Transaction.date, date_format).label('period'),
-        func.sum(Transaction.amount).label('net_flow')
-    ).filter(*filters).group_by('period').order_by('period').all()
-    
-    history = []
-    
-    initial_balance_query = db.session.query(func.sum(Transaction.amount)).filter(
-        Transaction.date < start_date
-    )
-    if upload_id:
-        initial_balance_query = initial_balance_query.filter(Transaction.source_file_id == upload_id)
-    elif user_id:
-        initial_balance_query = initial_balance_query.filter(Transaction.source_file_id.in_(
-            db.session.query(Upload.id).filter(Upload.user_id == user_id)
-        ))
-        
-    initial_balance = initial_balance_query.scalar() or 0
-    
-    cumulative = float(initial_balance)
-    
-    for r in results:
-        net = float(r.net_flow)
-        cumulative += net
-        history.append({
-            "date": r.period,
-            "net_flow": net,
-            "balance": float(cumulative)
-        })
-        
-    return history
 
+def _income_expense_by(period, filters):
+    return db.session.query(
+        period.label('period'),
+        func.sum(case((MonthlyRollup.type == 'SALE', MonthlyRollup.total), else_=0)).label('income'),
+        func.sum(case((MonthlyRollup.type == 'PURCHASE', MonthlyRollup.total), else_=0)).label('expense')
+    ).filter(*filters).group_by(period).order_by(period).all()
+
+@cached
 def get_monthly_breakdown(year=None, upload_id=None, user_id=None):
     if not year:
-        max_date_query = db.session.query(func.max(Transaction.date))
-        if upload_id:
-            max_date_query = max_date_query.filter(Transaction.source_file_id == upload_id)
-        elif user_id:
-            max_date_query = max_date_query.filter(Transaction.source_file_id.in_(
-                db.session.query(Upload.id).filter(Upload.user_id == user_id)
-            ))
-        max_date = max_date_query.scalar()
-        
-        if max_date:
-            year = max_date.year if isinstance(max_date, datetime) else int(str(max_date)[:4])
-        else:
-            year = datetime.utcnow().year
-        
-    start_date = datetime(year, 1, 1)
-    end_date = datetime(year + 1, 1, 1)
-    
-    filters = [
-        Transaction.date >= start_date,
-        Transaction.date < end_date
-    ]
-    if upload_id:
-        filters.append(Transaction.source_file_id == upload_id)
-    elif user_id:
-        filters.append(Transaction.source_file_id.in_(
-            db.session.query(Upload.id).filter(Upload.user_id == user_id)
-        ))
-
-    results = db.session.query(
-        format_date_sql(Transaction.date, '%Y-%m').label('month'),
-        func.sum(case((Transaction.type == 'SALE', Transaction.amount), else_=0)).label('income'),
-        func.sum(case((Transaction.type == 'PURCHASE', Transaction.amount), else_=0)).label('expense')
-    ).filter(*filters).group_by('month').order_by('month').all()
+        year = _default_year(upload_id, user_id)
+
+    results = _income_expense_by(MonthlyRollup.month, [
+        MonthlyRollup.month >= f'{year}-01',
+        MonthlyRollup.month < f'{year + 1}-01',
+        *rollups.scope(upload_id, user_id)
+    ])
     
     breakdown = []
     for r in results:
         income = float(r.income or 0)
         expense = float(r.expense or 0)
-        margin = income + expense
+        margin = float((r.income or 0) + (r.expense or 0)) # Decimal sum: exact
         margin_pct = (margin / income * 100) if income > 0 else 0
         
         breakdown.append({
-            "month": r.month,
+            "month": r.period,
             "income": income,
             "expense": expense,
             "margin": margin,
@@ -169,30 +178,18 @@ def get_monthly_breakdown(year=None, upload_id=None, user_id=None):
         
     return breakdown
 
+@cached
 def get_annual_breakdown(upload_id=None, user_id=None):
-    query = db.session.query(
-        format_date_sql(Transaction.date, '%Y').label('year'),
-        func.sum(case((Transaction.type == 'SALE', Transaction.amount), else_=0)).label('income'),
-        func.sum(case((Transaction.type == 'PURCHASE', Transaction.amount), else_=0)).label('expense')
-    )
-    
-    if upload_id:
-        query = query.filter(Transaction.source_file_id == upload_id)
-    elif user_id:
-        query = query.filter(Transaction.source_file_id.in_(
-            db.session.query(Upload.id).filter(Upload.user_id == user_id)
-        ))
-        
-    results = query.group_by('year').order_by('year').all()
+    results = _income_expense_by(func.substr(MonthlyRollup.month, 1, 4), rollups.scope(upload_id, user_id))
     
     breakdown = []
     for r in results:
         income = float(r.income or 0)
         expense = float(r.expense or 0)
-        margin = income + expense
+        margin = float((r.income or 0) + (r.expense or 0)) # Decimal sum: exact
         
         breakdown.append({
-            "year": r.year,
+            "year": r.period,
             "income": income,
             "expense": expense,
             "margin": margin
@@ -200,27 +197,23 @@ def get_annual_breakdown(upload_id=None, user_id=None):
         
     return breakdown
 
-def get_top_expenses(limit=10, upload_id=None, user_id=None):
+def _category_totals(type_, limit, upload_id=None, user_id=None, descending=False):
+    total = func.sum(MonthlyRollup.total)
     query = db.session.query(
-        Transaction.category,
-        func.sum(Transaction.amount).label('total')
+        MonthlyRollup.category,
+        total.label('total')
     ).filter(
-        Transaction.type == 'PURCHASE'
-    )
-    
-    if upload_id:
-        query = query.filter(Transaction.source_file_id == upload_id)
-    elif user_id:
-        query = query.filter(Transaction.source_file_id.in_(
-            db.session.query(Upload.id).filter(Upload.user_id == user_id)
-        ))
-        
-    query = query.group_by(Transaction.category).order_by(func.sum(Transaction.amount).asc())
-    
+        MonthlyRollup.type == type_,
+        *rollups.scope(upload_id, user_id)
+    ).group_by(MonthlyRollup.category).order_by(total.desc() if descending else total.asc())
+
     if limit and limit > 0:
-        results = query.limit(limit).all()
-    else:
-        results = query.all()
+        return query.limit(limit).all()
+    return query.all()
+
+@cached
+def get_top_expenses(limit=10, upload_id=None, user_id=None):
+    results = _category_totals('PURCHASE', limit, upload_id, user_id)
     
     expenses = []
     for r in results:
@@ -232,27 +225,9 @@ def get_top_expenses(limit=10, upload_id=None, user_id=None):
         
     return expenses
 
+@cached
 def get_top_income(limit=10, upload_id=None, user_id=None):
-    query = db.session.query(
-        Transaction.category,
-        func.sum(Transaction.amount).label('total')
-    ).filter(
-        Transaction.type == 'SALE'
-    )
-    
-    if upload_id:
-        query = query.filter(Transaction.source_file_id == upload_id)
-    elif user_id:
-        query = query.filter(Transaction.source_file_id.in_(
-            db.session.query(Upload.id).filter(Upload.user_id == user_id)
-        ))
-        
-    query = query.group_by(Transaction.category).order_by(func.sum(Transaction.amount).desc())
-    
-    if limit and limit > 0:
-        results = query.limit(limit).all()
-    else:
-        results = query.all()
+    results = _category_totals('SALE', limit, upload_id, user_id, descending=True)
     
     incomes = []
     for r in results:
@@ -264,44 +239,48 @@ def get_top_income(limit=10, upload_id=None, user_id=None):
         
     return incomes
 
+@cached
 def get_advanced_kpis(upload_id=None, user_id=None):
-    end_date = datetime.utcnow()
-    start_date = end_date - timedelta(days=365)
+    # The last 365 days, today's date one year ago excluded
+    start_date = datetime.utcnow().date() - timedelta(days=364)
+    totals = balances.totals_between(start_date, None, upload_id=upload_id, user_id=user_id)
     
-    query = db.session.query(
-        func.sum(case((Transaction.type == 'SALE', Transaction.amount), else_=0)).label('income'),
-        func.sum(case((Transaction.type == 'PURCHASE', Transaction.amount), else_=0)).label('expense')
-    ).filter(
-        Transaction.date >= start_date
-    )
-    
-    if upload_id:
-        query = query.filter(Transaction.source_file_id == upload_id)
-    elif user_id:
-        query = query.filter(Transaction.source_file_id.in_(
-            db.session.query(Upload.id).filter(Upload.user_id == user_id)
-        ))
-        
-    totals = query.first()
-    
-    income = float(totals.income or 0)
-    expense = float(totals.expense or 0)
-    margin = income + expense
-    savings_rate = (margin / income * 100) if income > 0 else 0
+    income = float(totals['sales'])
+    expense = float(totals['purchases'])
     
+    # Type inlined in the SQL: SQLite only uses the partial (user_id, amount) indexes for a literal
     max_expense_query = db.session.query(Transaction).filter(
-        Transaction.type == 'PURCHASE'
+        Transaction.type == db.literal('PURCHASE', literal_execute=True)
     )
     
     if upload_id:
         max_expense_query = max_expense_query.filter(Transaction.source_file_id == upload_id)
     elif user_id:
-        max_expense_query = max_expense_query.filter(Transaction.source_file_id.in_(
-            db.session.query(Upload.id).filter(Upload.user_id == user_id)
-        ))
+        max_expense_query = max_expense_query.filter(Transaction.user_id == user_id)
         
     max_expense_tx = max_expense_query.order_by(Transaction.amount.asc()).first()
+
+    max_income_query = db.session.query(Transaction).filter(
+        Transaction.type == db.literal('SALE', literal_execute=True)
+    )
+
+    if upload_id:
+        max_income_query = max_income_query.filter(Transaction.source_file_id == upload_id)
+    elif user_id:
+        max_income_query = max_income_query.filter(Transaction.user_id == user_id)
+
+    max_income_tx = max_income_query.order_by(Transaction.amount.desc()).first()
     
+    return summarize_advanced_kpis(income, expense, max_expense_tx, max_income_tx)
+
+def summarize_advanced_kpis(income, expense, max_expense_tx=None, max_income_tx=None):
+    """
+    Advanced KPIs from the last 12 months' income and expense and the largest
+    purchase and sale (rows with amount, description, date, category, or None).
+    """
+    margin = income + expense
+    savings_rate = (margin / income * 100) if income > 0 else 0
+
     max_expense_val = 0
     max_expense_details = None
     
@@ -314,19 +293,6 @@ def get_advanced_kpis(upload_id=None, user_id=None):
             "category": max_expense_tx.category
         }
 
-    max_income_query = db.session.query(Transaction).filter(
-        Transaction.type == 'SALE'
-    )
-
-    if upload_id:
-        max_income_query = max_income_query.filter(Transaction.source_file_id == upload_id)
-    elif user_id:
-        max_income_query = max_income_query.filter(Transaction.source_file_id.in_(
-            db.session.query(Upload.id).filter(Upload.user_id == user_id)
-        ))
-
-    max_income_tx = max_income_query.order_by(Transaction.amount.desc()).first()
-
     max_income_val = 0
     max_income_details = None
 
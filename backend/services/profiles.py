@@ -0,0 +1,141 @@
+import hashlib
+import json
+import threading
+from collections import Counter, OrderedDict
+from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+from models import db, ColumnProfile
+
+# Profiles kept in memory, per (user_id, fingerprint)
+CACHE_SIZE = 512
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0}
+_unknown = Counter() # Misses per fingerprint, to spot layouts worth a global profile
+
+def header_fingerprint(columns):
+    """
+    Stable id of a header row: SHA-1 of the lowercased, stripped column names
+    in file order.
+    """
+    names = [str(c).lower().strip() for c in columns]
+    return hashlib.sha1('\x1f'.join(names).encode('utf-8')).hexdigest()
+
+def _entry(profile):
+    # Plain dict: cached entries outlive the session that loaded them
+    return {
+        'id': profile.id,
+        'user_id': profile.user_id,
+        'mapping': json.loads(profile.mapping),
+        'date_format': profile.date_format
+    }
+
+def _remember(key, entry):
+    with _lock:
+        _cache[key] = entry
+        _cache.move_to_end(key)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+def lookup(fingerprint, user_id=None):
+    """
+    Profile for a header fingerprint: the user's own first, then the global one.
+    Returns a dict (id, user_id, mapping, date_format) or None.
+    """
+    for owner in ([user_id, None] if user_id is not None else [None]):
+        key = (owner, fingerprint)
+        with _lock:
+            entry = _cache.get(key)
+            if entry:
+                _cache.move_to_end(key)
+        if entry is None:
+            profile = ColumnProfile.query.filter_by(fingerprint=fingerprint, user_id=owner).first()
+            if profile:
+                entry = _entry(profile)
+                _remember(key, entry)
+        if entry:
+            with _lock:
+                _stats['hits'] += 1
+            return entry
+
+    with _lock:
+        _stats['misses'] += 1
+        if fingerprint in _unknown or len(_unknown) < CACHE_SIZE:
+            _unknown[fingerprint] += 1
+    return None
+
+def record_use(entry, date_format=None):
+    """
+    Counts a successful ingestion with a known profile. Fills in the date format
+    if the profile did not have one yet. Committed by the caller.
+    """
+    values = {'hits': db.func.coalesce(ColumnProfile.hits, 0) + 1, 'last_used_at': datetime.utcnow()}
+    if date_format and not entry['date_format']:
+        values['date_format'] = date_format
+        entry['date_format'] = date_format
+    ColumnProfile.query.filter_by(id=entry['id']).update(values, synchronize_session=False)
+
+def learn(fingerprint, columns, mapping, user_id=None, date_format=None):
+    """
+    Stores the mapping detected for a header after a successful ingestion, so
+    the next file with the same header skips detection. Committed by the caller.
+    Best effort: if a concurrent upload of the same header stored it first,
+    theirs is kept, and the caller's transaction is left intact.
+    """
+    profile = ColumnProfile.query.filter_by(fingerprint=fingerprint, user_id=user_id).first()
+    if profile is None:
+        try:
+            with db.session.begin_nested(): # Savepoint: a duplicate only rolls back this insert
+                db.session.add(ColumnProfile(
+                    fingerprint=fingerprint,
+                    user_id=user_id,
+                    columns=json.dumps([str(c) for c in columns]),
+                    mapping=json.dumps(mapping),
+                    date_format=date_format,
+                    hits=0
+                ))
+        except IntegrityError:
+            pass
+        profile = ColumnProfile.query.filter_by(fingerprint=fingerprint, user_id=user_id).first()
+        if profile is None:
+            return None
+
+    with _lock:
+        _unknown.pop(fingerprint, None)
+    _remember((user_id, fingerprint), _entry(profile))
+    return profile
+
+def promote(profile):
+    """
+    Makes a user's profile global. Returns False if a global profile already
+    exists for that header. Committed by the caller.
+    """
+    if ColumnProfile.query.filter_by(fingerprint=profile.fingerprint, user_id=None).first():
+        return False
+    old_key = (profile.user_id, profile.fingerprint)
+    profile.user_id = None
+    with _lock:
+        _cache.pop(old_key, None)
+    return True
+
+def forget(profile):
+    """
+    Drops a profile from the in-memory cache (after an edit or deletion).
+    """
+    with _lock:
+        _cache.pop((profile.user_id, profile.fingerprint), None)
+
+def get_stats(top=10):
+    """
+    In-process cache counters since start-up.
+    """
+    with _lock:
+        total = _stats['hits'] + _stats['misses']
+        return {
+            'hits': _stats['hits'],
+            'misses': _stats['misses'],
+            'hit_rate': round(_stats['hits'] / total, 3) if total else None,
+            'cached': len(_cache),
+            'unknown_headers': [{'fingerprint': fp, 'misses': n} for fp, n in _unknown.most_common(top)]
+        }
@@ -0,0 +1,112 @@
+import json
+import time
+import threading
+from datetime import datetime
+from models import db, Upload
+
+# Bumped after each committed progress write, to wake the streams of this process
+_versions = {}
+_changed = threading.Condition()
+
+def publish(upload_id, finished=False):
+    """
+    Signals that new progress of an upload was committed. Streams served by
+    another process (e.g. a separate worker.py) see it at their next poll.
+    `finished`: last state, the upload's version is dropped.
+    """
+    with _changed:
+        _versions[upload_id] = _versions.get(upload_id, 0) + 1
+        _changed.notify_all()
+        if finished:
+            _versions.pop(upload_id, None) # Any change wakes the waiters
+
+def version(upload_id):
+    with _changed:
+        return _versions.get(upload_id, 0)
+
+def wait(upload_id, seen, timeout):
+    """
+    Blocks until the upload's version moves past `seen` or `timeout` seconds
+    elapse. Returns the current version.
+    """
+    with _changed:
+        _changed.wait_for(lambda: _versions.get(upload_id, 0) != seen, timeout)
+        return _versions.get(upload_id, 0)
+
+def snapshot(upload):
+    """
+    Progress event of an upload: status, stage, row counters, percentage and
+    ETA in seconds (None until it can be estimated).
+    """
+    if upload.status == 'pending':
+        stage = 'queued'
+    elif upload.status == 'processing':
+        stage = upload.stage or 'reading'
+    else:
+        stage = upload.status
+
+    processed = upload.rows_processed or 0
+    total = upload.rows_total
+    if upload.status == 'completed':
+        percent = 100
+    elif total:
+        percent = min(round(processed / total * 100), 99)
+    else:
+        percent = 0
+
+    eta = None
+    if upload.status == 'processing' and upload.started_at and total and 0 < processed < total:
+        elapsed = (datetime.utcnow() - upload.started_at).total_seconds()
+        eta = round((total - processed) * elapsed / processed)
+
+    return {
+        "upload_id": upload.id,
+        "status": upload.status,
+        "stage": stage,
+        "rows_read": processed,
+        "rows_inserted": upload.rows_inserted or 0,
+        "rows_skipped": upload.rows_skipped or 0,
+        "rows_total": total,
+        "progress": percent,
+        "eta_seconds": eta,
+        "error": upload.error_message
+    }
+
+def _message(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def stream(upload_id, poll_interval=1.0, max_seconds=120, keepalive=15):
+    """
+    Server-Sent Events for an upload: a 'progress' event whenever it changes,
+    until it is completed or failed (last event), or `max_seconds` elapsed
+    (the client then reconnects). The Upload row is the source of truth; it
+    is read again when this process publishes progress, or every
+    `poll_interval` seconds for work running elsewhere.
+    """
+    deadline = time.monotonic() + max_seconds
+    last, last_sent = None, time.monotonic()
+    seen = version(upload_id)
+    yield f"retry: {int(poll_interval * 1000)}\n\n"
+
+    while True:
+        db.session.expire_all()
+        upload = db.session.get(Upload, upload_id)
+        event = snapshot(upload) if upload else None
+        db.session.rollback() # Hand the connection back to the pool while waiting
+
+        if event is None:
+            yield _message('progress', {"upload_id": upload_id, "status": 'error', "stage": 'error', "error": "Upload not found"})
+            return
+
+        # The ETA alone moving is not news
+        key = {k: v for k, v in event.items() if k != 'eta_seconds'}
+        if key != last:
+            yield _message('progress', event)
+            last, last_sent = key, time.monotonic()
+        elif time.monotonic() - last_sent > keepalive:
+            yield ": keep-alive\n\n"
+            last_sent = time.monotonic()
+
+        if event['status'] in ('completed', 'error') or time.monotonic() > deadline:
+            return
+        seen = wait(upload_id, seen, poll_interval)
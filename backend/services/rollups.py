@@ -0,0 +1,173 @@
+from datetime import date
+from decimal import Decimal
+import numpy as np
+import pandas as pd
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from models import db, Transaction, Upload, MonthlyRollup
+from utils import format_date_sql
+
+# Columns identifying a rollup row
+KEY = ['upload_id', 'month', 'type', 'category']
+
+def scope(upload_id=None, user_id=None):
+    """Filters on MonthlyRollup matching the kpi scope of an upload or a user."""
+    if upload_id:
+        return [MonthlyRollup.upload_id == upload_id]
+    if user_id:
+        return [MonthlyRollup.user_id == user_id]
+    return []
+
+def _transaction_scope(upload_id=None, user_id=None):
+    if upload_id:
+        return [Transaction.source_file_id == upload_id]
+    if user_id:
+        return [Transaction.user_id == user_id]
+    return []
+
+def _decimal(cents):
+    return Decimal(int(cents)).scaleb(-2)
+
+def _merge(records):
+    """
+    Adds rollup records (dicts with every column but id) to the stored rows
+    of the same key: totals and counts are summed, min and max combined.
+    """
+    if not records:
+        return
+    table = MonthlyRollup.__table__
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        insert = postgresql_insert if dialect == 'postgresql' else sqlite_insert
+        # SQLite's two-argument min()/max() are scalar, PostgreSQL spells them least()/greatest()
+        least, greatest = (func.least, func.greatest) if dialect == 'postgresql' else (func.min, func.max)
+        stmt = insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=KEY,
+            set_={
+                'total': table.c.total + stmt.excluded.total,
+                'count': table.c.count + stmt.excluded.count,
+                'min_amount': least(table.c.min_amount, stmt.excluded.min_amount),
+                'max_amount': greatest(table.c.max_amount, stmt.excluded.max_amount)
+            }
+        )
+        db.session.execute(stmt, records)
+        return
+
+    # No portable upsert: update the keys already stored, insert the others
+    for record in records:
+        row = MonthlyRollup.query.filter_by(**{k: record[k] for k in KEY}).first()
+        if row is None:
+            db.session.add(MonthlyRollup(**record))
+            continue
+        row.total += record['total']
+        row.count += record['count']
+        row.min_amount = min(row.min_amount, record['min_amount'])
+        row.max_amount = max(row.max_amount, record['max_amount'])
+    db.session.flush()
+
+def add(upload_id, user_id, normalized):
+    """
+    Adds a chunk of normalized rows just inserted for `upload_id` to its
+    rollup, in the session's transaction.
+    """
+    if normalized.empty:
+        return
+    cents = (normalized['amount'].astype(float) * 100).round().astype('int64')
+    # A chunk spans few distinct days: format those only
+    codes, days = pd.factorize(normalized['date'])
+    frame = pd.DataFrame({
+        'month': np.array([d.strftime('%Y-%m') for d in days], dtype=object)[codes],
+        'type': normalized['type'].fillna('').to_numpy(dtype=object),
+        'category': normalized['category'].fillna('').to_numpy(dtype=object),
+        'cents': cents.to_numpy()
+    })
+    grouped = frame.groupby(['month', 'type', 'category'])['cents'].agg(['sum', 'size', 'min', 'max'])
+    _merge([
+        {
+            'user_id': user_id, 'upload_id': upload_id, 'month': month, 'type': type_, 'category': category,
+            'total': _decimal(total), 'count': int(count), 'min_amount': _decimal(low), 'max_amount': _decimal(high)
+        }
+        for (month, type_, category), total, count, low, high in zip(
+            grouped.index, grouped['sum'], grouped['size'], grouped['min'], grouped['max']
+        )
+    ])
+
+def delete(*upload_ids):
+    """Drops the rollup of uploads whose transactions are being deleted."""
+    if upload_ids:
+        MonthlyRollup.query.filter(MonthlyRollup.upload_id.in_(upload_ids)).delete(synchronize_session=False)
+
+def move(source_id, target_id):
+    """Merges the rollup of `source_id` into `target_id` (rows of a statement refresh)."""
+    rows = MonthlyRollup.query.filter_by(upload_id=source_id).all()
+    target = Upload.query.get(target_id)
+    records = [
+        {
+            'user_id': target.user_id, 'upload_id': target_id, 'month': r.month, 'type': r.type, 'category': r.category,
+            'total': r.total, 'count': r.count, 'min_amount': r.min_amount, 'max_amount': r.max_amount
+        }
+        for r in rows
+    ]
+    delete(source_id)
+    _merge(records)
+
+def refresh(upload_id, months=None):
+    """
+    Recomputes the rollup of an upload from its transactions, or only the
+    listed months ('YYYY-MM'), with a single INSERT ... SELECT. For changes
+    that are not plain inserts (re-classification) and for backfills.
+    """
+    upload = Upload.query.get(upload_id)
+    stale = MonthlyRollup.query.filter(MonthlyRollup.upload_id == upload_id)
+    if months is not None:
+        months = sorted(set(months))
+        if not months:
+            return
+        stale = stale.filter(MonthlyRollup.month.in_(months))
+    stale.delete(synchronize_session=False)
+
+    month = format_date_sql(Transaction.date, '%Y-%m')
+    # Labels unlike the source column names: PostgreSQL reads those as input columns in GROUP BY
+    select = db.select(
+        db.literal(upload.user_id if upload else None, db.Integer),
+        db.literal(upload_id, db.Integer),
+        month.label('month_key'),
+        func.coalesce(Transaction.type, '').label('type_key'),
+        func.coalesce(Transaction.category, '').label('category_key'),
+        func.sum(Transaction.amount),
+        func.count(),
+        func.min(Transaction.amount),
+        func.max(Transaction.amount)
+    ).where(Transaction.source_file_id == upload_id)
+    if months is not None:
+        select = select.where(month.in_(months))
+    select = select.group_by(db.text('month_key'), db.text('type_key'), db.text('category_key'))
+
+    db.session.execute(MonthlyRollup.__table__.insert().from_select(
+        ['user_id', 'upload_id', 'month', 'type', 'category', 'total', 'count', 'min_amount', 'max_amount'],
+        select
+    ))
+
+def rebuild(upload_ids=None):
+    """
+    Rebuilds the rollup of the given uploads (default: all of them), one
+    committed upload at a time. Returns the number of uploads rebuilt.
+    """
+    if upload_ids is None:
+        upload_ids = [u.id for u in Upload.query.with_entities(Upload.id).order_by(Upload.id)]
+    for upload_id in upload_ids:
+        refresh(upload_id)
+        db.session.commit()
+    return len(upload_ids)
+
+def latest_month(upload_id=None, user_id=None):
+    """Latest 'YYYY-MM' with transactions in the scope, None if there is none."""
+    return db.session.query(func.max(MonthlyRollup.month)).filter(*scope(upload_id, user_id)).scalar()
+
+def month_start(value):
+    return date(value.year, value.month, 1)
+
+def next_month(value):
+    return date(value.year + value.month // 12, value.month % 12 + 1, 1)
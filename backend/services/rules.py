@@ -0,0 +1,437 @@
+import os
+import re
+import time
+import threading
+import traceback
+import numpy as np
+import pandas as pd
+from datetime import datetime
+try:
+    from re import _constants as sre_constants, _parser as sre_parse # Python 3.11+
+except ImportError:
+    import sre_constants, sre_parse
+from models import db, CategoryRule, Transaction, Upload
+from services import balances, cache, rollups
+from services.classification import CATEGORY_MATCHER
+
+MATCH_KINDS = ['keyword', 'regex', 'third_party', 'amount']
+RULE_TYPES = ['SALE', 'PURCHASE', 'OTHER']
+
+# Stored rows re-classified (and committed) at a time by reclassify()
+RECLASSIFY_CHUNK = int(os.getenv('RECLASSIFY_CHUNK_SIZE', 5000))
+# Ids per UPDATE ... WHERE id IN (...), below SQLite's bound parameter limit
+UPDATE_BATCH = 500
+# Longest regex rule pattern accepted
+MAX_PATTERN_LENGTH = 200
+
+# Parsed-regex opcodes read by _backtracks(), from re's internal parser
+_REPEATS = tuple(getattr(sre_constants, name) for name in ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT') if hasattr(sre_constants, name))
+_ATOMIC_GROUP = getattr(sre_constants, 'ATOMIC_GROUP', None) # Python 3.11+
+
+_cache = {} # user_id -> (signature, RuleSet or None)
+_lock = threading.Lock()
+_running = {} # user_id (None = all users) -> thread
+_last_runs = {}
+
+def _text_branch(index, pattern):
+    # Optional lookahead: the group is set when the rule matches, whatever the others do
+    return f'(?:(?=.*?(?P<rule{index}>{pattern})))?'
+
+def _backtracks(items, repeated=False):
+    """
+    True if a parsed regex has a variable repeat or alternatives inside an
+    unbounded repeat, as in (a+)+ or (a|ab)*: on a text that almost matches,
+    the engine tries every way of splitting it, which takes exponential time.
+    """
+    for op, av in items:
+        if op in _REPEATS:
+            low, high, body = av
+            if (repeated and low != high) or _backtracks(body, repeated or high == sre_constants.MAXREPEAT):
+                return True
+        elif op is sre_constants.BRANCH:
+            if repeated or any(_backtracks(branch, repeated) for branch in av[1]):
+                return True
+        elif op is sre_constants.SUBPATTERN:
+            if _backtracks(av[3], repeated):
+                return True
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            if _backtracks(av[1], repeated):
+                return True
+        elif _ATOMIC_GROUP is not None and op is _ATOMIC_GROUP:
+            if _backtracks(av, repeated):
+                return True
+    return False
+
+def validate(data):
+    """
+    Checks rule fields (a dict as received by the API).
+    Returns an error message, or None if the rule is valid.
+    """
+    kind = data.get('kind')
+    if kind not in MATCH_KINDS:
+        return f"kind must be one of: {', '.join(MATCH_KINDS)}"
+    pattern = (data.get('pattern') or '').strip()
+    if kind != 'amount' and not pattern:
+        return "pattern is required"
+    if kind == 'regex':
+        # Rules are compiled together: their groups must not clash
+        if '(?P' in pattern or re.search(r'\\[1-9]', pattern):
+            return "Named groups and backreferences are not supported in rule patterns"
+        if len(pattern) > MAX_PATTERN_LENGTH:
+            return f"Regular expressions are limited to {MAX_PATTERN_LENGTH} characters"
+        try:
+            re.compile('^' + _text_branch(0, pattern))
+        except re.error as e:
+            return f"Invalid regular expression: {e}"
+        # All rules of a user run in one regex, on the shared ingestion threads
+        if _backtracks(sre_parse.parse(pattern)):
+            return "Repeating a group that itself repeats or has alternatives, as in (a+)+ or (a|ab)*, is not supported in rule patterns"
+
+    try:
+        low = float(data['amount_min']) if data.get('amount_min') not in (None, '') else None
+        high = float(data['amount_max']) if data.get('amount_max') not in (None, '') else None
+    except (TypeError, ValueError):
+        return "amount_min and amount_max must be numbers"
+    if kind == 'amount' and low is None and high is None:
+        return "An amount rule needs amount_min or amount_max"
+    if low is not None and high is not None and low > high:
+        return "amount_min is greater than amount_max"
+
+    if not data.get('category') and not data.get('type'):
+        return "A rule must set a category or a type"
+    if data.get('type') and data['type'] not in RULE_TYPES:
+        return f"type must be one of: {', '.join(RULE_TYPES)}"
+    try:
+        int(data.get('priority', 100))
+    except (TypeError, ValueError):
+        return "priority must be an integer"
+    return None
+
+def update_rule(rule, data):
+    """
+    Copies validated API fields onto a CategoryRule. Committed by the caller.
+    """
+    rule.kind = data['kind']
+    rule.pattern = (data.get('pattern') or '').strip() or None
+    rule.amount_min = data.get('amount_min') if data.get('amount_min') not in (None, '') else None
+    rule.amount_max = data.get('amount_max') if data.get('amount_max') not in (None, '') else None
+    rule.category = data.get('category') or None
+    rule.type = data.get('type') or None
+    rule.priority = int(data.get('priority', 100))
+    rule.active = bool(data.get('active', True))
+    rule.updated_at = datetime.utcnow()
+
+def serialize_rule(rule):
+    return {
+        "id": rule.id,
+        "user_id": rule.user_id,
+        "global": rule.user_id is None,
+        "kind": rule.kind,
+        "pattern": rule.pattern,
+        "amount_min": float(rule.amount_min) if rule.amount_min is not None else None,
+        "amount_max": float(rule.amount_max) if rule.amount_max is not None else None,
+        "category": rule.category,
+        "type": rule.type,
+        "priority": rule.priority,
+        "active": bool(rule.active)
+    }
+
+class RuleSet:
+    """
+    Active rules of a user followed by the global ones, compiled once for
+    column-wise matching. Keyword and regex rules share a single regex with
+    one optional lookahead per rule, so a text is scanned once for all of
+    them; third-party rules are looked up by lowercase name; amount ranges
+    are compared as arrays.
+
+    For each row, the first matching rule (user's before global, then by
+    priority and id) having a category sets the category, and the first one
+    having a type sets the type.
+    """
+    def __init__(self, rules):
+        self.ids = np.array([r['id'] for r in rules], dtype=object)
+        self.categories = np.array([r['category'] for r in rules], dtype=object)
+        self.types = np.array([r['type'] for r in rules], dtype=object)
+        self.sets_category = np.array([bool(r['category']) for r in rules])
+        self.sets_type = np.array([bool(r['type']) for r in rules])
+        self.lows = np.array([-np.inf if r['amount_min'] is None else float(r['amount_min']) for r in rules])
+        self.highs = np.array([np.inf if r['amount_max'] is None else float(r['amount_max']) for r in rules])
+        self.bounded = bool(np.isfinite(self.lows).any() or np.isfinite(self.highs).any())
+
+        branches = []
+        self.text_rules = []
+        self.third_party_rules = []
+        self.by_third_party = {}
+        for i, rule in enumerate(rules):
+            if rule['kind'] == 'keyword':
+                branches.append(_text_branch(i, re.escape(rule['pattern'].lower())))
+                self.text_rules.append(i)
+            elif rule['kind'] == 'regex':
+                branches.append(_text_branch(i, rule['pattern']))
+                self.text_rules.append(i)
+            elif rule['kind'] == 'third_party':
+                self.by_third_party.setdefault(rule['pattern'].lower().strip(), []).append(i)
+                self.third_party_rules.append(i)
+        self.text_pattern = '^' + ''.join(branches) if branches else None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def matches(self, frame):
+        """
+        Boolean matrix (rows x rules): which rules match each row of a frame
+        with description, amount and third_party columns.
+        """
+        ok = np.ones((len(frame), len(self.ids)), dtype=bool)
+
+        if self.text_rules:
+            codes, uniques = pd.factorize(frame['description'].fillna(''))
+            found = pd.Series(uniques, dtype=object).str.extract(self.text_pattern, flags=re.DOTALL | re.IGNORECASE)
+            found = found[[f'rule{i}' for i in self.text_rules]].notna().to_numpy()
+            found = np.vstack([found, np.zeros((1, len(self.text_rules)), dtype=bool)]) # Code -1: no text
+            ok[:, self.text_rules] = found[codes]
+
+        if self.third_party_rules:
+            codes, uniques = pd.factorize(frame['third_party'].fillna('').str.lower().str.strip())
+            table = np.zeros((len(uniques) + 1, len(self.ids)), dtype=bool)
+            for code, name in enumerate(uniques):
+                for i in self.by_third_party.get(name, ()):
+                    table[code, i] = True
+            ok[:, self.third_party_rules] = table[codes][:, self.third_party_rules]
+
+        if self.bounded:
+            amounts = np.abs(frame['amount'].to_numpy(dtype=float))[:, None]
+            ok &= (amounts >= self.lows) & (amounts <= self.highs)
+        return ok
+
+    def apply(self, frame):
+        """
+        Returns a copy of a normalized frame with the rules applied: category,
+        type (the amount sign follows it) and rule_id (first matching rule,
+        None where no rule matched). original_type and original_amount keep
+        the type and amount a rule overrode; rows no rule gives a type get
+        theirs back.
+        """
+        ok = self.matches(frame)
+        result = frame.copy()
+
+        with_category = ok & self.sets_category
+        has_category = with_category.any(axis=1)
+        result['category'] = np.where(has_category, self.categories[with_category.argmax(axis=1)], frame['category'].to_numpy(dtype=object))
+
+        with_type = ok & self.sets_type
+        has_type = with_type.any(axis=1)
+        original_types, amounts = _pre_rule(frame)
+        types = np.where(has_type, self.types[with_type.argmax(axis=1)], original_types)
+        result['type'] = types
+        result['amount'] = np.select(
+            [has_type & (types == 'PURCHASE'), has_type & (types == 'SALE')],
+            [-np.abs(amounts), np.abs(amounts)],
+            default=amounts
+        )
+        result['original_type'] = np.where(has_type, original_types, None)
+        result['original_amount'] = np.where(has_type, amounts, None)
+        matched = ok.any(axis=1)
+        result['rule_id'] = np.where(matched, self.ids[ok.argmax(axis=1)], None)
+        return result
+
+def _pre_rule(frame):
+    """Type and amount of each row before a rule set its type."""
+    types = frame['type'].to_numpy(dtype=object)
+    amounts = frame['amount'].to_numpy(dtype=float)
+    if 'original_type' in frame:
+        kept = frame['original_type'].notna().to_numpy()
+        types = np.where(kept, frame['original_type'].to_numpy(dtype=object), types)
+        amounts = np.where(kept, frame['original_amount'].to_numpy(dtype=float, na_value=np.nan), amounts)
+    return types, amounts
+
+def _owned(query, user_id):
+    if user_id is None:
+        return query.filter(CategoryRule.user_id.is_(None))
+    return query.filter(db.or_(CategoryRule.user_id == user_id, CategoryRule.user_id.is_(None)))
+
+def for_user(user_id):
+    """
+    Compiled RuleSet of a user (their rules, then the global ones), None if
+    there is no active rule. Cached per process until a rule changes.
+    """
+    signature = tuple(_owned(
+        db.session.query(db.func.count(CategoryRule.id), db.func.max(CategoryRule.updated_at)), user_id
+    ).one())
+    with _lock:
+        cached = _cache.get(user_id)
+    if cached and cached[0] == signature:
+        return cached[1]
+
+    rules = _owned(CategoryRule.query.filter(CategoryRule.active.is_(True)), user_id).order_by(
+        CategoryRule.user_id.is_(None), CategoryRule.priority, CategoryRule.id
+    ).all()
+    ruleset = RuleSet([{
+        'id': r.id, 'kind': r.kind, 'pattern': r.pattern or '',
+        'amount_min': r.amount_min, 'amount_max': r.amount_max,
+        'category': r.category, 'type': r.type
+    } for r in rules]) if rules else None
+    with _lock:
+        _cache[user_id] = (signature, ruleset)
+    return ruleset
+
+def _builtin(frame):
+    """
+    Category the built-in keywords give rows no rule matches anymore, and the
+    type that follows their sign (for rows typed by a rule before
+    original_type was kept).
+    """
+    categories = CATEGORY_MATCHER.classify(frame['description'].fillna('').str.lower(), default='Autre')
+    amounts = frame['amount'].to_numpy(dtype=float)
+    types = np.select([amounts < 0, amounts > 0], ['PURCHASE', 'SALE'], default='OTHER')
+    return categories.to_numpy(dtype=object), types.astype(object)
+
+def _reclassify_owner(user_id, chunk_size, stats):
+    ruleset = for_user(user_id)
+    owner = Transaction.user_id.is_(None) if user_id is None else Transaction.user_id == user_id
+    columns = [
+        'id', 'description', 'amount', 'type', 'category', 'third_party', 'rule_id',
+        'original_type', 'original_amount', 'source_file_id', 'date'
+    ]
+
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            db.select(*(getattr(Transaction, c) for c in columns))
+            .where(owner, Transaction.id > last_id)
+            .order_by(Transaction.id)
+            .limit(chunk_size)
+        ).all()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+
+        frame = pd.DataFrame(rows, columns=columns)
+        frame['amount'] = frame['amount'].astype(float)
+        frame['original_amount'] = pd.to_numeric(frame['original_amount']).astype(float)
+        if ruleset:
+            result = ruleset.apply(frame)
+        else:
+            types, amounts = _pre_rule(frame)
+            result = frame.assign(type=types, amount=amounts, original_type=None, original_amount=None, rule_id=None)
+
+        # Rows an old rule had classified get the built-in category back, and
+        # their original type (restored above) or, if none was kept, that of their sign
+        released = (frame['rule_id'].notna() & result['rule_id'].isna()).to_numpy()
+        if released.any():
+            categories, types = _builtin(frame[released])
+            result.loc[released, 'category'] = categories
+            unknown = released & frame['original_type'].isna().to_numpy()
+            result.loc[unknown, 'type'] = types[unknown[released]]
+
+        flip = np.sign(result['amount'].to_numpy(dtype=float)) != np.sign(frame['amount'].to_numpy(dtype=float))
+        old_rule = frame['rule_id'].fillna(0).astype(int).to_numpy()
+        new_rule = result['rule_id'].fillna(0).astype(int).to_numpy()
+        had_original = frame['original_type'].notna().to_numpy()
+        has_original = result['original_type'].notna().to_numpy()
+        changed = (
+            (result['category'].to_numpy(dtype=object) != frame['category'].to_numpy(dtype=object))
+            | (result['type'].to_numpy(dtype=object) != frame['type'].to_numpy(dtype=object))
+            | (new_rule != old_rule) | flip | (had_original != has_original)
+        )
+
+        updates = pd.DataFrame({
+            'id': frame['id'].to_numpy()[changed],
+            'category': result['category'].to_numpy(dtype=object)[changed],
+            'type': result['type'].to_numpy(dtype=object)[changed],
+            'rule_id': new_rule[changed],
+            'flip': flip[changed],
+            'original': np.select([has_original & ~had_original, had_original & ~has_original], ['keep', 'drop'], default='')[changed]
+        })
+        # One set-based UPDATE per distinct outcome, ids in bounded batches
+        groups = updates.groupby(['category', 'type', 'rule_id', 'flip', 'original'], dropna=False)['id']
+        for (category, type_, rule_id, flipped, original), ids in groups:
+            values = {
+                'category': None if pd.isna(category) else category,
+                'type': None if pd.isna(type_) else type_,
+                'rule_id': int(rule_id) or None
+            }
+            if flipped:
+                values['amount'] = -Transaction.amount
+            if original == 'keep':
+                # The right-hand sides read the row as it was before this UPDATE
+                values['original_type'] = Transaction.type
+                values['original_amount'] = Transaction.amount
+            elif original == 'drop':
+                values['original_type'] = None
+                values['original_amount'] = None
+            ids = ids.tolist()
+            for start in range(0, len(ids), UPDATE_BATCH):
+                db.session.execute(
+                    db.update(Transaction).where(Transaction.id.in_(ids[start:start + UPDATE_BATCH])).values(values)
+                )
+        # Monthly rollups of the months touched, and daily balances of the days, in the same commit
+        touched = frame.loc[changed, ['source_file_id', 'date']]
+        for upload_id, dates in touched.groupby('source_file_id')['date']:
+            rollups.refresh(int(upload_id), {d.strftime('%Y-%m') for d in dates})
+            balances.refresh(int(upload_id), dates.tolist())
+        if changed.any():
+            cache.invalidate(user_id)
+        db.session.commit() # Per chunk: locks are held for one chunk only
+
+        stats['scanned'] += len(frame)
+        stats['updated'] += len(updates)
+        stats['chunks'] += 1
+
+def reclassify(user_id=None, chunk_size=None, all_users=False):
+    """
+    Applies the current rules to the stored transactions of a user, or of
+    every user with `all_users` (after a global rule changed). Only the
+    columns rules look at are read, `chunk_size` rows at a time in id order;
+    changed rows are written with set-based UPDATEs and each chunk is
+    committed on its own, so no lock is held for long.
+
+    Rows matched by no rule keep their category, unless a rule had set it:
+    those get the built-in keyword category back. Rows no rule gives a type
+    get back the type and amount they had before one did.
+    Returns counters: scanned, updated, chunks, seconds.
+    """
+    start = time.perf_counter()
+    stats = {'scanned': 0, 'updated': 0, 'chunks': 0}
+    if all_users:
+        owners = [u for (u,) in db.session.query(Upload.user_id).distinct()]
+    else:
+        owners = [user_id]
+    for owner in owners:
+        _reclassify_owner(owner, chunk_size or RECLASSIFY_CHUNK, stats)
+    stats['seconds'] = round(time.perf_counter() - start, 3)
+    return stats
+
+def _run(app, user_id, all_users):
+    key = 'all' if all_users else user_id
+    try:
+        with app.app_context():
+            stats = reclassify(user_id, all_users=all_users)
+            stats['finished_at'] = datetime.utcnow().isoformat(timespec='seconds')
+            print(f"Reclassification ({'all users' if all_users else f'user {user_id}'}): "
+                  f"{stats['updated']} of {stats['scanned']} transaction(s) updated in {stats['seconds']}s")
+    except Exception as e:
+        traceback.print_exc()
+        stats = {'error': str(e)}
+    with _lock:
+        _last_runs[key] = stats
+        _running.pop(key, None)
+
+def start_reclassify(app, user_id=None, all_users=False):
+    """
+    Runs reclassify() in a background thread. Returns False if one is already
+    running for the same scope.
+    """
+    key = 'all' if all_users else user_id
+    with _lock:
+        if key in _running:
+            return False
+        thread = threading.Thread(target=_run, args=(app, user_id, all_users), name='reclassify', daemon=True)
+        _running[key] = thread
+    thread.start()
+    return True
+
+def reclassify_status(user_id=None, all_users=False):
+    key = 'all' if all_users else user_id
+    with _lock:
+        return {'running': key in _running, 'last': _last_runs.get(key)}
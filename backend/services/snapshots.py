@@ -0,0 +1,153 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+except ImportError: # Optional: without it, reprocessing reads the original file
+    pa = None
+
+# Bump when the layout changes: older snapshots are then ignored
+SNAPSHOT_VERSION = 1
+
+log = logging.getLogger(__name__)
+
+def available():
+    return pa is not None
+
+def snapshot_dir(file_path, sheet=None):
+    """
+    Snapshot of a stored file, next to it: '<file>.snapshot', or
+    '<file>.<sheet digest>.snapshot' for a given .xlsx sheet.
+    """
+    if sheet:
+        return f"{file_path}.{hashlib.sha1(sheet.encode('utf-8')).hexdigest()[:8]}.snapshot"
+    return f"{file_path}.snapshot"
+
+def load_meta(file_path, sheet=None):
+    """
+    Metadata of a complete snapshot ({'header', 'columns', 'rows', 'parts'}),
+    None if there is none or it cannot be read here.
+    """
+    if pa is None:
+        return None
+    try:
+        with open(os.path.join(snapshot_dir(file_path, sheet), 'meta.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get('version') != SNAPSHOT_VERSION:
+        return None
+    return meta
+
+def covers(meta, columns):
+    """Does the snapshot hold all these (lowercase) columns."""
+    return meta is not None and set(columns) <= set(meta['columns'])
+
+def _to_table(chunk):
+    try:
+        return pa.Table.from_pandas(chunk, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Mixed cells (e.g. dates and text in one Excel column) are stored as text
+        chunk = chunk.copy()
+        for col in chunk.columns:
+            try:
+                pa.array(chunk[col], from_pandas=True)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                chunk[col] = chunk[col].map(lambda v: v if v is None or pd.isna(v) else str(v))
+        return pa.Table.from_pandas(chunk, preserve_index=False)
+
+class SnapshotWriter:
+    """
+    Writes the raw chunks of a file as Arrow IPC files, one per chunk, in a
+    temporary directory renamed into place by commit(). Chunks may differ in
+    dtypes, each part keeps its own schema.
+
+    Each writer has a directory of its own: worker threads (same pid) may
+    snapshot the same stored file at once.
+    """
+    def __init__(self, file_path, sheet=None, header=None):
+        self.path = snapshot_dir(file_path, sheet)
+        self.header = [str(c) for c in (header or [])]
+        self.columns = None
+        self.parts = 0
+        self.rows = 0
+        self.tmp = tempfile.mkdtemp(prefix=os.path.basename(self.path) + '.tmp-', dir=os.path.dirname(self.path) or None)
+
+    def write(self, chunk):
+        if self.columns is None:
+            self.columns = [str(c) for c in chunk.columns]
+        table = _to_table(chunk)
+        with pa.OSFile(os.path.join(self.tmp, f'part-{self.parts:05d}.arrow'), 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        self.parts += 1
+        self.rows += len(chunk)
+
+    def commit(self):
+        """
+        Puts the snapshot in place. Returns False if it could not be (e.g.
+        another writer of the same file renamed its own meanwhile): a snapshot
+        is only an optimization, the caller carries on without it.
+        """
+        try:
+            with open(os.path.join(self.tmp, 'meta.json'), 'w') as f:
+                json.dump({
+                    'version': SNAPSHOT_VERSION,
+                    'header': self.header,
+                    'columns': self.columns or [],
+                    'rows': self.rows,
+                    'parts': self.parts
+                }, f)
+            shutil.rmtree(self.path, ignore_errors=True)
+            os.replace(self.tmp, self.path)
+            return True
+        except OSError as e:
+            log.warning("Snapshot of %s not kept: %s", self.path, e)
+            self.abort()
+            return False
+
+    def abort(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+def open_writer(file_path, sheet=None, header=None):
+    """
+    SnapshotWriter, or None when pyarrow is missing or the folder is not writable.
+    """
+    if pa is None:
+        return None
+    try:
+        return SnapshotWriter(file_path, sheet, header)
+    except OSError as e:
+        log.warning("Snapshot disabled for %s: %s", file_path, e)
+        return None
+
+def iter_chunks(file_path, sheet=None, columns=None, meta=None):
+    """
+    Yields the snapshot parts as DataFrames. Files are memory-mapped and only
+    `columns` (lowercase names) are materialized.
+    """
+    meta = meta or load_meta(file_path, sheet)
+    folder = snapshot_dir(file_path, sheet)
+    for part in range(meta['parts']):
+        with pa.memory_map(os.path.join(folder, f'part-{part:05d}.arrow'), 'r') as source:
+            table = pa.ipc.open_file(source).read_all()
+            if columns:
+                table = table.select([c for c in table.column_names if c in columns])
+            yield table.to_pandas()
+
+def remove(file_path):
+    """
+    Deletes every snapshot of a stored file (all sheets).
+    """
+    folder, name = os.path.split(file_path)
+    if not os.path.isdir(folder):
+        return
+    for entry in os.listdir(folder):
+        if entry.startswith(name + '.') and '.snapshot' in entry[len(name):]:
+            shutil.rmtree(os.path.join(folder, entry), ignore_errors=True)
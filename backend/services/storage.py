@@ -0,0 +1,81 @@
+import hashlib
+import os
+import tempfile
+from models import Upload
+from services import snapshots
+
+# Bytes read from the request stream at a time while hashing
+BLOCK_SIZE = 1 << 20
+
+def upload_folder(app):
+    folder = os.path.join(app.root_path, 'uploads')
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    return folder
+
+def blob_name(content_hash, filename):
+    """
+    Stored files are named after their SHA-256, keeping the original extension
+    so the parser can tell CSV from Excel.
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    return f"{content_hash}{ext}"
+
+def save_stream(app, stream, filename):
+    """
+    Copies an uploaded file to the uploads folder while computing its SHA-256.
+    Identical content is stored once. Returns (content_hash, path).
+    """
+    folder = upload_folder(app)
+    sha256 = hashlib.sha256()
+
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.incoming-')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            for block in iter(lambda: stream.read(BLOCK_SIZE), b''):
+                sha256.update(block)
+                out.write(block)
+
+        content_hash = sha256.hexdigest()
+        path = os.path.join(folder, blob_name(content_hash, filename))
+        if os.path.exists(path):
+            os.remove(tmp_path) # Same content already stored
+        else:
+            os.replace(tmp_path, path)
+        return content_hash, path
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def blob_path(app, upload):
+    """
+    Path of the file behind an upload. Uploads stored before content addressing
+    have no hash and live under their original filename.
+    """
+    if upload.content_hash:
+        return os.path.join(app.root_path, 'uploads', blob_name(upload.content_hash, upload.filename))
+    return os.path.join(app.root_path, 'uploads', upload.filename)
+
+def release_blob(app, upload):
+    """
+    Deletes the file of an upload that was just deleted, unless another upload
+    still references the same content. Call after the deletion is committed.
+    """
+    path = blob_path(app, upload)
+    if upload.content_hash:
+        still_used = Upload.query.filter(
+            Upload.content_hash == upload.content_hash,
+            Upload.id != upload.id
+        ).count()
+    else:
+        still_used = Upload.query.filter(
+            Upload.filename == upload.filename,
+            Upload.content_hash.is_(None),
+            Upload.id != upload.id
+        ).count()
+
+    if not still_used:
+        if os.path.exists(path):
+            os.remove(path)
+        snapshots.remove(path)
@@ -0,0 +1,180 @@
+"""
+Seeded synthetic statements for capacity planning and benchmarks.
+
+Generates N users x M transactions per year x Y years, one file per user and
+year, written in the layouts we receive from customers:
+
+  montant       Date;Libellé;Montant;Tiers;Devise   amounts with a decimal comma
+  debit_credit  Date,Libellé,Débit,Crédit,Tiers     accounting export, dot decimals
+  excel_serial  Date;Libellé;Montant                dates as Excel serial numbers
+  xlsx          Excel workbook with title rows above a Débit/Crédit table
+
+The same seed always produces the same files. A manifest.json listing the
+files (user, year, variant, rows) is written next to them.
+
+Usage: python synthetic_data.py OUT_DIR [--users N] [--transactions M] [--years Y]
+                                [--variants montant,xlsx,...] [--seed S]
+"""
+import os
+import json
+import argparse
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+VARIANTS = ['montant', 'debit_credit', 'excel_serial', 'xlsx']
+
+# Descriptions drawn for each side. Income labels avoid the
+# expense keywords so they stay sales once ingested.
+INCOME = [
+    'Règlement client', 'Encaissement TPE', 'Remise de chèque', 'Vente comptoir',
+    'Acompte client', 'Encaissement Stripe'
+]
+EXPENSES = [
+    'Paiement Loyer', 'Prélèvement EDF', 'CB Carrefour', 'Facture Orange', 'Cotisation URSSAF',
+    'Achat fournitures', 'Uber Trip', 'SNCF Voyage', 'Frais bancaires', 'Assurance RC Pro',
+    'Netflix', 'Pharmacie du centre', 'Essence Total', 'Honoraires comptable'
+]
+CURRENCY = 'EUR'
+
+def generate_statement(user, year, transactions, seed=0):
+    """
+    Transactions of one user over one calendar year, sorted by date: about a
+    third income, the rest expenses, plus a monthly rent and payroll.
+    Returns a DataFrame: date, description, amount, third_party.
+    """
+    rng = np.random.default_rng([seed, user, year])
+    days = np.sort(rng.integers(0, 365, transactions))
+    dates = pd.Timestamp(year, 1, 1) + pd.to_timedelta(days, unit='D')
+
+    income = rng.random(transactions) < 0.35
+    amounts = np.where(income, rng.uniform(200, 6000, transactions), -rng.uniform(5, 1500, transactions))
+    descriptions = np.where(
+        income,
+        rng.choice(INCOME, transactions),
+        rng.choice(EXPENSES, transactions)
+    )
+    third_parties = np.where(
+        income,
+        np.char.add('Client ', rng.integers(1, 200, transactions).astype(str)),
+        np.char.add('Fournisseur ', rng.integers(1, 60, transactions).astype(str))
+    )
+
+    frame = pd.DataFrame({
+        'date': dates,
+        'description': descriptions.astype(object),
+        'amount': np.round(amounts, 2),
+        'third_party': third_parties.astype(object)
+    })
+
+    fixed = pd.DataFrame({
+        'date': [pd.Timestamp(year, month, day) for month in range(1, 13) for day in (1, 28)],
+        'description': ['Loyer Bureau', 'Salaires'] * 12,
+        'amount': [-1200.0, -4500.0] * 12,
+        'third_party': ['SCI Bureaux', 'Personnel'] * 12
+    })
+    return pd.concat([frame, fixed], ignore_index=True).sort_values('date', kind='stable', ignore_index=True)
+
+def _debit_credit(frame):
+    debit = (-frame['amount']).where(frame['amount'] < 0)
+    credit = frame['amount'].where(frame['amount'] > 0)
+    return debit, credit
+
+def write_variant(frame, path, variant):
+    """
+    Writes a statement in one of the VARIANTS layouts. Returns the path.
+    """
+    if variant == 'montant':
+        out = pd.DataFrame({
+            'Date': frame['date'].dt.strftime('%d/%m/%Y'),
+            'Libellé': frame['description'],
+            'Montant': frame['amount'],
+            'Tiers': frame['third_party'],
+            'Devise': CURRENCY
+        })
+        out.to_csv(path, sep=';', decimal=',', index=False, float_format='%.2f')
+    elif variant == 'debit_credit':
+        debit, credit = _debit_credit(frame)
+        out = pd.DataFrame({
+            'Date': frame['date'].dt.strftime('%d/%m/%Y'),
+            'Libellé': frame['description'],
+            'Débit': debit,
+            'Crédit': credit,
+            'Tiers': frame['third_party']
+        })
+        out.to_csv(path, sep=',', index=False, float_format='%.2f')
+    elif variant == 'excel_serial':
+        serial = (frame['date'] - pd.Timestamp(1899, 12, 30)).dt.days
+        out = pd.DataFrame({
+            'Date': serial,
+            'Libellé': frame['description'],
+            'Montant': frame['amount']
+        })
+        out.to_csv(path, sep=';', index=False, float_format='%.2f')
+    elif variant == 'xlsx':
+        from openpyxl import Workbook
+
+        debit, credit = _debit_credit(frame)
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet('Grand livre')
+        ws.append(['Grand livre - export'])
+        ws.append(['Édité le', datetime(2024, 1, 15)])
+        ws.append([])
+        ws.append(['Date', 'Libellé', 'Débit', 'Crédit', 'Tiers'])
+        for row in zip(frame['date'].dt.to_pydatetime(), frame['description'], debit, credit, frame['third_party']):
+            ws.append([None if isinstance(v, float) and np.isnan(v) else v for v in row])
+        wb.save(path)
+    else:
+        raise ValueError(f"Unknown variant '{variant}'. Choose from: {', '.join(VARIANTS)}")
+    return path
+
+def generate_dataset(out_dir, users=1, transactions=1000, years=1, variants=None, seed=0, start_year=2021):
+    """
+    Writes one file per user and year in `out_dir`. User i gets the layout
+    variants[i % len(variants)]. Returns the manifest (list of dicts), also
+    saved as manifest.json.
+    """
+    variants = variants or VARIANTS
+    os.makedirs(out_dir, exist_ok=True)
+
+    manifest = []
+    for user in range(users):
+        variant = variants[user % len(variants)]
+        ext = '.xlsx' if variant == 'xlsx' else '.csv'
+        for year in range(start_year, start_year + years):
+            frame = generate_statement(user, year, transactions, seed)
+            path = os.path.join(out_dir, f'user{user:04d}_{year}_{variant}{ext}')
+            write_variant(frame, path, variant)
+            manifest.append({
+                'user': user,
+                'year': year,
+                'variant': variant,
+                'file': os.path.basename(path),
+                'rows': len(frame),
+                'bytes': os.path.getsize(path)
+            })
+
+    with open(os.path.join(out_dir, 'manifest.json'), 'w') as f:
+        json.dump({'seed': seed, 'files': manifest}, f, indent=2)
+    return manifest
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate seeded synthetic bank statements.")
+    parser.add_argument('out_dir')
+    parser.add_argument('--users', type=int, default=1)
+    parser.add_argument('--transactions', type=int, default=1000, help="Transactions per user and year")
+    parser.add_argument('--years', type=int, default=1)
+    parser.add_argument('--variants', default=','.join(VARIANTS), help="Comma separated layouts")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--start-year', type=int, default=2021)
+    args = parser.parse_args(argv)
+
+    manifest = generate_dataset(
+        args.out_dir, args.users, args.transactions, args.years,
+        [v.strip() for v in args.variants.split(',') if v.strip()], args.seed, args.start_year
+    )
+    print(f"{len(manifest)} file(s), {sum(m['rows'] for m in manifest)} rows written to {args.out_dir}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""
+Query-plan regression test for the dashboard endpoints: calls them through
+the test client on a small synthetic dataset (see synthetic_data.py), for a
+user and for one of their uploads, captures every SELECT they send and
+explains it. Fails when a statement reads transactions, monthly_rollups or
+daily_balances without an index: a SCAN in SQLite's EXPLAIN QUERY PLAN, a
+Seq Scan or an index scan without Index Cond on PostgreSQL, where sequential
+scans are disabled first so the plan does not depend on the table size.
+
+Runs on a throwaway SQLite database, or on TEST_DATABASE_URL (which must be
+empty). Use pytest -s to see every plan.
+"""
+import os
+import re
+import json
+import pytest
+
+CHECKED_TABLES = ('transactions', 'monthly_rollups', 'daily_balances')
+ENDPOINTS = [
+    '/api/dashboard/stats', '/api/dashboard/advanced-kpis',
+    '/api/dashboard/cashflow?granularity=day', '/api/dashboard/cashflow?granularity=month',
+    '/api/dashboard/monthly', '/api/dashboard/annual',
+    '/api/dashboard/top-expenses?limit=5', '/api/dashboard/top-income?limit=5',
+    '/api/dashboard/details?month=2024-06&type=expense', '/api/dashboard/analysis',
+    '/api/forecast?months=6', '/api/dashboard/bundle', '/api/budget/comparison'
+]
+USERS = 8
+TRANSACTIONS = 500 # Rows per synthetic statement (two per user)
+
+def seed(tmp, users, transactions):
+    from models import db, User, Upload
+    from services.ingestion import process_file
+    from synthetic_data import generate_statement, write_variant
+
+    # Several users, so that SQLite's statistics make one user's rows a small share of the table
+    users = [User(username=f'plan{i}', email=f'plan{i}@example.com', password_hash='-', subscription_status='active') for i in range(users)]
+    db.session.add_all(users)
+    db.session.commit()
+    upload_ids = []
+    for user in users:
+        for year in (2023, 2024):
+            path = write_variant(generate_statement(user.id, year, transactions), os.path.join(tmp, f'plan{user.id}-{year}.csv'), 'montant')
+            upload = Upload(filename=os.path.basename(path), user_id=user.id, status='processing')
+            db.session.add(upload)
+            db.session.commit()
+            process_file(path, upload.id)
+            upload_ids.append(upload.id)
+    db.session.execute(db.text("ANALYZE"))
+    db.session.commit()
+    return users[0].id, upload_ids[0]
+
+def capture(app, engine, user_id, upload_id):
+    """Returns [(label, statement, parameters)] of the SELECTs the endpoints run."""
+    from sqlalchemy import event
+    from flask_jwt_extended import create_access_token
+
+    statements = []
+    current = {}
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+            statements.append((current['label'], statement, parameters))
+
+    client = app.test_client()
+    with app.app_context():
+        headers = {'Authorization': 'Bearer ' + create_access_token(identity=str(user_id))}
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        for scope in ('', f'upload_id={upload_id}'):
+            for url in ENDPOINTS:
+                if scope:
+                    url += ('&' if '?' in url else '?') + scope
+                current['label'] = url
+                response = client.get(url, headers=headers)
+                assert response.status_code == 200, f"{url}: HTTP {response.status_code}"
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    return statements
+
+def _sqlite_problems(connection, statement, parameters):
+    plan = [row[-1] for row in connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)]
+    pattern = re.compile(r'^SCAN (%s)\b' % '|'.join(CHECKED_TABLES))
+    return plan, [line for line in plan if pattern.match(line)]
+
+def _postgresql_problems(connection, statement, parameters):
+    document = connection.exec_driver_sql('EXPLAIN (FORMAT JSON) ' + statement, parameters).scalar()
+    if isinstance(document, str):
+        document = json.loads(document)
+    plan, problems = [], []
+
+    def walk(node, depth):
+        relation = node.get('Relation Name')
+        line = '  ' * depth + node['Node Type'] + (f" on {relation}" if relation else '')
+        if node.get('Index Name'):
+            line += f" using {node['Index Name']}"
+        plan.append(line)
+        if relation in CHECKED_TABLES:
+            if node['Node Type'] == 'Seq Scan':
+                problems.append(line)
+            elif node['Node Type'] in ('Index Scan', 'Index Only Scan') and 'Index Cond' not in node:
+                problems.append(line + ' (full index scan)')
+        for child in node.get('Plans', []):
+            walk(child, depth + 1)
+
+    walk(document[0]['Plan'], 0)
+    return plan, problems
+
+def explain(engine, statements):
+    """Returns [(label, statement, plan)] of the distinct statements read without an index."""
+    failures = []
+    seen = set()
+    with engine.connect() as connection:
+        postgresql = connection.dialect.name == 'postgresql'
+        if postgresql:
+            connection.exec_driver_sql("SET enable_seqscan = off")
+        for label, statement, parameters in statements:
+            key = (statement, repr(parameters))
+            if key in seen:
+                continue
+            seen.add(key)
+            if postgresql:
+                plan, problems = _postgresql_problems(connection, statement, parameters)
+            else:
+                plan, problems = _sqlite_problems(connection, statement, parameters)
+            print(f"\n{'FAIL' if problems else 'ok'}  {label}\n    {' '.join(statement.split())[:300]}")
+            for line in plan:
+                print(f"      {line}")
+            if problems:
+                failures.append((label, ' '.join(statement.split())[:300], plan))
+        connection.rollback()
+    print(f"\n{len(seen)} distinct statement(s) checked, {len(failures)} without an index on {'/'.join(CHECKED_TABLES)}.")
+    return failures
+
+@pytest.fixture(scope='module')
+def seeded(tmp_path_factory):
+    tmp = str(tmp_path_factory.mktemp('plans'))
+    with pytest.MonkeyPatch.context() as env:
+        env.setenv('DATABASE_URL', os.environ.get('TEST_DATABASE_URL') or 'sqlite:///' + os.path.join(tmp, 'plans.db'))
+        env.setenv('INGESTION_WORKERS', '0') # Only the checked requests touch the DB
+        env.setenv('RESULT_CACHE_BACKEND', 'none') # Every endpoint call must reach the database
+        from app import create_app
+        from models import db, Transaction
+
+        app = create_app()
+        app.root_path = tmp # Uploaded files stay in the throwaway directory
+        with app.app_context():
+            if db.session.query(Transaction.id).first() is not None:
+                pytest.fail("TEST_DATABASE_URL must be an empty database: this test seeds its own data.")
+            user_id, upload_id = seed(tmp, USERS, TRANSACTIONS)
+            engine = db.engine
+        yield app, engine, user_id, upload_id
+        engine.dispose()
+
+def test_dashboard_queries_use_indexes(seeded):
+    app, engine, user_id, upload_id = seeded
+    failures = explain(engine, capture(app, engine, user_id, upload_id))
+    assert not failures, "Read without an index:\n" + '\n'.join(
+        f"{label}\n    {statement}\n" + '\n'.join(f"      {line}" for line in plan) for label, statement, plan in failures
+    )
@@ -0,0 +1,121 @@
+"""
+Deleting uploads that are still pending or processing is refused: the
+ingestion worker would keep inserting rows under an upload that no longer
+exists.
+"""
+import pytest
+
+@pytest.fixture
+def app(tmp_path):
+    with pytest.MonkeyPatch.context() as env:
+        env.setenv('DATABASE_URL', 'sqlite:///' + str(tmp_path / 'delete.db'))
+        env.setenv('INGESTION_WORKERS', '0')
+        env.setenv('RESULT_CACHE_BACKEND', 'none')
+        from app import create_app
+        from models import db
+
+        app = create_app()
+        app.root_path = str(tmp_path)
+        yield app
+        with app.app_context():
+            db.engine.dispose()
+
+def _user(db, User, name, admin=False):
+    user = User(username=name, email=f'{name}@example.com', password_hash='-', is_admin=admin)
+    db.session.add(user)
+    db.session.commit()
+    return user.id
+
+def _headers(user_id):
+    from flask_jwt_extended import create_access_token
+    return {'Authorization': 'Bearer ' + create_access_token(identity=str(user_id))}
+
+def test_delete_upload_refused_while_ingesting(app):
+    from models import db, User, Upload
+
+    with app.app_context():
+        owner = _user(db, User, 'owner')
+        uploads = {status: Upload(filename=f'{status}.csv', user_id=owner, status=status)
+                   for status in ('pending', 'processing', 'completed', 'error')}
+        db.session.add_all(uploads.values())
+        db.session.commit()
+        ids = {status: upload.id for status, upload in uploads.items()}
+        headers = _headers(owner)
+
+    client = app.test_client()
+    for status in ('pending', 'processing'):
+        response = client.delete(f"/api/uploads/{ids[status]}", headers=headers)
+        assert response.status_code == 409, status
+    for status in ('completed', 'error'):
+        assert client.delete(f"/api/uploads/{ids[status]}", headers=headers).status_code == 200, status
+
+    with app.app_context():
+        assert sorted(u.status for u in Upload.query.all()) == ['pending', 'processing']
+
+def test_delete_upload_refused_while_a_refresh_is_ingesting(app):
+    from models import db, User, Upload
+
+    with app.app_context():
+        owner = _user(db, User, 'owner')
+        base = Upload(filename='base.csv', user_id=owner, status='completed')
+        db.session.add(base)
+        db.session.commit()
+        db.session.add(Upload(filename='refresh.csv', user_id=owner, status='processing', append_to_id=base.id))
+        db.session.commit()
+        base_id = base.id
+        headers = _headers(owner)
+
+    assert app.test_client().delete(f"/api/uploads/{base_id}", headers=headers).status_code == 409
+
+def test_delete_user_refused_while_ingesting(app):
+    from models import db, User, Upload
+
+    with app.app_context():
+        admin = _user(db, User, 'admin', admin=True)
+        owner = _user(db, User, 'owner')
+        upload = Upload(filename='s.csv', user_id=owner, status='processing')
+        db.session.add(upload)
+        db.session.commit()
+        headers = _headers(admin)
+
+    client = app.test_client()
+    assert client.delete(f"/api/admin/users/{owner}", headers=headers).status_code == 409
+    with app.app_context():
+        Upload.query.filter_by(user_id=owner).update({'status': 'completed'})
+        db.session.commit()
+    assert client.delete(f"/api/admin/users/{owner}", headers=headers).status_code == 200
+
+def test_upload_deleted_while_ingesting_leaves_nothing_behind(app, tmp_path, monkeypatch):
+    from models import db, User, Upload, Transaction, MonthlyRollup, DailyBalance
+    from services import balances, progress, rollups
+    from services.ingestion import process_file
+    from services.kpi import get_dashboard_stats
+
+    path = tmp_path / 'statement.csv'
+    path.write_text('Date;Libellé;Montant\n' + ''.join(f'{d:02d}/03/2024;Vente {d};100\n' for d in range(1, 31)))
+
+    with app.app_context():
+        owner = _user(db, User, 'owner')
+        upload = Upload(filename='statement.csv', user_id=owner, status='processing')
+        db.session.add(upload)
+        db.session.commit()
+        upload_id = upload.id
+
+        # The upload is deleted (as delete_upload used to) once two chunks are committed
+        published = []
+        def publish(uid, finished=False):
+            published.append(uid)
+            if len(published) == 3: # 'reading', then two chunks
+                Transaction.query.filter_by(source_file_id=uid).delete()
+                rollups.delete(uid)
+                balances.delete(uid)
+                db.session.delete(Upload.query.get(uid))
+                db.session.commit()
+        monkeypatch.setattr(progress, 'publish', publish)
+
+        assert process_file(str(path), upload_id, chunksize=10) == 0
+        assert Transaction.query.count() == 0
+        assert MonthlyRollup.query.count() == 0
+        assert DailyBalance.query.filter_by(user_id=owner).count() == 0
+        stats = get_dashboard_stats(user_id=owner)
+        assert stats['total_sales'] == 0 and stats['current_balance'] == 0
@@ -33,3 +33,13 @@ def format_date_sql(date_col, fmt):
                     .replace('%M', 'MI') \
                     .replace('%S', 'SS')
         return func.to_char(date_col, pg_fmt)
+
+def week_start_sql(date_col):
+    """
+    Returns a SQLAlchemy expression for the Monday of a date's week, as
+    'YYYY-MM-DD' text (ISO weeks on both SQLite and PostgreSQL).
+    """
+    if db.engine.name == 'sqlite':
+        # Next Sunday (the day itself if it is one), then back to its Monday
+        return func.date(date_col, 'weekday 0', '-6 days')
+    return func.to_char(func.date_trunc('week', date_col), 'YYYY-MM-DD')
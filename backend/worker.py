@@ -0,0 +1,24 @@
+"""
+Standalone ingestion worker, for deployments running the web app with
+INGESTION_WORKERS=0. Claims 'pending' uploads from the shared database.
+
+Usage: python worker.py [threads]
+"""
+import os
+import sys
+
+os.environ['INGESTION_WORKERS'] = '0' # No extra pool inside create_app
+
+from app import create_app
+from services.jobs import IngestionWorkerPool
+
+app = create_app()
+
+if __name__ == "__main__":
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    pool = IngestionWorkerPool(app, workers=workers).start()
+    print(f"Ingestion worker started with {workers} thread(s).")
+    try:
+        pool.join()
+    except KeyboardInterrupt:
+        pool.stop()
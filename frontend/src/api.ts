@@ -16,3 +16,55 @@ api.interceptors.request.use((config) => {
 });
 
 export default api;
+
+export interface UploadProgress {
+    upload_id: number;
+    status: 'pending' | 'processing' | 'completed' | 'error';
+    stage: string;
+    rows_read: number;
+    rows_inserted: number;
+    rows_skipped: number;
+    rows_total: number | null;
+    progress: number;
+    eta_seconds: number | null;
+    error: string | null;
+}
+
+// Reads the Server-Sent Events of /uploads/:id/events. fetch() rather than
+// EventSource, which cannot send the Authorization header.
+// Resolves with the last event once the server closes the stream.
+export const streamUploadProgress = async (
+    uploadId: number,
+    onEvent: (event: UploadProgress) => void
+): Promise<UploadProgress | null> => {
+    const token = localStorage.getItem('token');
+    const response = await fetch(`${api.defaults.baseURL}/uploads/${uploadId}/events`, {
+        headers: token ? { Authorization: `Bearer ${token}` } : {},
+    });
+    if (!response.ok || !response.body) {
+        throw new Error(`Progress stream unavailable (${response.status})`);
+    }
+
+    const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+    let buffer = '';
+    let last: UploadProgress | null = null;
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) return last;
+        buffer += value;
+
+        let end: number;
+        while ((end = buffer.indexOf('\n\n')) >= 0) {
+            const block = buffer.slice(0, end);
+            buffer = buffer.slice(end + 2);
+            const data = block
+                .split('\n')
+                .filter((line) => line.startsWith('data:'))
+                .map((line) => line.slice(5).trim())
+                .join('\n');
+            if (!data) continue; // Comment (keep-alive) or retry hint
+            last = JSON.parse(data) as UploadProgress;
+            onEvent(last);
+        }
+    }
+};
@@ -1,7 +1,7 @@
 import React, { useState } from 'react';
 import { Upload as UploadIcon, CheckCircle, AlertCircle, FileSpreadsheet } from 'lucide-react';
 import { useNavigate } from 'react-router-dom';
-import api from '../api';
+import api, { streamUploadProgress, UploadProgress } from '../api';
 
 interface UploadProps {
     onUploadSuccess: (uploadId: number) => void;
@@ -12,6 +12,7 @@ const Upload: React.FC<UploadProps> = ({ onUploadSuccess }) => {
     const [file, setFile] = useState<File | null>(null);
     const [uploading, setUploading] = useState(false);
     const [message, setMessage] = useState<{ type: 'success' | 'error'; text: string } | null>(null);
+    const [progress, setProgress] = useState<UploadProgress | null>(null);
 
     const handleFileChange = (e: React.ChangeEvent<HTMLInputElement>) => {
         if (e.target.files && e.target.files[0]) {
@@ -20,6 +21,25 @@ const Upload: React.FC<UploadProps> = ({ onUploadSuccess }) => {
         }
     };
 
+    // Processing runs in the background: follow its progress stream until it is done
+    const waitForProcessing = async (uploadId: number) => {
+        while (true) {
+            const last = await streamUploadProgress(uploadId, setProgress);
+            if (last?.status === 'completed') return last;
+            if (last?.status === 'error') throw new Error(last.error || 'Processing failed.');
+            // The server closes long streams: reconnect
+            await new Promise((resolve) => setTimeout(resolve, 500));
+        }
+    };
+
+    const progressLabel = (p: UploadProgress) => {
+        if (p.stage === 'queued') return ' En attente...';
+        let label = ` ${p.progress}%`;
+        if (p.rows_read) label += ` · ${p.rows_read.toLocaleString('fr-FR')} lignes`;
+        if (p.eta_seconds !== null) label += ` · ~${p.eta_seconds} s`;
+        return label;
+    };
+
     const handleUpload = async () => {
         if (!file) return;
 
@@ -28,6 +48,7 @@ const Upload: React.FC<UploadProps> = ({ onUploadSuccess }) => {
 
         setUploading(true);
         setMessage(null);
+        setProgress(null);
 
         try {
             const response = await api.post('/upload', formData, {
@@ -35,7 +56,8 @@ const Upload: React.FC<UploadProps> = ({ onUploadSuccess }) => {
                     'Content-Type': 'multipart/form-data',
                 },
             });
-            setMessage({ type: 'success', text: response.data.message });
+            const upload = await waitForProcessing(response.data.upload_id);
+            setMessage({ type: 'success', text: `Fichier traité avec succès. ${upload.rows_read} lignes lues, ${upload.rows_inserted} importées.` });
             setFile(null);
             onUploadSuccess(response.data.upload_id);
         } catch (err: any) {
@@ -52,6 +74,7 @@ const Upload: React.FC<UploadProps> = ({ onUploadSuccess }) => {
             });
         } finally {
             setUploading(false);
+            setProgress(null);
         }
     };
 
@@ -111,7 +134,7 @@ const Upload: React.FC<UploadProps> = ({ onUploadSuccess }) => {
                     : 'bg-blue-600 hover:bg-blue-500 text-white shadow-lg shadow-blue-500/20'
                     }`}
             >
-                {uploading ? 'Traitement en cours...' : 'Traiter le Fichier'}
+                {uploading ? `Traitement en cours...${progress !== null ? progressLabel(progress) : ''}` : 'Traiter le Fichier'}
             </button>
         </div>
     );
@@ -76,31 +76,21 @@ const Dashboard: React.FC = () => {
     const fetchData = async () => {
         try {
             const params = uploadId ? `&upload_id=${uploadId}` : '';
-            const qParams = uploadId ? `?upload_id=${uploadId}` : '';
-
-            const [statsRes, advStatsRes, cashflowRes, monthlyRes, annualRes, topExpRes, topIncRes, forecastRes, analysisRes] = await Promise.all([
-                api.get(`/dashboard/stats${qParams}`),
-                api.get(`/dashboard/advanced-kpis${qParams}`),
-                api.get(`/dashboard/cashflow?granularity=day${params}`),
-                api.get(`/dashboard/monthly${qParams}`), // Let backend choose default year
-                api.get(`/dashboard/annual${qParams}`),
-                api.get(`/dashboard/top-expenses?limit=0${params}`), // Fetch ALL expenses
-                api.get(`/dashboard/top-income?limit=0${params}`), // Fetch ALL income
-                api.get(`/forecast?months=6${params}`),
-                api.get(`/dashboard/analysis${qParams}`)
-            ]);
-            setStats(statsRes.data);
-            if (statsRes.data?.current_balance !== undefined) {
-                setCustomBalance(statsRes.data.current_balance);
+
+            // Every section in one request; the backend lets year default to the latest one
+            const { data } = await api.get(`/dashboard/bundle?granularity=day&limit=0&months=6${params}`);
+            setStats(data.stats);
+            if (data.stats?.current_balance !== undefined) {
+                setCustomBalance(data.stats.current_balance);
             }
-            setAdvancedStats(advStatsRes.data);
-            setCashflow(cashflowRes.data || []);
-            setMonthlyData(monthlyRes.data || []);
-            setAnnualData(annualRes.data || []);
-            setTopExpenses(topExpRes.data || []);
-            setTopIncome(topIncRes.data || []);
-            setForecastData(forecastRes.data || []);
-            setAnalysisData(analysisRes.data);
+            setAdvancedStats(data.advanced_kpis);
+            setCashflow(data.cashflow || []);
+            setMonthlyData(data.monthly || []);
+            setAnnualData(data.annual || []);
+            setTopExpenses(data.top_expenses || []);
+            setTopIncome(data.top_income || []);
+            setForecastData(data.forecast || []);
+            setAnalysisData(data.analysis);
         } catch (error) {
             console.error("Error fetching dashboard data:", error);
         } finally {
@@ -32,9 +32,9 @@ const History: React.FC = () => {
             try {
                 await api.delete(`/uploads/${id}`);
                 setUploads(uploads.filter(u => u.id !== id));
-            } catch (error) {
+            } catch (error: any) {
                 console.error("Error deleting upload:", error);
-                alert("Erreur lors de la suppression.");
+                alert(error.response?.data?.error || "Erreur lors de la suppression.");
             }
         }
     };